@@ -7,7 +7,8 @@
 
 from user_metrics.utils import nested_import
 from user_metrics.config import settings
-from user_metrics.api.broker import FileBroker
+from user_metrics.api.broker import FileBroker, IndexedFileBroker, \
+    SQLiteBroker
 
 from user_metrics.config import settings as conf
 
@@ -16,7 +17,40 @@ REQUEST_BROKER_TARGET = BROKER_HOME + 'request_broker.txt'
 RESPONSE_BROKER_TARGET = BROKER_HOME + 'response_broker.txt'
 PROCESS_BROKER_TARGET = BROKER_HOME + 'process_broker.txt'
 
-umapi_broker_context = FileBroker()
+# Requesters of the queued requests, keyed as in the request target
+REQUESTER_BROKER_TARGET = BROKER_HOME + 'requester_broker.txt'
+
+# Maps the key of a request with a single aggregator onto the key of a
+# queued request combining that aggregator with others
+COALESCE_BROKER_TARGET = BROKER_HOME + 'coalesce_broker.txt'
+
+# Progress of the running jobs, keyed as in the process target
+PROGRESS_BROKER_TARGET = BROKER_HOME + 'progress_broker.txt'
+
+# Time series points are streamed onto a target per request, the last item
+# of a stream is keyed on STREAM_END_KEY
+STREAM_BROKER_PREFIX = BROKER_HOME + 'stream_broker_'
+STREAM_END_KEY = 'end'
+
+
+def get_stream_target(url_hash):
+    """ Returns the broker target streaming the points of a request """
+    return STREAM_BROKER_PREFIX + url_hash + '.txt'
+
+# Broker implementations selectable with ``__broker_type__`` in the settings
+# and the arguments they are built with
+BROKER_TYPES = {
+    'file': FileBroker,
+    'indexed': IndexedFileBroker,
+    'sqlite': SQLiteBroker,
+}
+BROKER_KWARGS = {
+    'sqlite': {'db': BROKER_HOME + 'broker.db'},
+}
+
+BROKER_TYPE = getattr(conf, '__broker_type__', 'file')
+umapi_broker_context = BROKER_TYPES[BROKER_TYPE](
+    **BROKER_KWARGS.get(BROKER_TYPE, {}))
 
 query_mod = nested_import(settings.__query_module__)
 
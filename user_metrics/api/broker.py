@@ -12,12 +12,24 @@ __license__ = "GPL (version 2 or later)"
 
 import json
 import os
+import errno
+import fcntl
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from select import select
 from user_metrics.config import logging
 
 
 class Broker(object):
     """
     Base class for broker
+
+    Processes block on targets with ``wait`` until another process signals
+    a change with ``notify``.  Notifications are written to a named pipe
+    beside the target that the waiting process holds open, so they are not
+    lost between two waits.  A notification wakes a single waiting process.
     """
 
     def compose(self):
@@ -47,6 +59,18 @@ class Broker(object):
         """
         raise NotImplementedError()
 
+    def clear(self, target):
+        """
+        Remove all key/value pairs from the target
+        """
+        raise NotImplementedError()
+
+    def drop(self, target):
+        """
+        Remove the target altogether, releasing any resources held for it
+        """
+        raise NotImplementedError()
+
     def get_keys(self, target):
         """
         Retrieve all keys in the broker
@@ -71,12 +95,74 @@ class Broker(object):
         """
         raise NotImplementedError()
 
+    def claim(self, source, dest, key=None):
+        """
+        Move the first item of the source queue, or the item of key, to dest,
+        keeping its key, and return its value
+        """
+        raise NotImplementedError()
+
+    def notify(self, target):
+        """
+        Wake the process waiting on target, if any
+        """
+        try:
+            fd = os.open(target + '.fifo', os.O_WRONLY | os.O_NONBLOCK)
+        except OSError:
+            # No process waits on the target
+            return
+        try:
+            os.write(fd, '.')
+        except OSError as e:
+            # A full pipe already holds pending notifications
+            if e.errno != errno.EAGAIN:
+                raise
+        finally:
+            os.close(fd)
+
+    def wait(self, targets, timeout=None, fds=()):
+        """
+        Block until one of targets is notified, one of the file descriptors
+        (or objects with a ``fileno`` method) in fds is readable or the
+        timeout elapses.  Returns False on timeout.
+        """
+        fifos = [self._fifo(target) for target in targets]
+        ready = select(fifos + list(fds), [], [], timeout)[0]
+        for fd in ready:
+            if fd in fifos:
+                # Consume the pending notifications
+                try:
+                    while os.read(fd, 4096):
+                        pass
+                except OSError as e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+        return bool(ready)
+
+    def _fifo(self, target):
+        """
+        Returns the read end of the named pipe of target, opened read-write
+        so that it stays open without writers
+        """
+        if getattr(self, '_fifo_pid', None) != os.getpid():
+            self._fifos = dict()
+            self._fifo_pid = os.getpid()
+        if target not in self._fifos:
+            path = target + '.fifo'
+            try:
+                os.mkfifo(path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            self._fifos[target] = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+        return self._fifos[target]
+
 
 class FileBroker(Broker):
     """
     Implements a broker that uses a flat file as a broker
 
-    !! Operations are O(n), consider storing keys in heap
+    !! Operations are O(n), see ``IndexedFileBroker``
     """
 
     def __init__(self, **kwargs):
@@ -103,7 +189,7 @@ class FileBroker(Broker):
         """
         try:
             with open(target, 'r') as f:
-                lines = f.read().split('\n')
+                lines = [line for line in f.read().split('\n') if line]
                 for idx, line in enumerate(lines):
                     item = json.loads(line)
                     if item.keys()[0] == key:
@@ -116,7 +202,7 @@ class FileBroker(Broker):
 
         with open(target, 'w') as f:
             for line in lines:
-                f.write(line)
+                f.write(line + '\n')
 
     def update(self, target, key, value):
         """
@@ -124,11 +210,11 @@ class FileBroker(Broker):
         """
         try:
             with open(target, 'r') as f:
-                lines = f.read().split('\n')
+                lines = [line for line in f.read().split('\n') if line]
                 for idx, line in enumerate(lines):
                     item = json.loads(line)
                     if item.keys()[0] == key:
-                        lines[idx] = json.dumps({key: value}) + '\n'
+                        lines[idx] = json.dumps({key: value})
                         break
         except IOError:
             lines = []
@@ -137,7 +223,7 @@ class FileBroker(Broker):
 
         with open(target, 'w') as f:
             for line in lines:
-                f.write(line)
+                f.write(line + '\n')
 
     def get(self, target, key):
         """
@@ -156,6 +242,22 @@ class FileBroker(Broker):
 
             return None
 
+    def clear(self, target):
+        """
+        Empty the target
+        """
+        with open(target, 'w'):
+            pass
+
+    def drop(self, target):
+        """
+        Remove the target file
+        """
+        try:
+            os.remove(target)
+        except OSError:
+            pass
+
     def get_keys(self, target):
         """
         Retrieve all keys in the broker target
@@ -172,6 +274,8 @@ class FileBroker(Broker):
             with open(target, 'r') as f:
                 lines = f.read().split('\n')
                 for idx, line in enumerate(lines):
+                    if not line:
+                        continue
                     try:
                         item = json.loads(line)
                     except Exception:
@@ -213,3 +317,468 @@ class FileBroker(Broker):
         Return boolean indicating whether a key is in target
         """
         return key in self.get_keys(target)
+
+    def claim(self, source, dest, key=None):
+        """
+        Move the first item of source, or the item of key, to dest, this is
+        not atomic: two processes may claim the same item
+        """
+        if key is None:
+            try:
+                with open(source, 'r') as f:
+                    item = json.loads(f.readline())
+                    key = item.keys()[0]
+                    value = item[key]
+            except (IOError, KeyError, ValueError, IndexError):
+                return None
+        else:
+            value = self.get(source, key)
+            if value is None:
+                return None
+        self.remove(source, key)
+        self.add(dest, key, value)
+        return value
+
+
+class IndexedFileBroker(Broker):
+    """
+    Implements a broker over append-only logs of JSON records.  Each target
+    is a log of ``[op, key, value]`` records that is replayed into an
+    in-memory index ordered by insertion, so ``add``, ``pop``, ``remove``
+    and ``is_item`` are O(1) amortised.  Other processes' changes are picked
+    up by reading the records appended since the last operation.
+
+    Access to a target is serialised between processes with ``flock`` on a
+    lock file beside the log.  The log is kept open, so that a log replaced
+    by another process is told apart by its inode even on file systems that
+    reuse inodes quickly.  Once the log holds more than
+    ``COMPACTION_MIN_RECORDS`` records of which less than
+    ``1 / COMPACTION_RATIO`` are live it is compacted, i.e. the live items
+    are written to a new log that replaces the old one.
+    """
+
+    # Log record operations
+    OP_ADD = 'a'
+    OP_DEL = 'd'
+
+    COMPACTION_MIN_RECORDS = 1000
+    COMPACTION_RATIO = 4
+
+    def __init__(self, **kwargs):
+        super(IndexedFileBroker, self).__init__(**kwargs)
+        self._targets = dict()
+        self._pid = os.getpid()
+        self._mutex = threading.RLock()
+
+    def compose(self):
+        pass
+
+    def _log_path(self, target):
+        return target + '.log'
+
+    def _state(self, target):
+        """
+        Returns the index state of the target, lock files are reopened in
+        forked processes as ``flock`` locks are shared by open files
+        """
+        if self._pid != os.getpid():
+            for state in self._targets.itervalues():
+                state['lock'].close()
+                if state['log']:
+                    state['log'].close()
+            self._targets = dict()
+            self._pid = os.getpid()
+            self._mutex = threading.RLock()
+
+        if target not in self._targets:
+            self._targets[target] = {
+                'lock': open(target + '.lock', 'a'),
+                'index': OrderedDict(),
+                'log': None,
+                'offset': 0,
+                'records': 0,
+            }
+        return self._targets[target]
+
+    @contextmanager
+    def _locked(self, target, exclusive=False):
+        """
+        Holds the target lock and syncs the index with the log, threads of
+        a process are serialised on the broker mutex
+        """
+        state = self._state(target)
+        with self._mutex:
+            fcntl.flock(state['lock'], fcntl.LOCK_EX if exclusive else
+                        fcntl.LOCK_SH)
+            try:
+                self._sync(target, state)
+                yield state
+            finally:
+                fcntl.flock(state['lock'], fcntl.LOCK_UN)
+
+    def _is_open_log(self, state, stat):
+        """ Whether the open log of the target is the file of ``stat`` """
+        if not state['log']:
+            return False
+        log_stat = os.fstat(state['log'].fileno())
+        return (log_stat.st_dev, log_stat.st_ino) == \
+            (stat.st_dev, stat.st_ino)
+
+    def _open_log(self, target, state):
+        """ (Re)opens the log of the target, the caller holds the lock """
+        if state['log']:
+            state['log'].close()
+        state['log'] = open(self._log_path(target), 'r')
+
+    def _sync(self, target, state):
+        """ Applies the records appended to the log since the last sync """
+        try:
+            stat = os.stat(self._log_path(target))
+        except OSError:
+            stat = None
+
+        if not stat or not self._is_open_log(state, stat) or \
+                stat.st_size < state['offset']:
+            # The log was replaced (compacted or cleared), replay it
+            state['index'] = OrderedDict()
+            state['offset'] = 0
+            state['records'] = 0
+            if state['log']:
+                state['log'].close()
+                state['log'] = None
+            if stat:
+                self._open_log(target, state)
+        if not stat or stat.st_size == state['offset']:
+            return
+
+        log = state['log']
+        log.seek(state['offset'])
+        for line in iter(log.readline, ''):
+            if not line.endswith('\n'):
+                break
+            state['offset'] += len(line)
+            try:
+                op, key, value = json.loads(line)
+            except ValueError:
+                logging.error(__name__ + ' :: Could not parse JSON '
+                                         'from: {0}'.format(line))
+                continue
+            self._apply(state, op, key, value)
+
+    def _apply(self, state, op, key, value):
+        state['records'] += 1
+        if op == self.OP_ADD:
+            state['index'][key] = value
+        else:
+            state['index'].pop(key, None)
+
+    def _append(self, target, state, op, key, value=None):
+        """ Appends a record to the log, the caller holds the lock """
+        line = json.dumps([op, key, value]) + '\n'
+        with open(self._log_path(target), 'a') as f:
+            f.write(line)
+        if not state['log']:
+            self._open_log(target, state)
+        state['offset'] += len(line)
+        self._apply(state, op, key, value)
+
+        if state['records'] > self.COMPACTION_MIN_RECORDS and \
+                state['records'] > self.COMPACTION_RATIO * \
+                len(state['index']):
+            self._rewrite(target, state)
+
+    def _rewrite(self, target, state):
+        """ Replaces the log by one holding only the live items """
+        tmp = self._log_path(target) + '.tmp'
+        offset = 0
+        with open(tmp, 'w') as f:
+            for key, value in state['index'].iteritems():
+                line = json.dumps([self.OP_ADD, key, value]) + '\n'
+                f.write(line)
+                offset += len(line)
+        os.rename(tmp, self._log_path(target))
+        self._open_log(target, state)
+        state['offset'] = offset
+        state['records'] = len(state['index'])
+
+    def add(self, target, key, value):
+        """
+        Adds key/value pair
+        """
+        with self._locked(target, exclusive=True) as state:
+            self._append(target, state, self.OP_ADD, key, value)
+
+    def remove(self, target, key):
+        """
+        Remove element with the given key
+        """
+        with self._locked(target, exclusive=True) as state:
+            if key in state['index']:
+                self._append(target, state, self.OP_DEL, key)
+
+    def update(self, target, key, value):
+        """
+        Update element with the given key
+        """
+        with self._locked(target, exclusive=True) as state:
+            if key in state['index']:
+                self._append(target, state, self.OP_ADD, key, value)
+
+    def get(self, target, key):
+        """
+        Retrieve a value with the given key
+        """
+        with self._locked(target) as state:
+            return state['index'].get(key)
+
+    def clear(self, target):
+        """
+        Empty the target
+        """
+        with self._locked(target, exclusive=True) as state:
+            state['index'] = OrderedDict()
+            self._rewrite(target, state)
+
+    def drop(self, target):
+        """
+        Remove the log and lock file of the target and close them
+        """
+        with self._locked(target, exclusive=True):
+            for path in [self._log_path(target), target + '.lock']:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        with self._mutex:
+            state = self._targets.pop(target, None)
+            if state:
+                state['lock'].close()
+                if state['log']:
+                    state['log'].close()
+
+    def get_keys(self, target):
+        """
+        Retrieve all keys in the broker target
+        """
+        with self._locked(target) as state:
+            return state['index'].keys()
+
+    def get_all_items(self, target):
+        """
+        Retrieve all values in the target
+        """
+        with self._locked(target) as state:
+            return [{key: value} for key, value in
+                    state['index'].iteritems()]
+
+    def pop(self, target):
+        """
+        Pop the top value from the list
+        """
+        with self._locked(target, exclusive=True) as state:
+            if not state['index']:
+                return None
+            key, value = next(state['index'].iteritems())
+            self._append(target, state, self.OP_DEL, key)
+            return value
+
+    def claim(self, source, dest, key=None):
+        """
+        Atomically move the first item of source, or the item of key, to
+        dest, targets are locked in name order
+        """
+        first, second = sorted([source, dest])
+        with self._locked(first, exclusive=True):
+            with self._locked(second, exclusive=True):
+                source_state = self._state(source)
+                if key is None:
+                    if not source_state['index']:
+                        return None
+                    key, value = next(source_state['index'].iteritems())
+                elif key in source_state['index']:
+                    value = source_state['index'][key]
+                else:
+                    return None
+                self._append(dest, self._state(dest), self.OP_ADD, key,
+                             value)
+                self._append(source, source_state, self.OP_DEL, key)
+                return value
+
+    def is_item(self, target, key):
+        """
+        Return boolean indicating whether a key is in target
+        """
+        with self._locked(target) as state:
+            return key in state['index']
+
+
+class SQLiteBroker(Broker):
+    """
+    Implements a broker over a SQLite database in WAL mode, so readers don't
+    block the writer.  Items of all targets are rows of a single table
+    indexed on ``(target, key)`` and ordered by insertion.  ``pop`` and
+    ``claim`` run in immediate transactions, an item is claimed by exactly
+    one of several concurrent job controllers.
+
+    Connections are opened per process and thread.
+    """
+
+    # Seconds to wait on a locked database
+    BUSY_TIMEOUT = 30.0
+
+    def __init__(self, db=None, **kwargs):
+        super(SQLiteBroker, self).__init__(**kwargs)
+        self.db = db
+        self._local = threading.local()
+        self.compose()
+
+    def compose(self):
+        """
+        Creates the item table and its indices
+        """
+        conn = self._connection()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS broker_items (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                target TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                UNIQUE (target, key))
+            """)
+        conn.execute('CREATE INDEX IF NOT EXISTS broker_items_target '
+                     'ON broker_items (target, id)')
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db, timeout=self.BUSY_TIMEOUT,
+                                   isolation_level=None)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """ Runs statements in an immediate (write locked) transaction """
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _put(self, conn, target, key, value):
+        conn.execute('INSERT INTO broker_items (target, key, value) '
+                     'VALUES (?, ?, ?)', (target, key, value))
+
+    def add(self, target, key, value):
+        """
+        Adds key/value pair, replacing the value of an existing key
+        """
+        value = json.dumps(value)
+        with self._transaction() as conn:
+            if not conn.execute('UPDATE broker_items SET value = ? '
+                                'WHERE target = ? AND key = ?',
+                                (value, target, key)).rowcount:
+                self._put(conn, target, key, value)
+
+    def remove(self, target, key):
+        """
+        Remove element with the given key
+        """
+        self._connection().execute('DELETE FROM broker_items '
+                                   'WHERE target = ? AND key = ?',
+                                   (target, key))
+
+    def update(self, target, key, value):
+        """
+        Update element with the given key
+        """
+        self._connection().execute('UPDATE broker_items SET value = ? '
+                                   'WHERE target = ? AND key = ?',
+                                   (json.dumps(value), target, key))
+
+    def get(self, target, key):
+        """
+        Retrieve a value with the given key
+        """
+        row = self._connection().execute(
+            'SELECT value FROM broker_items WHERE target = ? AND key = ?',
+            (target, key)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def clear(self, target):
+        """
+        Empty the target
+        """
+        self._connection().execute('DELETE FROM broker_items '
+                                   'WHERE target = ?', (target,))
+
+    def drop(self, target):
+        """
+        Remove the target, its items are all the target holds
+        """
+        self.clear(target)
+
+    def get_keys(self, target):
+        """
+        Retrieve all keys in the broker target
+        """
+        return [row[0] for row in self._connection().execute(
+            'SELECT key FROM broker_items WHERE target = ? ORDER BY id',
+            (target,))]
+
+    def get_all_items(self, target):
+        """
+        Retrieve all values in the target with a single query
+        """
+        return [{key: json.loads(value)} for key, value in
+                self._connection().execute(
+                    'SELECT key, value FROM broker_items WHERE target = ? '
+                    'ORDER BY id', (target,))]
+
+    def _first(self, conn, target):
+        return conn.execute('SELECT id, key, value FROM broker_items '
+                            'WHERE target = ? ORDER BY id LIMIT 1',
+                            (target,)).fetchone()
+
+    def pop(self, target):
+        """
+        Pop the top value from the list
+        """
+        with self._transaction() as conn:
+            row = self._first(conn, target)
+            if not row:
+                return None
+            conn.execute('DELETE FROM broker_items WHERE id = ?', (row[0],))
+        return json.loads(row[2])
+
+    def claim(self, source, dest, key=None):
+        """
+        Atomically move the first item of source, or the item of key, to dest
+        """
+        with self._transaction() as conn:
+            if key is None:
+                row = self._first(conn, source)
+            else:
+                row = conn.execute('SELECT id, key, value FROM broker_items '
+                                   'WHERE target = ? AND key = ?',
+                                   (source, key)).fetchone()
+            if not row:
+                return None
+            conn.execute('DELETE FROM broker_items WHERE id = ? OR '
+                         '(target = ? AND key = ?)', (row[0], dest, row[1]))
+            self._put(conn, dest, row[1], row[2])
+        return json.loads(row[2])
+
+    def is_item(self, target, key):
+        """
+        Return boolean indicating whether a key is in target
+        """
+        return self._connection().execute(
+            'SELECT 1 FROM broker_items WHERE target = ? AND key = ?',
+            (target, key)).fetchone() is not None
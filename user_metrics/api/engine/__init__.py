@@ -59,18 +59,24 @@ DEFAULT_QUERY_VAL = 'present'
 # DELIMETER FOR RESPONSE IN BROKER
 RESPONSE_DELIMETER = '<&>'
 
-# Timeout in seconds to wait for data on the queue.  This should be long
-# enough to ensure that the full response can be received
+# Longest time in seconds the response handler and the job controller sleep
+# between broker notifications (see ``Broker.wait``)
 RESPONSE_TIMEOUT = 10.0
 RESQUEST_TIMEOUT = 10.0
 
 # MODULE CONSTANTS
 #
-# 1. Determines maximum block size of (multiprocessing.)queue item
-# 2. Number of maximum concurrently running jobs
-# 3. Time to block on waiting for a new request to appear in the queue
-MAX_BLOCK_SIZE = 5000
-MAX_CONCURRENT_JOBS = 2
+# 1. Bounds of the number of concurrently running jobs, the job scheduler
+# adapts the limit between them (see the scheduler module)
+# 2. Default length in hours of the intervals of time series requests
+MIN_CONCURRENT_JOBS = int(getattr(settings, '__min_concurrent_jobs__', 2))
+MAX_CONCURRENT_JOBS = int(getattr(settings, '__max_concurrent_jobs__', 8))
+DEFAULT_INERVAL_LENGTH = 24
+
+# Sampled aggregator requests for a ``target_error`` start from a pilot
+# sample of this fraction of the cohort, and of at least this many users
+SAMPLE_PILOT_FRACTION = 0.01
+SAMPLE_PILOT_MIN_USERS = 500
 
 
 #
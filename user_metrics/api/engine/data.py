@@ -16,27 +16,57 @@
 
     The other portion of data storage and retrieval is concerned with providing
     functionality that enables responses to be cached.  Request responses are
-    currently cached in the ``api_data`` OrderedDict_ defined in the run
-    module.  This object stores responses in a nested fashion using URL request
-    variables and their corresponding values.  For example, the url
+    cached in the ``response_store``, see the response_store module.  A
+    response is keyed on the hash of the URL request variables and their
+    corresponding values.  For example, the url
     ``http://metrics-api.wikimedia.org/cohorts/e3_ob2b/revert_rate?t=10000``
-    maps to::
+    is keyed on the hash of::
 
-        api_data['cohort_expr <==> e3_ob2b']['metric <==> revert_rate']
-        ['start <==> xx']['start <==> yy']['t <==> 10000']
+        ['cohort_expr--e3_ob2b', 'metric--revert_rate', 't--10000']
 
     The list of key values for a given request is referred to as it's "key
     signature".  The order of parameters is perserved.
 
-    The ``get_data`` method requires a reference to ``api_data``. Given this
-    reference and a RequestMeta object the method attempts to find an entry
-    for the request if one exists.  The ``set_data`` method does much the
-    same operation but performs storage into the hash reference passed.
-    The method ``get_url_from_keys`` builds URLs from nested hash references
-    using the key list and ``build_key_tree`` recursively builds a tree
-    representation of all of the key paths in the hash reference.
-
-    .. _OrderedDict: http://docs.python.org/2/library/collections.html
+    Given a RequestMeta object the ``get_data`` method attempts to find an
+    entry for the request if one exists.  The ``set_data`` method stores
+    the response of a request along with its key signature and the refresh
+    time of its cohort (``utm_touched``).  A response stored before the
+    cohort was last refreshed is dropped rather than returned.  The method
+    ``get_url_from_keys`` builds URLs from key signatures and
+    ``get_cached_key_signatures`` lists the key signatures of all stored
+    responses.
+
+    Responses are JSON encoded by the worker process (``encode_response``)
+    and stored gzip compressed.  The rows of raw requests, collected on disk
+    in ``SpilledRows``, are encoded and spooled one at a time
+    (``iter_encode_response``).  ``get_encoded_data`` returns the stored
+    bytes so that they can be sent to clients that accept gzip without
+    decoding, ``get_data`` returns the decoded response.  The worker writes
+    its response to a spool file of the store (``spool_data``) and only the
+    path of the file is handed on, the response handler then moves the file
+    into place (``commit_data``).
+
+    Time series points are additionally cached one by one so that requests
+    over overlapping ranges can share work.  A point is keyed on the cohort,
+    the cohort refresh time, the metric parameters, the aggregator, and the
+    start and length of its interval.  ``get_series_points`` returns the
+    cached points for a set of interval starts and ``set_series_points``
+    stores newly computed points.
+
+    The metric rows of individual users are cached as well, so that a cohort
+    overlapping cohorts computed earlier (e.g. ``12&15~18`` after ``12``)
+    only computes the users that are new.  A row is keyed on the metric,
+    the metric parameters (project, namespace, window etc.) and the user.
+    Only rows over windows that have ended are cached.  ``get_user_rows``
+    returns the cached rows of a list of users and ``set_user_rows`` stores
+    newly computed rows.
+
+    ``get_user_groups`` maps the users of a request to the groups of a group
+    by dimension (registration day/week/month, cohort or project).
+
+    A response to a request for a list of aggregators (e.g.
+    ``aggregator=sum,mean``) is also stored under the request for each of its
+    aggregators, see ``split_combined_response``.
 
 """
 
@@ -47,23 +77,55 @@ __date__ = "2012-01-11"
 __license__ = "GPL (version 2 or later)"
 
 
-from re import search
+from re import search, split
+from datetime import datetime, timedelta
+from dateutil.parser import parse as date_parse
+from copy import deepcopy
 from collections import OrderedDict
 from hashlib import sha1
+from uuid import uuid4
 import cPickle
-import os
+import json
+import time
+import zlib
 
 from user_metrics.config import logging, settings
-from user_metrics.api.engine import COHORT_REGEX, parse_cohorts
+from user_metrics.api.engine import COHORT_REGEX, DEFAULT_INERVAL_LENGTH, \
+    parse_cohorts
 from user_metrics.api.engine.request_meta import REQUEST_META_QUERY_STR,\
-    REQUEST_META_BASE, build_request_obj
+    REQUEST_META_BASE, build_request_obj, get_agg_handles, get_agg_key, \
+    get_aggregator_type, metric_dict, ParameterMapping
+from user_metrics.metrics.user_metric import UserMetric
+from user_metrics.etl.aggregator import METRIC_AGG_METHOD_HEAD
+from user_metrics.etl.spill import SpilledRows
+from user_metrics.metrics.users import get_registration_dates
 from user_metrics.api import MetricsAPIError, query_mod
+from user_metrics.api.engine.response_store import response_store, \
+    point_store, row_store
 
 
 # This is used to separate key meta and key strings for hash table data
 # e.g. "metric <==> blocks"
 HASH_KEY_DELIMETER = "--"
 
+# Encodings of stored responses, JSON either as is or gzip compressed at
+# ``__response_compression_level__`` (0 disables compression)
+RESPONSE_ENCODING_JSON = 'json'
+RESPONSE_ENCODING_GZIP = 'json+gzip'
+RESPONSE_ENCODINGS = [RESPONSE_ENCODING_JSON, RESPONSE_ENCODING_GZIP]
+RESPONSE_COMPRESSION_LEVEL = int(getattr(settings,
+                                         '__response_compression_level__', 6))
+
+# zlib window bits selecting the gzip format
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# Request parameters only taken by time series requests
+TIME_SERIES_PARAMS = ['time_series', 'slice', 'rolling']
+
+# Request parameters that only bound the range of a time series, these are
+# excluded from the key of a single point
+POINT_RANGE_PARAMS = ['start', 'end']
+
 
 def get_users(cohort_expr):
     """ get users from cohort """
@@ -85,92 +147,379 @@ def get_users(cohort_expr):
     return users
 
 
-def get_data(url, hash_result=True):
+# Dimensions over which aggregator requests may be grouped
+GROUP_BY_REG_DAY = 'reg_day'
+GROUP_BY_REG_WEEK = 'reg_week'
+GROUP_BY_REG_MONTH = 'reg_month'
+GROUP_BY_COHORT = 'cohort'
+GROUP_BY_PROJECT = 'project'
+
+GROUP_BY_REG_FORMATS = {
+    GROUP_BY_REG_DAY: '%Y-%m-%d',
+    GROUP_BY_REG_WEEK: '%Y-%m-%d',
+    GROUP_BY_REG_MONTH: '%Y-%m',
+}
+
+
+def get_user_groups(group_by, request_meta, users):
+    """
+        Maps each user to the list of groups it belongs to along the
+        ``group_by`` dimension:
+
+            * reg_day, reg_week, reg_month - the day, week (labelled by its
+            Monday) or month of the user registration
+            * cohort - the cohorts of a cohort expression that include the
+            user
+            * project - the projects of those cohorts
+    """
+    groups = dict()
+    if group_by in GROUP_BY_REG_FORMATS:
+        for row in get_registration_dates(users, request_meta.project):
+            try:
+                reg = date_parse(str(row[1]))
+            except (ValueError, TypeError):
+                continue
+            if group_by == GROUP_BY_REG_WEEK:
+                reg -= timedelta(days=reg.weekday())
+            groups[str(row[0])] = [reg.strftime(
+                GROUP_BY_REG_FORMATS[group_by])]
+
+    elif group_by in [GROUP_BY_COHORT, GROUP_BY_PROJECT]:
+        cohort_expr = request_meta.cohort_expr
+        if not search(COHORT_REGEX, cohort_expr):
+            label = cohort_expr if group_by == GROUP_BY_COHORT else \
+                request_meta.project
+            return dict((str(user), [label]) for user in users)
+
+        user_set = set(str(user) for user in users)
+        for cid in split(r'[&~]', cohort_expr):
+            if group_by == GROUP_BY_COHORT:
+                label = cid
+            else:
+                label = query_mod.get_cohort_project_by_id(cid)
+            for user in query_mod.get_cohort_users(cid):
+                user = str(user)
+                if user in user_set:
+                    user_groups = groups.setdefault(user, list())
+                    if label not in user_groups:
+                        user_groups.append(label)
+    else:
+        raise MetricsAPIError(__name__ + ' :: Bad group by dimension "{0}".'.
+                              format(str(group_by)))
+    return groups
+
+
+def encode_response(results):
+    """
+        Encodes the results of a request as JSON.  Numpy values are
+        converted to native types and other non-native values to strings.
+    """
+    return json.dumps(results, default=_json_default, separators=(',', ':'))
+
+
+def iter_encode_response(results):
+    """
+        Generator over the chunks of the JSON encoding of ``results``, as
+        ``encode_response``.  If the data of the results are ``SpilledRows``
+        they are encoded one row at a time as an object of the remaining
+        columns of the rows keyed on their first column.
+    """
+    rows = results.get('data')
+    if not isinstance(rows, SpilledRows):
+        yield encode_response(results)
+        return
+
+    # Encode the rest of the results around a placeholder for the rows
+    marker = json.dumps(uuid4().hex)
+    head = OrderedDict(results)
+    head['data'] = json.loads(marker)
+    prefix, suffix = encode_response(head).split(marker, 1)
+
+    yield prefix + '{'
+    separator = ''
+    for row in rows:
+        yield separator + json.dumps(str(row[0])) + ':' + \
+            encode_response(list(row[1:]))
+        separator = ','
+    yield '}' + suffix
+
+
+def _json_default(obj):
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    return str(obj)
+
+
+def decode_response(data):
+    """ Decodes a response encoded by ``encode_response`` """
+    return json.loads(data, object_pairs_hook=OrderedDict)
+
+
+def decompress_response(payload, meta):
     """
-        Extract data from the global hash given a request object.  If an item
-        is successfully recovered data is returned
+        Returns the JSON encoded response given the payload and the metadata
+        of a stored response
     """
+    if meta.get('encoding') == RESPONSE_ENCODING_GZIP:
+        return zlib.decompress(payload, GZIP_WBITS)
+    return payload
+
 
-    request_obj = build_request_obj(url)
-    hash_table_ref = read_pickle_data()
+def get_encoded_data(url, request_obj=None):
+    """
+        Extract the stored response of a request url.  Returns the payload,
+        JSON possibly compressed (see ``decompress_response``), and the
+        metadata of the response or None if there is no valid response.  The
+        RequestMeta object of the url is built unless it is passed.
+    """
 
-    # Traverse the hash key structure to find data
-    # @TODO rather than iterate through REQUEST_META_BASE &
-    #   REQUEST_META_QUERY_STR look only at existing attributes
+    if request_obj is None:
+        request_obj = build_request_obj(url)
 
     logging.debug(__name__ + " - Attempting to pull data for request " \
                              "COHORT {0}, METRIC {1}".
                   format(request_obj.cohort_expr, request_obj.metric))
 
-    key_sig = build_key_signature(request_obj, hash_result=hash_result)
-    item = find_item(hash_table_ref, key_sig)
+    key_sig = build_key_signature(request_obj, hash_result=True)
+    if not key_sig:
+        return None
+    item = response_store.get(key_sig)
+    if not item:
+        return None
+    meta, payload = item
 
-    if item:
-        # item[0] will be a stringified structure that
-        # is initialized, see set_data.
-        try:
-            return eval(item[0])
-        except SyntaxError:
-            logging.error(__name__ + ' :: Failed to retrieve {0}'.
-                          format(key_sig))
-            return None
-    else:
+    # Responses computed before the cohort was refreshed are stale
+    if meta.get('refresh') != request_obj.cohort_gen_timestamp:
+        logging.info(__name__ + ' :: Dropping stale response for {0}'.
+                     format(key_sig))
+        response_store.remove(key_sig)
+        return None
+
+    if meta.get('encoding') not in RESPONSE_ENCODINGS:
+        logging.error(__name__ + ' :: Unknown encoding of {0}'.
+                      format(key_sig))
+        return None
+
+    logging.info(__name__ + ' :: Retrieved {0} - {1} bytes ({2} stored)'.
+                 format(key_sig, meta.get('size'), len(payload)))
+    return payload, meta
+
+
+def get_data(url, request_obj=None):
+    """
+        Extract data from the response store given a request url.  If an
+        item is successfully recovered the decoded data is returned
+    """
+    item = get_encoded_data(url, request_obj)
+    if not item:
         return None
 
+    time_start = time.time()
+    try:
+        data = decode_response(decompress_response(*item))
+    except (ValueError, zlib.error) as e:
+        logging.error(__name__ + ' :: Failed to decode {0}: {1}'.
+                      format(url, str(e)))
+        return None
+    logging.info(__name__ + ' :: Decoded {0} in {1:.4f}s'.
+                 format(url, time.time() - time_start))
+    return data
 
-def set_data(data, request_meta, hash_result=True):
+
+def set_data(data, request_meta):
     """
-        Given request meta-data and a dataset create a key path in the global
-        hash to store the data
+        Given request meta-data and a dataset, encoded by
+        ``encode_response``, store the data under the key signature of the
+        request
     """
-    hash_table_ref = read_pickle_data()
+    path = spool_data(data, request_meta)
+    if path:
+        response_store.commit(
+            build_key_signature(request_meta, hash_result=True), path)
+
 
-    key_sig = build_key_signature(request_meta, hash_result=hash_result)
-    logging.debug(__name__ + " :: Adding data to hash @ key signature = {0}".
+def spool_data(data, request_meta):
+    """
+        Writes a dataset, encoded by ``encode_response``, to a spool file of
+        the response store without storing it.  Returns the path of the
+        file, see ``commit_data``, or an empty string if the request has no
+        key signature.  The dataset may also be an iterable of chunks (see
+        ``iter_encode_response``), these are compressed into the spool file
+        as they are encoded.
+    """
+    key_sig = build_key_signature(request_meta, hash_result=True)
+    if not key_sig:
+        return ''
+    logging.debug(__name__ + " :: Spooling data @ key signature = {0}".
                   format(str(key_sig)))
-    if hash_result:
-        key_sig_full = build_key_signature(request_meta, hash_result=False)
-        hash_table_ref[key_sig] = (data, key_sig_full)
-    else:
-        last_item = key_sig[-1]
-        for item in key_sig:
-            if item == last_item:
-                hash_table_ref[last_item] = data
-            else:
-                hash_table_ref[item] = OrderedDict()
-            hash_table_ref = hash_table_ref[item]
-    write_pickle_data(hash_table_ref)
 
+    chunks = [data] if isinstance(data, basestring) else data
+    compressor = zlib.compressobj(RESPONSE_COMPRESSION_LEVEL, zlib.DEFLATED,
+                                  GZIP_WBITS) if \
+        RESPONSE_COMPRESSION_LEVEL else None
+    encoding = RESPONSE_ENCODING_GZIP if compressor else \
+        RESPONSE_ENCODING_JSON
+
+    size = [0]
+
+    def payload():
+        for chunk in chunks:
+            size[0] += len(chunk)
+            yield compressor.compress(chunk) if compressor else chunk
+        if compressor:
+            yield compressor.flush()
+
+    return response_store.stage(key_sig, payload(),
+                                key_sig=build_key_signature(request_meta),
+                                refresh=request_meta.cohort_gen_timestamp,
+                                encoding=encoding, size=lambda: size[0])
 
-def find_item(hash_table_ref, key_sig):
+
+def commit_data(path, request_meta):
+    """
+        Stores the dataset spooled to path by ``spool_data`` under the key
+        signature of the request.  The response to a request for a list of
+        aggregators is also stored for each of them.
     """
-        For each key in the key signature add a nested key to the hash.
+    key_sig = build_key_signature(request_meta, hash_result=True)
+    logging.debug(__name__ + " :: Adding data to store @ key signature = {0}".
+                  format(str(key_sig)))
+    response_store.commit(key_sig, path)
 
-        Parameters
-        ~~~~~~~~~~
+    if len(get_agg_handles(request_meta.aggregator)) > 1:
+        item = response_store.get(key_sig, touch=False)
+        if item:
+            data = decompress_response(item[1], item[0])
+            for single_data, single_meta in split_combined_response(
+                    data, request_meta):
+                set_data(single_data, single_meta)
+
+
+def get_cached_key_signatures():
     """
-    if not hasattr(key_sig, '__iter___'):
-        key_sig = [key_sig]
+        Generator over the key signatures of all of the stored responses
+    """
+    for key in response_store.keys():
+        item = response_store.get(key, touch=False)
+        if item:
+            yield item[0].get('key_sig')
 
-    last_item = key_sig[len(key_sig) - 1]
-    for key in key_sig:
-        if key != last_item:
-            if hasattr(hash_table_ref, 'keys') and key in hash_table_ref:
-                hash_table_ref = hash_table_ref[key]
-            else:
-                # Item not found
-                return None
+
+def split_combined_response(data, request_meta):
+    """
+        Splits the response to a request for a list of aggregators into the
+        responses for each single aggregator, so that those requests are
+        served from the cache.  Returns a list of ``(data, request_meta)``
+        pairs, empty if the request was for at most one aggregator.
+    """
+    handles = get_agg_handles(request_meta.aggregator) if \
+        request_meta.aggregator else []
+    if len(handles) < 2:
+        return []
+
+    try:
+        response = decode_response(data)
+        header = response['header']
+    except (ValueError, TypeError, KeyError):
+        # Failed requests are not split
+        return []
+
+    # Nor are estimates from a sample
+    if 'sample' in response:
+        return []
+
+    # Time series headers lead with the timestamp
+    lead = 1 if header and header[0] == 'timestamp' else 0
+
+    responses = list()
+    offset = 0
+    for handle in handles:
+        try:
+            agg_key = get_agg_key(handle, request_meta.metric)
+            width = len(getattr(get_aggregator_type(agg_key),
+                                METRIC_AGG_METHOD_HEAD))
+        except MetricsAPIError:
+            return []
+
+        single = deepcopy(response)
+        single['aggregator'] = handle
+        single['header'] = header[:lead] + \
+            header[lead + offset: lead + offset + width]
+        if hasattr(single['data'], 'keys'):
+            for key in single['data']:
+                single['data'][key] = \
+                    response['data'][key][offset: offset + width]
         else:
-            if hasattr(hash_table_ref, 'keys') and \
-                key in hash_table_ref:
-                    return hash_table_ref[key]
-            # Item not found
-            return None
+            single['data'] = response['data'][offset: offset + width]
+        offset += width
+
+        single_meta = deepcopy(request_meta)
+        single_meta.aggregator = handle
+        responses.append((encode_response(single), single_meta))
+    return responses
+
+
+def _metric_defaults(metric_handle):
+    """ Default values of the parameters of a metric by parameter name """
+    metric_class = metric_dict.get(metric_handle)
+    if not metric_class:
+        return dict()
+    param_types = dict(UserMetric._param_types['init'])
+    param_types.update(metric_class._param_types['init'])
+    return dict((name, param[2]) for name, param in param_types.iteritems()
+                if len(param) > 2)
+
+
+def _is_default(value, default):
+    """ Whether a request parameter value is the default value """
+    if isinstance(default, list):
+        return str(value).strip('[]').replace(' ', '') == \
+            ','.join(str(item) for item in default)
+    try:
+        return float(value) == float(default)
+    except (TypeError, ValueError):
+        return str(value) == str(default)
+
+
+def canonical_request(request_meta):
+    """
+        Returns a copy of a RequestMeta object without the parameters that
+        don't affect its response: parameters the metric doesn't take,
+        parameters set to their default value and time series parameters of
+        requests that aren't time series.  Equivalent requests have the same
+        canonical request, and key signature.
+    """
+    canonical = deepcopy(request_meta)
+    metric_params = ParameterMapping.QUERY_PARAMS_BY_METRIC.get(
+        getattr(request_meta, 'metric', None))
+    if metric_params is None:
+        return canonical
+
+    metric_vars = dict((m.query_var, m.metric_var) for m in metric_params)
+    defaults = _metric_defaults(request_meta.metric)
+    defaults['slice'] = DEFAULT_INERVAL_LENGTH
+    is_time_series = all(getattr(request_meta, name, None) for name in
+                         ['aggregator', 'time_series', 'group', 'slice',
+                          'start', 'end'])
+
+    for name in REQUEST_META_QUERY_STR:
+        value = getattr(canonical, name, None)
+        if value is None:
+            continue
+        if name not in metric_vars or \
+                (not is_time_series and name in TIME_SERIES_PARAMS):
+            setattr(canonical, name, None)
+        elif metric_vars[name] in defaults and \
+                _is_default(value, defaults[metric_vars[name]]):
+            setattr(canonical, name, None)
+    return canonical
 
 
 def build_key_signature(request_meta, hash_result=False):
     """
-        Given a RequestMeta object contruct a hashkey.
+        Given a RequestMeta object contruct a hashkey.  The key is built from
+        the canonical request (see ``canonical_request``) so that equivalent
+        requests share a key.
 
         Parameters
         ~~~~~~~~~~
@@ -178,6 +527,7 @@ def build_key_signature(request_meta, hash_result=False):
             request_meta : RequestMeta
                 Stores request data.
     """
+    request_meta = canonical_request(request_meta)
     key_sig = list()
 
     # Build the key signature -- These keys must exist
@@ -203,6 +553,135 @@ def build_key_signature(request_meta, hash_result=False):
         return key_sig
 
 
+def get_request_key(url, request_meta=None):
+    """
+        Returns the key of a request url in the broker targets, the hashed
+        key signature of its RequestMeta object so that equivalent requests
+        share a key.  The SHA1 of the url is used if the request object
+        isn't passed or has no key signature.
+    """
+    if request_meta:
+        key = build_key_signature(request_meta, hash_result=True)
+        if key:
+            return key
+    return sha1(url.encode('utf-8')).hexdigest()
+
+
+def build_point_key_signature(request_meta, interval_start):
+    """
+        Given a RequestMeta object for a time series and the start of one of
+        its intervals construct a hashkey for that single point.  Returns an
+        empty string if the cohort refresh time is unknown, such points are
+        not cached.
+
+        Parameters
+        ~~~~~~~~~~
+
+            request_meta : RequestMeta
+                Stores request data.
+
+            interval_start : str
+                Start timestamp of the interval.
+    """
+    if not request_meta.cohort_gen_timestamp:
+        return ''
+
+    key_sig = [
+        'cohort_expr' + HASH_KEY_DELIMETER + str(request_meta.cohort_expr),
+        'cohort_gen_timestamp' + HASH_KEY_DELIMETER +
+        str(request_meta.cohort_gen_timestamp),
+        'metric' + HASH_KEY_DELIMETER + str(request_meta.metric),
+    ]
+    for key_name in REQUEST_META_QUERY_STR:
+        if key_name in POINT_RANGE_PARAMS:
+            continue
+        key = getattr(request_meta, key_name, None)
+        if key:
+            key_sig.append(key_name + HASH_KEY_DELIMETER + str(key))
+    key_sig.append('interval_start' + HASH_KEY_DELIMETER +
+                   str(interval_start))
+
+    return sha1(str(key_sig).encode('utf-8')).hexdigest()
+
+
+def get_series_points(request_meta, interval_starts):
+    """
+        Retrieve any cached time series points for the interval starts
+        given.  Returns a dict of points keyed on interval start.
+    """
+    points = dict()
+    for interval_start in interval_starts:
+        key_sig = build_point_key_signature(request_meta, interval_start)
+        item = point_store.get(key_sig) if key_sig else None
+        if item:
+            points[interval_start] = cPickle.loads(item[1])
+    return points
+
+
+def set_series_points(request_meta, points):
+    """
+        Store time series points.  Each point is a list whose first element
+        is the start of its interval.
+    """
+    if not points:
+        return
+
+    for point in points:
+        key_sig = build_point_key_signature(request_meta, point[0])
+        if key_sig:
+            point_store.put(key_sig, cPickle.dumps(point,
+                                                   cPickle.HIGHEST_PROTOCOL))
+
+
+def build_row_key_signature(metric_obj, user):
+    """
+        Given a metric object construct a hashkey for the row of a single
+        user.  The key covers the metric class and all of its parameters.
+    """
+    key_sig = ['metric' + HASH_KEY_DELIMETER + metric_obj.__class__.__name__]
+    for key_name in sorted(metric_obj._param_types['init']):
+        key_sig.append(key_name + HASH_KEY_DELIMETER +
+                       str(getattr(metric_obj, key_name, None)))
+    key_sig.append('user' + HASH_KEY_DELIMETER + str(user))
+
+    return sha1(str(key_sig).encode('utf-8')).hexdigest()
+
+
+def get_user_rows(metric_obj, users):
+    """
+        Retrieve any cached metric rows of the users given.  Returns a dict
+        of rows keyed on user ID.
+    """
+    rows = dict()
+    for user in users:
+        item = row_store.get(build_row_key_signature(metric_obj, user))
+        if item:
+            rows[str(user)] = cPickle.loads(item[1])
+    return rows
+
+
+def set_user_rows(metric_obj, rows):
+    """
+        Store the metric rows of users, lists whose first element is the user
+        ID.  Rows are only stored if every user window has ended, i.e. ``t``
+        hours after the end of the metric period.
+    """
+    if not rows:
+        return
+
+    try:
+        window_end = date_parse(str(metric_obj.datetime_end)) + \
+            timedelta(hours=int(metric_obj.t))
+    except (TypeError, ValueError):
+        return
+    if window_end > datetime.now():
+        return
+
+    for row in rows:
+        row_store.put(build_row_key_signature(metric_obj, row[0]),
+                      cPickle.dumps(list(row), cPickle.HIGHEST_PROTOCOL))
+
+
 def get_url_from_keys(keys, path_root):
     """ Compose a url from a set of keys """
     query_str = ''
@@ -220,21 +699,3 @@ def get_url_from_keys(keys, path_root):
     else:
         url = path_root
     return url
-
-
-def read_pickle_data():
-    try:
-        with open(os.path.join(settings.__data_file_dir__,
-                  'api_data.pkl'), 'rb') as pkl_file:
-            return cPickle.load(pkl_file)
-    except IOError:
-        with open(os.path.join(settings.__data_file_dir__,
-                  'api_data.pkl'), 'wb') as pkl_file:
-            data = OrderedDict()
-            cPickle.dump(data, pkl_file)
-            return data
-
-def write_pickle_data(obj):
-    with open(os.path.join(settings.__data_file_dir__,
-              'api_data.pkl'), 'wb') as pkl_file:
-        cPickle.dump(obj, pkl_file)
\ No newline at end of file
@@ -0,0 +1,110 @@
+"""
+    This module implements the reporting of the progress of running jobs.
+    The worker of a job records its progress on the progress broker target,
+    under the key of its request, and the views read it from there.
+
+    Progress
+    ~~~~~~~~
+
+    A job counts the users of its cohort and, for time series, the
+    intervals of the series, along with how many of each are done, and the
+    number of queries issued by the worker and the processes it forks::
+
+        >>> progress = JobProgress(key)
+        >>> progress.update(users_total=len(users))
+        >>> progress.advance('intervals_done')
+
+    Updates are written at most every ``REPORT_PERIOD`` seconds, unless
+    forced.  The job controller removes the progress of a job once it ends.
+
+    Status
+    ~~~~~~
+
+    ``get_job_status`` returns the progress of a job along with its percent
+    complete, measured in intervals for time series and in users otherwise,
+    and an estimate in seconds of the time remaining at the throughput
+    observed so far.
+"""
+
+__license__ = "GPL (version 2 or later)"
+
+import time
+
+from user_metrics.api import umapi_broker_context, PROGRESS_BROKER_TARGET
+from user_metrics.etl.data_loader import get_query_count, reset_query_count
+
+# Minimum time in seconds between two writes of the progress of a job
+REPORT_PERIOD = 1.0
+
+
+class JobProgress(object):
+    """
+    Progress of a running job, see the module documentation.  Creating the
+    object starts a new count of the queries of the process.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        now = time.time()
+        self.state = {
+            'users_done': 0,
+            'users_total': 0,
+            'intervals_done': 0,
+            'intervals_total': 0,
+            'queries': 0,
+            'started': now,
+            'updated': now,
+        }
+        self._last_report = now
+
+        reset_query_count()
+        umapi_broker_context.remove(PROGRESS_BROKER_TARGET, key)
+        umapi_broker_context.add(PROGRESS_BROKER_TARGET, key,
+                                 dict(self.state))
+
+    def update(self, force=False, **counts):
+        """ Sets the counts passed as keyword arguments """
+        self.state.update(counts)
+        if force or time.time() - self._last_report >= REPORT_PERIOD:
+            self.report()
+
+    def advance(self, name, count=1):
+        """ Increments the count ``name`` """
+        self.update(**{name: self.state[name] + count})
+
+    def report(self):
+        """ Writes the progress to the progress broker target """
+        self._last_report = time.time()
+        self.state['queries'] = get_query_count()
+        self.state['updated'] = self._last_report
+        umapi_broker_context.update(PROGRESS_BROKER_TARGET, self.key,
+                                    dict(self.state))
+
+
+def job_status(state, now=None):
+    """
+    Returns the progress ``state`` of a job with its ``percent_complete``,
+    ``elapsed`` time and ``eta``, the seconds remaining or None while
+    nothing is done.
+    """
+    now = now if now is not None else time.time()
+    if state.get('intervals_total'):
+        done = float(state['intervals_done']) / state['intervals_total']
+    elif state.get('users_total'):
+        done = float(state['users_done']) / state['users_total']
+    else:
+        done = 0.0
+    done = min(done, 1.0)
+
+    elapsed = max(now - state['started'], 0.0)
+    status = dict(state)
+    status['percent_complete'] = round(100.0 * done, 1)
+    status['elapsed'] = round(elapsed, 1)
+    status['eta'] = round(elapsed * (1.0 - done) / done, 1) if done else None
+    return status
+
+
+def get_job_status(key):
+    """ Returns the status of the running job of a request, or None """
+    state = umapi_broker_context.get(PROGRESS_BROKER_TARGET, key)
+    return job_status(state) if state else None
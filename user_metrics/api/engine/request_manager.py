@@ -46,8 +46,8 @@
         metric_param := -, optional metric parameters
         data := list(tuple), set of data points
 
-    Request data is mapped to a query via metric objects and hashed in the
-    dictionary `api_data`.
+    Request data is mapped to a query via metric objects and responses are
+    cached in the response store (see the response_store module).
 
     Request Flow Management
     ^^^^^^^^^^^^^^^^^^^^^^^
@@ -68,6 +68,9 @@
       interval length.  Further an aggregator must be provided which operates
       on each time interval.
 
+    Raw and aggregate requests computing per-user rows in this process reuse
+    the rows of users cached by earlier requests (``process_users``).
+
     Also defined are metric types for which requests may be made with
     ``metric_dict``, and the types of aggregators that may be called on metrics
     ``aggregator_dict``, and also the meta data around how many threads may be
@@ -84,39 +87,53 @@ __license__ = "GPL (version 2 or later)"
 from user_metrics.config import logging, settings
 from user_metrics.api import MetricsAPIError, error_codes, query_mod, \
     REQUEST_BROKER_TARGET, umapi_broker_context,\
-    RESPONSE_BROKER_TARGET, PROCESS_BROKER_TARGET
+    RESPONSE_BROKER_TARGET, PROCESS_BROKER_TARGET, REQUESTER_BROKER_TARGET, \
+    PROGRESS_BROKER_TARGET, STREAM_END_KEY, get_stream_target
 from user_metrics.api.engine import pack_response_for_broker, \
-    RESQUEST_TIMEOUT, MAX_BLOCK_SIZE, MAX_CONCURRENT_JOBS
-from user_metrics.api.engine.data import get_users
-from user_metrics.api.engine.request_meta import build_request_obj
-from user_metrics.metrics.users import MediaWikiUser
-from user_metrics.metrics.user_metric import UserMetricError
-from user_metrics.etl.aggregator import aggregator as agg_engine
-
-from multiprocessing import Process, Queue
-from collections import namedtuple
+    RESQUEST_TIMEOUT
+from user_metrics.api.engine.scheduler import JobScheduler
+from user_metrics.api.engine.data import get_users, get_user_groups, \
+    get_series_points, set_series_points, iter_encode_response, \
+    spool_data, get_request_key, get_user_rows, set_user_rows
+from user_metrics.api.engine.request_meta import build_request_obj, \
+    get_request_type
+from user_metrics.api.engine.progress import JobProgress
+from user_metrics.metrics.users import MediaWikiUser, \
+    USER_METRIC_PERIOD_TYPE
+from user_metrics.metrics.user_metric import UserMetricError, \
+    ColumnarResults
+from user_metrics.etl.aggregator import aggregator as agg_engine, \
+    get_agg_state, get_agg_pushdown, group_aggregate, METRIC_AGG_METHOD_HEAD
+from user_metrics.etl.spill import SpilledRows
+
+from multiprocessing import Process, Pipe
+from collections import namedtuple, OrderedDict
 from os import getpid
-from sys import getsizeof
 import time
-from hashlib import sha1
 
 # API JOB HANDLER
 # ###############
 
-# Defines the job item type used to temporarily store job progress
-job_item_type = namedtuple('JobItem', 'id process request queue')
+# Defines the job item type used to temporarily store job progress, the
+# outcome of a job is read from its ``queue``, the read end of a pipe.  The
+# ``key`` of the job is that of its request in the broker targets.
+job_item_type = namedtuple('JobItem', 'id process request key queue')
+
+# Seconds the stream target of a finished job is kept for clients that have
+# not read it to the end, see ``stream_output``
+STREAM_RETENTION = 300.0
 
 
 def job_control():
     """
         Controls the execution of user metrics requests
 
-        Parameters
-        ~~~~~~~~~~
-
-        request_queue : multiprocessing.Queue
-           Queues incoming API requests.
-
+        The controller sleeps until a request is queued on the request
+        target (see ``Broker.notify``), a running job writes to its pipe or
+        ``RESQUEST_TIMEOUT`` elapses.  On each wake-up the responses of
+        finished jobs are moved to the response target and the queued
+        requests chosen by the job scheduler (see the scheduler module) are
+        started.
     """
 
     # Store executed and pending jobs respectively
@@ -125,8 +142,12 @@ def job_control():
     # Global job ID number
     job_id = 0
 
-    # Tallies the number of concurrently running jobs
-    concurrent_jobs = 0
+    # Chooses the queued requests to start
+    scheduler = JobScheduler()
+
+    # Finish times of jobs by request key, their stream targets are removed
+    # after ``STREAM_RETENTION`` seconds
+    ended_streams = OrderedDict()
 
     log_name = '{0} :: {1}'.format(__name__, job_control.__name__)
 
@@ -134,88 +155,109 @@ def job_control():
 
     while 1:
 
-        time.sleep(RESQUEST_TIMEOUT)
-
-        # Request Queue Processing
-        # ------------------------
-
-        # logging.debug(log_name + ' :: POLLING REQUESTS...')
         logging.debug(log_name + ' :: JOB QUEUE - {0}'.format(str(job_queue)))
-        req_item = None
-
-        # Only process if there are fewer than the maximum number of concurrent
-        # jobs
-        if concurrent_jobs < MAX_CONCURRENT_JOBS:
-
-            # Pop from request target
-            req_item = umapi_broker_context.pop(REQUEST_BROKER_TARGET)
-
-            # Push to process target
-            if req_item:
-                url_hash = sha1(req_item.encode('utf-8')).hexdigest()
-                umapi_broker_context.add(PROCESS_BROKER_TARGET, url_hash,
-                                         req_item)
-
-                logging.debug(log_name + ' :: PULLING item from request queue -> '
-                                         '\n\t{0}'
-                              .format(req_item))
 
         # Process complete jobs
         # ---------------------
 
-        if concurrent_jobs:
-            for job_item in job_queue:
-
-                if not job_item.queue.empty():
-
-                    logging.info(log_name + ' :: READING RESPONSE - {0}'.
-                        format(job_item.request))
-
-                    # Pull data off of the queue and add it to response queue
-                    data = ''
-                    while not job_item.queue.empty():
-                        data += job_item.queue.get(True)
-
-                    # Remove from process target
-                    url_hash = sha1(job_item.request.encode('utf-8')).hexdigest()
-                    try:
-                        umapi_broker_context.remove(PROCESS_BROKER_TARGET,
-                                                    url_hash)
-                    except Exception as e:
-                        logging.error(log_name + ' :: Could not process '
-                                                 '{0} from {1}  -- {2}'.
-                            format(job_item.request,
-                                   PROCESS_BROKER_TARGET,
-                                   e.message))
-
-                    # Add to response target
-                    umapi_broker_context.add(RESPONSE_BROKER_TARGET, url_hash,
-                                             pack_response_for_broker(
-                                                 job_item.request, data))
-
-                    del job_queue[job_queue.index(job_item)]
-                    concurrent_jobs -= 1
-                    logging.debug(log_name + ' :: RUN -> RESPONSE - Job ID {0}'
-                                             '\n\tConcurrent jobs = {1}'
-                                  .format(str(job_item.id), concurrent_jobs))
-
-        # Process request
-        # ---------------
-
-        if req_item:
-            req_q = Queue()
-            proc = Process(target=process_metrics, args=(req_q, req_item))
+        for job_item in job_queue[:]:
+
+            # A job sends a single ``(success, value)`` pair, the spool file
+            # holding its response or an error message
+            if not job_item.queue.poll():
+                continue
+            try:
+                success, value = job_item.queue.recv()
+            except EOFError:
+                success, value = False, 'Job exited without a response.'
+
+            logging.info(log_name + ' :: READING RESPONSE - {0}'.
+                format(job_item.request))
+            job_item.queue.close()
+            job_item.process.join()
+
+            url_hash = job_item.key
+            scheduler.finish(url_hash)
+
+            # Remove from process target
+            try:
+                umapi_broker_context.remove(PROCESS_BROKER_TARGET,
+                                            url_hash)
+                umapi_broker_context.remove(PROGRESS_BROKER_TARGET,
+                                            url_hash)
+            except Exception as e:
+                logging.error(log_name + ' :: Could not process '
+                                         '{0} from {1}  -- {2}'.
+                    format(job_item.request,
+                           PROCESS_BROKER_TARGET,
+                           e.message))
+
+            # Add to response target
+            if success:
+                umapi_broker_context.add(RESPONSE_BROKER_TARGET, url_hash,
+                                         pack_response_for_broker(
+                                             job_item.request, value))
+                umapi_broker_context.notify(RESPONSE_BROKER_TARGET)
+            else:
+                logging.error(log_name + ' :: Request failed {0} -- {1}'.
+                              format(job_item.request, value))
+
+            ended_streams.pop(url_hash, None)
+            ended_streams[url_hash] = time.time()
+
+            job_queue.remove(job_item)
+            logging.debug(log_name + ' :: RUN -> RESPONSE - Job ID {0}'
+                                     '\n\tConcurrent jobs = {1}'
+                          .format(str(job_item.id), len(job_queue)))
+
+        while ended_streams and time.time() - \
+                next(ended_streams.itervalues()) > STREAM_RETENTION:
+            key, _ = ended_streams.popitem(last=False)
+            umapi_broker_context.drop(get_stream_target(key))
+
+        # Request Queue Processing
+        # ------------------------
+
+        # Start the requests chosen by the scheduler, moving each from the
+        # request target to the process target
+        requesters = dict(item.items()[0] for item in
+                          umapi_broker_context.get_all_items(
+                              REQUESTER_BROKER_TARGET))
+        scheduler.update(
+            umapi_broker_context.get_all_items(REQUEST_BROKER_TARGET),
+            requesters)
+
+        for key in scheduler.select():
+            req_item = umapi_broker_context.claim(REQUEST_BROKER_TARGET,
+                                                  PROCESS_BROKER_TARGET,
+                                                  key=key)
+            if key in requesters:
+                umapi_broker_context.remove(REQUESTER_BROKER_TARGET, key)
+            if not req_item:
+                scheduler.discard(key)
+                continue
+            ended_streams.pop(key, None)
+
+            logging.debug(log_name + ' :: PULLING item from request queue -> '
+                                     '\n\t{0}'
+                          .format(req_item))
+
+            req_q, res_q = Pipe(duplex=False)
+            proc = Process(target=process_metrics, args=(res_q, req_item))
             proc.start()
+            res_q.close()
 
-            job_item = job_item_type(job_id, proc, req_item, req_q)
+            job_item = job_item_type(job_id, proc, req_item, key, req_q)
             job_queue.append(job_item)
 
-            concurrent_jobs += 1
             job_id += 1
 
             logging.debug(log_name + ' :: WAIT -> RUN - Job ID {0}'
                                      '\n\tConcurrent jobs = {1}, REQ = {2}'
-                          .format(str(job_id), concurrent_jobs, req_item))
+                          .format(str(job_id), len(job_queue), req_item))
+
+        umapi_broker_context.wait([REQUEST_BROKER_TARGET], RESQUEST_TIMEOUT,
+                                  fds=[j.queue for j in job_queue])
 
     logging.debug('{0} - FINISHING.'.format(log_name))
 
@@ -243,63 +285,104 @@ def process_metrics(p, request_url):
         request_obj = build_request_obj(request_url)
     except MetricsAPIError as e:
         # TODO - flag job as failed
+        p.send((False, e.message))
         return
 
-    # obtain user list - handle the case where a lone user ID is passed
-    # !! The username should already be validated
-    if request_obj.is_user:
-        uid = MediaWikiUser.is_user_name(request_obj.cohort_expr,
-                                         request_obj.project)
-        if uid:
-            valid = True
-            users = [uid]
-        else:
-            valid = False
-            err_msg = error_codes[3]
+    # The response is stored under the request as received, before any of
+    # its parameters are filled in below
+    response_meta = deepcopy(request_obj)
+    request_key = get_request_key(request_url, response_meta)
 
-    # The "all" user group.  All users within a time period.
-    elif request_obj.cohort_expr == 'all':
-        users = MediaWikiUser(query_type=1)
+    progress = JobProgress(request_key)
 
-        try:
-            users = [u for u in users.get_users(
-                request_obj.start, request_obj.end,
-                project=request_obj.project)]
-            valid = True
-        except Exception:
-            valid = False
-            err_msg = error_codes[5]
+    # Points of time series are streamed to the broker as they complete, on
+    # the target of the request key shared by equivalent requests.  The
+    # stream is always ended, its clients or the job controller remove it.
+    stream_target = None
+    stream_end = {'status': 'failed', 'error': 'Request failed.'}
+    if get_request_type(request_obj) == request_types.time_series:
+        stream_target = get_stream_target(request_key)
+        umapi_broker_context.clear(stream_target)
 
-    # "TYPICAL" COHORT PROCESSING
-    else:
-        users = get_users(request_obj.cohort_expr)
+    def stream_point(timestamp, values, in_order):
+        values = [v.item() if hasattr(v, 'item') else v for v in values]
+        umapi_broker_context.add(stream_target, timestamp,
+                                 {'data': values, 'in_order': in_order})
 
-        # Default project is what is stored in usertags_meta
-        project = query_mod.get_cohort_project_by_meta(
-            request_obj.cohort_expr)
-        if project:
-            request_obj.project = project
-        logging.debug(log_name + ' :: Using default project from '
-                                 'usertags_meta {0}.'.format(project))
+    try:
+        # obtain user list - handle the case where a lone user ID is passed
+        # !! The username should already be validated
+        if request_obj.is_user:
+            uid = MediaWikiUser.is_user_name(request_obj.cohort_expr,
+                                             request_obj.project)
+            if uid:
+                valid = True
+                users = [uid]
+            else:
+                valid = False
+                err_msg = error_codes[3]
+
+        # The "all" user group.  All users within a time period.
+        elif request_obj.cohort_expr == 'all':
+            users = MediaWikiUser(query_type=1)
+
+            try:
+                users = [u for u in users.get_users(
+                    request_obj.start, request_obj.end,
+                    project=request_obj.project)]
+                valid = True
+            except Exception:
+                valid = False
+                err_msg = error_codes[5]
+
+        # "TYPICAL" COHORT PROCESSING
+        else:
+            users = get_users(request_obj.cohort_expr)
 
-        valid = True
-        err_msg = ''
+            # Default project is what is stored in usertags_meta
+            project = query_mod.get_cohort_project_by_meta(
+                request_obj.cohort_expr)
+            if project:
+                request_obj.project = project
+            logging.debug(log_name + ' :: Using default project from '
+                                     'usertags_meta {0}.'.format(project))
 
-    if valid:
-        # process request
-        results = process_data_request(request_obj, users)
-        results = str(results)
-        response_size = getsizeof(results, None)
-
-        if response_size > MAX_BLOCK_SIZE:
-            index = 0
-
-            # Dump the data in pieces - block until it is picked up
-            while index < response_size:
-                p.put(results[index:index+MAX_BLOCK_SIZE], block=True)
-                index += MAX_BLOCK_SIZE
+            valid = True
+            err_msg = ''
+
+        if valid:
+            progress.update(users_total=len(users), force=True)
+
+            # process request
+            results = process_data_request(
+                request_obj, users,
+                point_callback=stream_point if stream_target else None,
+                progress=progress)
+
+            # Failed requests are reported rather than stored as responses
+            if is_failed_response(results):
+                valid = False
+                err_msg = results['data']
+                stream_end['error'] = err_msg
+            else:
+                progress.update(users_done=len(users), force=True)
+                stream_end = {'status': 'complete'}
         else:
-            p.put(results, block=True)
+            stream_end['error'] = err_msg
+
+    finally:
+        if stream_target:
+            umapi_broker_context.add(stream_target, STREAM_END_KEY,
+                                     stream_end)
+
+    if valid:
+        # Hand over the spooled response rather than the response itself
+        try:
+            path = spool_data(iter_encode_response(results), response_meta)
+        finally:
+            if isinstance(results['data'], SpilledRows):
+                results['data'].discard()
+        p.send((True, path) if path else (False, err_msg))
 
         logging.info(log_name + ' :: END JOB'
                                 '\n\tCOHORT = {0}- METRIC = {1} -  PID = {2})'.
@@ -307,7 +390,7 @@ def process_metrics(p, request_url):
                             getpid()))
 
     else:
-        p.put(err_msg, block=True)
+        p.send((False, err_msg))
         logging.info(log_name + ' :: END JOB - FAILED.'
                                 '\n\tCOHORT = {0}- METRIC = {1} -  PID = {2})'.
                      format(request_obj.cohort_expr, request_obj.metric,
@@ -318,28 +401,46 @@ def process_metrics(p, request_url):
 
 from dateutil.parser import parse as date_parse
 from copy import deepcopy
+from datetime import datetime
+from math import ceil
+from operator import itemgetter
 
 from user_metrics.etl.data_loader import DataLoader
-import user_metrics.metrics.user_metric as um
 import user_metrics.etl.time_series_process_methods as tspm
 from user_metrics.api.engine.request_meta import ParameterMapping
 from user_metrics.api.engine.response_meta import format_response
-from user_metrics.api.engine import DATETIME_STR_FORMAT
+from user_metrics.api.engine import DATETIME_STR_FORMAT, \
+    SAMPLE_PILOT_FRACTION, SAMPLE_PILOT_MIN_USERS, DEFAULT_INERVAL_LENGTH
 from user_metrics.api.engine.request_meta import get_agg_key, \
     get_aggregator_type, request_types
-
-INTERVALS_PER_THREAD = 10
-MAX_THREADS = 5
+from user_metrics.api.engine.data import GROUP_BY_REG_DAY
+from user_metrics.etl.sampling import sample_frame, stratified_sample, \
+    sample_estimate, relative_error, CONFIDENCE_LEVEL
 
 USER_THREADS = settings.__user_thread_max__
 REVISION_THREADS = settings.__rev_thread_max__
-DEFAULT_INERVAL_LENGTH = 24
+
+# Number of partitions, of at least ``USER_PROGRESS_MIN_STEP`` users, in
+# which users are processed by jobs that report their progress
+USER_PROGRESS_STEPS = 20
+USER_PROGRESS_MIN_STEP = 500
+
+# Largest number of users processed at a time by raw requests, whose rows
+# are spilled to disk between partitions
+RAW_PARTITION_SIZE = 10000
 
 # create shorthand method refs
 to_string = DataLoader().cast_elems_to_string
 
 
-def process_data_request(request_meta, users):
+def is_failed_response(results):
+    """ Whether the results of ``process_data_request`` are a failure """
+    return isinstance(results['data'], basestring) and \
+        results['data'].startswith('Request failed.')
+
+
+def process_data_request(request_meta, users, point_callback=None,
+                         progress=None):
     """
         Main entry point of the module, prepares results for a given request.
         Coordinates a request based on the following parameters::
@@ -353,6 +454,12 @@ def process_data_request(request_meta, users):
             Most notably, "aggregator" if the request requires aggregation,
             "time_series" flag indicating a time series request.  The
             remaining kwargs specify metric object parameters.
+
+        For time series requests ``point_callback`` is optionally called as
+        ``point_callback(timestamp, values, in_order)`` for every point as
+        soon as it is available.  ``in_order`` is False if any earlier point
+        of the series is still outstanding.  The users and intervals done
+        are counted on ``progress``, a JobProgress object, if passed.
     """
 
     # Set interval length in hours if not present
@@ -361,6 +468,11 @@ def process_data_request(request_meta, users):
     else:
         request_meta.slice = float(request_meta.slice)
 
+    # Rolling windows are measured over the intervals of the series (see
+    # ``build_rolling_time_series``), points are keyed accordingly
+    if request_meta.rolling:
+        request_meta.group = USER_METRIC_PERIOD_TYPE.INPUT
+
     # Get the aggregator key
     agg_key = get_agg_key(request_meta.aggregator, request_meta.metric) if \
         request_meta.aggregator else None
@@ -382,12 +494,6 @@ def process_data_request(request_meta, users):
             results['data'] = 'Request failed. ' + e.message
             return results
 
-        # Determine intervals and thread allocation
-        total_intervals = (date_parse(end) - date_parse(start)).\
-            total_seconds() / (3600 * request_meta.slice)
-        time_threads = max(1, int(total_intervals / INTERVALS_PER_THREAD))
-        time_threads = min(MAX_THREADS, time_threads)
-
         logging.info(__name__ + ' :: Initiating time series for %(metric)s\n'
                                 '\tAGGREGATOR = %(agg)s\n'
                                 '\tFROM: %(start)s,\tTO: %(end)s.' %
@@ -397,30 +503,106 @@ def process_data_request(request_meta, users):
                                     'start': str(start),
                                     'end': str(end),
                                 })
-        metric_threads = '"k_" : {0}, "kr_" : {1}'.format(USER_THREADS,
-                         REVISION_THREADS)
-        metric_threads = '{' + metric_threads + '}'
-
         new_kwargs = deepcopy(args)
 
         del new_kwargs['slice']
         del new_kwargs['aggregator']
         del new_kwargs['datetime_start']
         del new_kwargs['datetime_end']
-
-        out = tspm.build_time_series(start,
-                                     end,
-                                     request_meta.slice,
-                                     metric_class,
-                                     aggregator_func,
-                                     users,
-                                     kt_=time_threads,
-                                     metric_threads=metric_threads,
-                                     log=True,
-                                     **new_kwargs)
+        del new_kwargs['rolling']
+        del new_kwargs['groupby']
+
+        # Assemble the series from cached points, computing only the gaps
+        intervals = tspm.get_intervals(start, end, request_meta.slice)
+        cached_points = get_series_points(
+            request_meta, [str(ts_s) for ts_s, ts_e in intervals])
+
+        runs = list()
+        for ts_s, ts_e in intervals:
+            if str(ts_s) in cached_points:
+                continue
+            if runs and runs[-1][1] == ts_s:
+                runs[-1][1] = ts_e
+            else:
+                runs.append([ts_s, ts_e])
+
+        logging.info(__name__ + ' :: {0} of {1} points cached, computing '
+                                '{2} runs.'.format(len(cached_points),
+                                                   len(intervals), len(runs)))
+        if progress:
+            progress.update(intervals_total=len(intervals),
+                            intervals_done=len(cached_points), force=True)
+
+        # Hand points to the callback, flagging those that overtake others
+        starts = [str(ts_s) for ts_s, ts_e in intervals]
+        emitted = set()
+        next_point = [0]
+
+        def emit(point):
+            emitted.add(point[0])
+            while next_point[0] < len(starts) and \
+                    starts[next_point[0]] in emitted:
+                next_point[0] += 1
+            in_order = next_point[0] == len(starts) or \
+                point[0] < starts[next_point[0]]
+            timestamp = date_parse(point[0][:19]).strftime(
+                DATETIME_STR_FORMAT)
+            point_callback(timestamp, point[3:], in_order)
+
+        def computed(point):
+            if point_callback:
+                emit(point)
+            if progress:
+                progress.advance('intervals_done')
+
+        out = cached_points.values()
+        if point_callback:
+            for point in sorted(out, key=itemgetter(0)):
+                emit(point)
+        if point_callback or progress:
+            new_kwargs['callback_'] = computed
+
+        for run_start, run_end in runs:
+            if request_meta.rolling:
+                # Rolling windows span ``rolling`` intervals of ``slice``
+                try:
+                    run_out = tspm.build_rolling_time_series(
+                        run_start,
+                        run_end,
+                        request_meta.slice,
+                        int(request_meta.rolling),
+                        metric_class,
+                        aggregator_func,
+                        users,
+                        log=True,
+                        **new_kwargs)
+                except (ValueError, tspm.TimeSeriesException) as e:
+                    results['data'] = 'Request failed. ' + str(e)
+                    return results
+            else:
+                try:
+                    run_out = tspm.build_time_series(run_start,
+                                                     run_end,
+                                                     request_meta.slice,
+                                                     metric_class,
+                                                     aggregator_func,
+                                                     users,
+                                                     log=True,
+                                                     **new_kwargs)
+                except tspm.TimeSeriesException as e:
+                    results['data'] = 'Request failed. ' + str(e)
+                    return results
+
+            # Only points over completed intervals are cached
+            now = datetime.now()
+            set_series_points(request_meta,
+                              [p for p in run_out if date_parse(p[1]) <= now])
+            out.extend(run_out)
+
+        out.sort(key=itemgetter(0))
 
         results['header'] = ['timestamp'] + \
-            getattr(aggregator_func, um.METRIC_AGG_METHOD_HEAD)
+            getattr(aggregator_func, METRIC_AGG_METHOD_HEAD)
         for row in out:
             timestamp = date_parse(row[0][:19]).strftime(
                 DATETIME_STR_FORMAT)
@@ -445,20 +627,91 @@ def process_data_request(request_meta, users):
                                     'end': str(end),
                                 })
 
+        # Sampled requests estimate the aggregate from part of the cohort,
+        # an empty cohort is left to the unsampled path
+        if (request_meta.sample or request_meta.target_error) and users:
+            return process_sample_request(request_meta, results, metric_obj,
+                                          aggregator_func, users, args)
+
+        # Resolve the groups of users up front for grouped requests
+        user_groups = None
+        if request_meta.groupby:
+            try:
+                user_groups = get_user_groups(str(request_meta.groupby),
+                                              request_meta, users)
+            except (MetricsAPIError, query_mod.UMQueryCallError) as e:
+                results['data'] = 'Request failed. ' + e.message
+                return results
+
+        # Aggregates with a push-down form are computed by the database when
+        # all users share the metric window, no per-user rows are fetched
+        pushdown = get_agg_pushdown(aggregator_func)
+        if pushdown and user_groups is None and \
+                metric_obj.group == USER_METRIC_PERIOD_TYPE.INPUT:
+            logging.info(__name__ + ' :: Pushing down %s to the database.' %
+                                    request_meta.aggregator)
+            try:
+                values = pushdown(users, metric_obj)
+            except query_mod.UMQueryCallError as e:
+                results['data'] = 'Request failed. ' + e.message
+                return results
+
+            results['header'] = to_string(
+                getattr(aggregator_func, METRIC_AGG_METHOD_HEAD))
+            results['data'] = values
+            return results
+
+        # Mergeable aggregators are folded by the workers of the task grid,
+        # per-user rows never reach this process
+        if get_agg_state(aggregator_func) and user_groups is None:
+            new_kwargs = deepcopy(args)
+            for key in ['slice', 'aggregator', 'datetime_start',
+                        'datetime_end', 'rolling', 'groupby']:
+                del new_kwargs[key]
+
+            if progress:
+                new_kwargs['progress_'] = \
+                    lambda n: progress.advance('users_done', n)
+
+            point = tspm.build_aggregate(start, end, metric_class,
+                                         aggregator_func, users, log=True,
+                                         **new_kwargs)
+            if not point:
+                results['data'] = 'Request failed. Could not compute the ' \
+                                  'aggregate for all users.'
+                return results
+
+            results['header'] = to_string(
+                getattr(aggregator_func, METRIC_AGG_METHOD_HEAD))
+            results['data'] = point[3:]
+            return results
+
+        # Only aggregates are read from the results, keep them as columns
         try:
-            metric_obj.process(users,
-                               k_=USER_THREADS,
-                               kr_=REVISION_THREADS,
-                               log_=True,
-                               **args)
+            process_users(metric_obj, users,
+                          progress=progress,
+                          k_=USER_THREADS,
+                          kr_=REVISION_THREADS,
+                          log_=True,
+                          columnar_=True,
+                          **args)
         except UserMetricError as e:
             logging.error(__name__ + ' :: Metrics call failed: ' + str(e))
             results['data'] = str(e)
             return results
 
-        r = agg_engine(aggregator_func, metric_obj, metric_obj.header())
-        results['header'] = to_string(r.header)
-        results['data'] = r.data[1:]
+        if user_groups is not None:
+            # All groups are aggregated from the one set of results
+            results['groupby'] = str(request_meta.groupby)
+            results['header'] = to_string(
+                getattr(aggregator_func, METRIC_AGG_METHOD_HEAD))
+            for group, r in group_aggregate(aggregator_func, metric_obj,
+                                            user_groups).iteritems():
+                results['data'][str(group)] = r.data[1:]
+        else:
+            r = agg_engine(aggregator_func, metric_obj, metric_obj.header())
+            results['header'] = to_string(r.header)
+            results['data'] = r.data[1:]
 
     elif results['type'] == request_types.raw:
 
@@ -469,18 +722,168 @@ def process_data_request(request_meta, users):
                                     'start': str(start),
                                     'end': str(end),
                                 })
+        # The rows are held on disk beyond the memory budget and encoded
+        # one at a time, see ``iter_encode_response``
         try:
-            metric_obj.process(users,
-                               k_=USER_THREADS,
-                               kr_=REVISION_THREADS,
-                               log_=True,
-                               **args)
+            process_users(metric_obj, users,
+                          progress=progress,
+                          k_=USER_THREADS,
+                          kr_=REVISION_THREADS,
+                          log_=True,
+                          spill_=True,
+                          **args)
         except UserMetricError as e:
             logging.error(__name__ + ' :: Metrics call failed: ' + str(e))
             results['data'] = str(e)
             return results
 
-        for m in metric_obj.__iter__():
-            results['data'][m[0]] = m[1:]
+        results['data'] = metric_obj._results
+
+    return results
+
 
+def process_users(metric_obj, users, progress=None, **kwargs):
+    """
+        Processes ``metric_obj`` over ``users`` reusing the rows of users
+        cached by earlier requests (see ``get_user_rows``).  Only the
+        remaining users are computed, and their rows cached.  The keyword
+        arguments are those of the metric ``process`` method.
+
+        If ``progress`` is passed the cached users are counted as done and
+        the remaining users are processed in up to ``USER_PROGRESS_STEPS``
+        partitions, each counted as done once processed.  If ``spill_`` is
+        set the results are ``SpilledRows`` and partitions hold at most
+        ``RAW_PARTITION_SIZE`` users.
+    """
+    columnar = kwargs.pop('columnar_', False)
+    spill = kwargs.pop('spill_', False)
+    cached = get_user_rows(metric_obj, users)
+    missing = [user for user in users if str(user) not in cached]
+
+    logging.info(__name__ + ' :: {0} of {1} user rows cached.'.
+                 format(len(users) - len(missing), len(users)))
+    n = max(len(missing), 1)
+    if progress:
+        progress.update(users_done=len(users) - len(missing), force=True)
+        n = max(int(ceil(float(len(missing)) / USER_PROGRESS_STEPS)),
+                USER_PROGRESS_MIN_STEP)
+    if spill:
+        n = min(n, RAW_PARTITION_SIZE)
+
+    rows = SpilledRows() if spill else list()
+    for i in xrange(0, len(missing), n):
+        partition = missing[i: i + n]
+        metric_obj.process(partition, **kwargs)
+        partition_rows = list(metric_obj.__iter__())
+        set_user_rows(metric_obj, partition_rows)
+        rows.extend(partition_rows)
+        if progress:
+            progress.advance('users_done', len(partition))
+    if not missing and not cached:
+        # Let the metric flag the empty cohort
+        metric_obj.process(missing, **kwargs)
+
+    rows.extend(cached.itervalues())
+    metric_obj._results = rows
+    if columnar:
+        metric_obj._results = ColumnarResults(metric_obj._results,
+                                              metric_obj._data_model_meta,
+                                              len(metric_obj.header()))
+    return metric_obj
+
+
+def process_sample_request(request_meta, results, metric_obj,
+                           aggregator_func, users, args):
+    """
+        Estimates the aggregate of an aggregator request from a random
+        sample of the cohort, stratified by registration day (see
+        ``user_metrics.etl.sampling``), and reports confidence intervals of
+        the estimates along with the sample.
+
+        The ``sample`` request parameter sets the fraction of users sampled.
+        For a ``target_error`` (the largest half width of the confidence
+        intervals relative to the estimate) the sample starts from a pilot,
+        of ``sample`` if given, and is extended until the target is met.
+    """
+    try:
+        fraction = float(request_meta.sample) if request_meta.sample \
+            else None
+        target_error = float(request_meta.target_error) if \
+            request_meta.target_error else None
+    except ValueError:
+        fraction, target_error = -1.0, None
+    if (fraction is not None and not 0.0 < fraction <= 1.0) or \
+            (target_error is not None and target_error <= 0.0):
+        results['data'] = 'Request failed. The sample must be a fraction ' \
+                          'in (0, 1] and the target error positive.'
+        return results
+    if request_meta.groupby:
+        results['data'] = 'Request failed. Sampled requests can\'t be ' \
+                          'grouped.'
+        return results
+
+    # Stratify the cohort by registration day
+    try:
+        user_groups = get_user_groups(GROUP_BY_REG_DAY, request_meta, users)
+    except (MetricsAPIError, query_mod.UMQueryCallError) as e:
+        results['data'] = 'Request failed. ' + e.message
+        return results
+    strata = dict()
+    for user in users:
+        strata.setdefault(user_groups.get(str(user), [None])[0],
+                          list()).append(user)
+
+    if not fraction:
+        fraction = min(1.0, max(SAMPLE_PILOT_FRACTION,
+                                float(SAMPLE_PILOT_MIN_USERS) / len(users)))
+
+    frame = sample_frame(strata)
+    sample, rows = dict(), list()
+    while True:
+        sampled = set(u for s in sample.itervalues() for u in s)
+        sample = stratified_sample(frame, fraction)
+        new_users = [u for s in sample.itervalues() for u in s
+                     if u not in sampled]
+
+        logging.info(__name__ + ' :: Sampling {0} of {1} users in {2} '
+                                'strata.'.format(len(sampled) +
+                                                 len(new_users), len(users),
+                                                 len(strata)))
+        if new_users:
+            try:
+                process_users(metric_obj, new_users,
+                              k_=USER_THREADS,
+                              kr_=REVISION_THREADS,
+                              log_=True,
+                              **args)
+            except UserMetricError as e:
+                logging.error(__name__ + ' :: Metrics call failed: ' +
+                              str(e))
+                results['data'] = str(e)
+                return results
+            rows.extend(metric_obj.__iter__())
+        metric_obj._results = rows
+
+        values, intervals = sample_estimate(aggregator_func, metric_obj,
+                                            sample, fraction)
+        error = relative_error(values, intervals)
+        if not target_error or error is None or error <= target_error or \
+                fraction >= 1.0:
+            break
+
+        # Interval widths shrink with the square root of the sample size
+        fraction = min(1.0, 1.1 * fraction * (error / target_error) ** 2)
+
+    results['header'] = to_string(
+        getattr(aggregator_func, METRIC_AGG_METHOD_HEAD))
+    results['data'] = values
+    results['confidence_intervals'] = intervals
+    results['sample'] = {
+        'fraction': fraction,
+        'cohort_users': len(users),
+        'sampled_users': sum(len(s) for s in sample.itervalues()),
+        'strata': len(strata),
+        'confidence_level': CONFIDENCE_LEVEL,
+        'relative_error': error,
+    }
     return results
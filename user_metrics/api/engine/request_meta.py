@@ -45,6 +45,8 @@ from collections import namedtuple, OrderedDict
 from flask import escape
 from user_metrics.config import logging
 from user_metrics.utils import unpack_fields
+from user_metrics.etl.aggregator import build_combined_agg
+import re
 
 
 # DEFINE REQUEST META OBJECT, CREATION, AND PROCESSING
@@ -52,6 +54,9 @@ from user_metrics.utils import unpack_fields
 
 DEFAULT_PROJECT = 'enwiki'
 
+# Separates the handles of a request for several aggregators
+AGGREGATOR_DELIMETER = ','
+
 # Default group + structure that maps values in the query string to new ones
 DEFAULT_GROUP = 'reg'
 REQUEST_VALUE_MAPPING = {
@@ -159,7 +164,8 @@ def build_request_obj(request_url):
 REQUEST_META_QUERY_STR = ['aggregator', 'time_series', 'project', 'namespace',
                           'start', 'end', 'slice', 't', 'n',
                           'time_unit', 'time_unit_count', 'look_ahead',
-                          'look_back', 'threshold_type', 'group', 'is_user']
+                          'look_back', 'threshold_type', 'group', 'is_user',
+                          'rolling', 'groupby', 'sample', 'target_error']
 
 # Defines which variables may be taken from the URL path
 REQUEST_META_BASE = ['cohort_expr', 'metric']
@@ -198,14 +204,15 @@ def format_request_params(request_meta):
     if not request_meta.project:
         request_meta.project = DEFAULT_PROJECT
 
-    grp_in_req = request_meta.group in REQUEST_VALUE_MAPPING
+    grp_in_req = request_meta.group in REQUEST_VALUE_MAPPING['group']
     if get_request_type(request_meta) != request_types.raw and not grp_in_req:
         request_meta.group = DEFAULT_GROUP
 
-    # set the aggregator if there is one
+    # set the aggregator if there is one, lists of aggregators are
+    # normalised to comma separated handles
     agg_key = get_agg_key(request_meta.aggregator, request_meta.metric)
-    request_meta.aggregator = escape(request_meta.aggregator)\
-        if agg_key else None
+    request_meta.aggregator = escape(AGGREGATOR_DELIMETER.join(
+        get_agg_handles(request_meta.aggregator))) if agg_key else None
     # @TODO Escape remaining input
 
     # MAP request values.
@@ -329,7 +336,11 @@ class ParameterMapping(object):
                      varMapping('aggregator', 'aggregator'),
                      varMapping('t', 't'),
                      varMapping('group', 'group'),
-                     varMapping('is_user', 'is_user')]
+                     varMapping('is_user', 'is_user'),
+                     varMapping('rolling', 'rolling'),
+                     varMapping('groupby', 'groupby'),
+                     varMapping('sample', 'sample'),
+                     varMapping('target_error', 'target_error')]
 
     QUERY_PARAMS_BY_METRIC = {
         'blocks': common_params,
@@ -372,19 +383,22 @@ from user_metrics.metrics.threshold import Threshold, threshold_editors_agg
 from user_metrics.metrics.blocks import Blocks, block_rate_agg, \
     block_prop_agg
 from user_metrics.metrics.bytes_added import BytesAdded, ba_median_agg, \
-    ba_min_agg, ba_max_agg, ba_sum_agg, ba_mean_agg, ba_std_agg
+    ba_min_agg, ba_max_agg, ba_sum_agg, ba_mean_agg, ba_std_agg, \
+    ba_quantile_agg
 from user_metrics.metrics.survival import Survival, survival_editors_agg
 from user_metrics.metrics.revert_rate import RevertRate, revert_stats_agg, \
     revert_prop_agg
 from user_metrics.metrics.time_to_threshold import TimeToThreshold, \
-    ttt_avg_agg, ttt_stats_agg
+    ttt_avg_agg, ttt_stats_agg, ttt_quantile_agg
 from user_metrics.metrics.edit_rate import EditRate, edit_rate_agg, \
-    er_stats_agg
+    er_stats_agg, er_quantile_agg
 from user_metrics.metrics.namespace_of_edits import NamespaceEdits, \
     namespace_edits_sum
 from user_metrics.metrics.live_account import LiveAccount, live_accounts_agg
+from user_metrics.metrics.edit_count import EditCount, edit_count_sum_agg, \
+    edit_count_active_agg
 from user_metrics.metrics.pages_created import PagesCreated, \
-    pages_created_stats_agg
+    pages_created_stats_agg, pages_created_quantile_agg
 
 
 # Registered metrics types
@@ -399,6 +413,7 @@ metric_dict = {
     'namespace_edits': NamespaceEdits,
     'live_account': LiveAccount,
     'pages_created': PagesCreated,
+    'edit_count': EditCount,
 }
 
 # @TODO: let metric types handle this mapping themselves and obsolete this
@@ -423,6 +438,12 @@ aggregator_dict = {
     'proportion+blocks': block_prop_agg,
     'dist+time_to_threshold': ttt_stats_agg,
     'dist+pages_created': pages_created_stats_agg,
+    'sum+edit_count': edit_count_sum_agg,
+    'proportion+edit_count': edit_count_active_agg,
+    'quantiles+bytes_added': ba_quantile_agg,
+    'quantiles+time_to_threshold': ttt_quantile_agg,
+    'quantiles+edit_rate': er_quantile_agg,
+    'quantiles+pages_created': pages_created_quantile_agg,
 }
 
 
@@ -432,8 +453,11 @@ def get_metric_type(metric):
 
 def get_aggregator_type(agg):
     try:
+        if AGGREGATOR_DELIMETER in agg:
+            return build_combined_agg([aggregator_dict[key] for key in
+                                       agg.split(AGGREGATOR_DELIMETER)])
         return aggregator_dict[agg]
-    except KeyError:
+    except (KeyError, TypeError):
         raise MetricsAPIError(__name__ + ' :: Bad aggregator name.')
 
 
@@ -452,12 +476,26 @@ def get_param_types(metric_handle):
     return metric_dict[metric_handle]()._param_types
 
 
+def get_agg_handles(agg_handle):
+    """
+        Splits the aggregator of a request into the list of its aggregator
+        handles, e.g. "sum,mean" (or "sum%2Cmean") -> ['sum', 'mean'].
+    """
+    return [h for h in re.sub('%2C', AGGREGATOR_DELIMETER, str(agg_handle),
+                              flags=re.I).split(AGGREGATOR_DELIMETER) if h]
+
+
 def get_agg_key(agg_handle, metric_handle):
-    """ Compose the metric dependent aggregator handle """
+    """
+        Compose the metric dependent aggregator handle.  A list of
+        aggregators composes a key for each, joined by
+        ``AGGREGATOR_DELIMETER``.
+    """
     try:
-        agg_key = '+'.join([agg_handle, metric_handle])
-        if agg_key in aggregator_dict:
-            return agg_key
+        agg_keys = ['+'.join([handle, metric_handle])
+                    for handle in get_agg_handles(agg_handle)]
+        if agg_keys and all(key in aggregator_dict for key in agg_keys):
+            return AGGREGATOR_DELIMETER.join(agg_keys)
         else:
             return ''
     except TypeError:
@@ -13,9 +13,7 @@ from user_metrics.config import logging
 from user_metrics.api.engine import unpack_response_for_broker, \
     RESPONSE_TIMEOUT
 from user_metrics.api.engine.request_meta import build_request_obj
-from user_metrics.api.engine.data import set_data
-
-import time
+from user_metrics.api.engine.data import commit_data
 
 
 # API RESPONSE HANDLER
@@ -23,27 +21,35 @@ import time
 
 
 def process_response():
-    """ Pulls responses off of the queue. """
+    """
+        Pulls responses off of the queue.  Sleeps until the job controller
+        notifies the response target or ``RESPONSE_TIMEOUT`` elapses.
+    """
 
     log_name = '{0} :: {1}'.format(__name__, process_response.__name__)
     logging.debug(log_name  + ' - STARTING...')
 
     while 1:
 
-        time.sleep(RESPONSE_TIMEOUT)
-
         # Handle any responses as they enter the queue
         # logging.debug(log_name  + ' - POLLING RESPONSES...')
         res_item = umapi_broker_context.pop(RESPONSE_BROKER_TARGET)
         if not res_item:
+            umapi_broker_context.wait([RESPONSE_BROKER_TARGET],
+                                      RESPONSE_TIMEOUT)
             continue
 
-        req, data = unpack_response_for_broker(res_item)
+        # The response is spooled to a file by the worker process
+        req, path = unpack_response_for_broker(res_item)
         request_meta = build_request_obj(req)
 
         # Add result to cache once completed
         logging.debug(log_name + ' - Setting data for {0}'.format(
             str(request_meta)))
-        set_data(data, request_meta)
+        try:
+            commit_data(path, request_meta)
+        except OSError as e:
+            logging.error(log_name + ' - Could not store {0}: {1}'.format(
+                path, str(e)))
 
     logging.debug(log_name + ' - SHUTTING DOWN...')
@@ -0,0 +1,271 @@
+"""
+    This module implements the on-disk store of cached API responses and
+    time series points.  Each item is a file of its own named by its key, the
+    SHA1 of the key signature of a request, so that storing or retrieving a
+    response only touches that response.
+
+    Layout
+    ~~~~~~
+
+    Items are sharded into directories on the first two characters of their
+    key.  A file holds a line of JSON metadata, e.g. the key signature of the
+    request and the refresh time of its cohort, followed by the payload::
+
+        <store root>/3f/3fa9c0...
+            {"key_sig": [...], "refresh": "2013-04-02 10:00:00"}\\n
+            <payload>
+
+    Writes go to a temporary file in the shard that is renamed over the item,
+    readers therefore see either the previous or the new item and concurrent
+    writers of different keys never interfere.  A process may write the file
+    (``stage``) and hand its path to another to store it (``commit``), so the
+    payload is never copied between the two.  A payload may be staged from
+    chunks as they are produced; metadata only known once it is written
+    (e.g. its size) is filled into room reserved on the metadata line.
+    Reads map the file into memory rather than copying it through a
+    buffered read.
+
+    Eviction
+    ~~~~~~~~
+
+    Items older than ``__response_store_max_age__`` days are not served and
+    are removed.  Once the store exceeds ``__response_store_max_size__``
+    megabytes the least recently read items are removed.  Eviction runs from
+    the writing process at most every ``EVICTION_PERIOD`` seconds::
+
+        >>> store = ResponseStore('/tmp/store')
+        >>> store.put(key, 'data', key_sig=key_sig)
+        >>> meta, value = store.get(key)
+"""
+
+__license__ = "GPL (version 2 or later)"
+
+import os
+import json
+import mmap
+import time
+from tempfile import mkstemp
+
+from user_metrics.config import logging, settings
+
+# Root directory of the stores
+RESPONSE_STORE_DIR = getattr(settings, '__response_store_dir__',
+                             os.path.join(settings.__data_file_dir__,
+                                          'response_store'))
+
+# Size limit in bytes and age limit in seconds of the items of a store
+RESPONSE_STORE_MAX_SIZE = int(getattr(settings, '__response_store_max_size__',
+                                      1024)) * 1024 * 1024
+RESPONSE_STORE_MAX_AGE = float(getattr(settings, '__response_store_max_age__',
+                                       30)) * 24 * 3600
+
+# Minimum time in seconds between two evictions
+EVICTION_PERIOD = 300.0
+
+# Prefix of files being written
+TEMP_PREFIX = '.tmp_'
+
+# Bytes reserved on the metadata line for metadata computed while a payload
+# is staged from chunks
+META_RESERVE = 64
+
+
+class ResponseStore(object):
+    """
+    Store of byte string payloads keyed on hex digests.  See the module
+    documentation for the layout.
+    """
+
+    def __init__(self, root, max_size=RESPONSE_STORE_MAX_SIZE,
+                 max_age=RESPONSE_STORE_MAX_AGE):
+        self.root = root
+        self.max_size = max_size
+        self.max_age = max_age
+        self._last_eviction = 0.0
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def put(self, key, value, **meta):
+        """
+        Atomically stores the payload value under key along with the
+        JSON serializable metadata passed as keyword arguments
+        """
+        self.commit(key, self.stage(key, value, **meta))
+
+    def stage(self, key, value, **meta):
+        """
+        Writes an item for key to a temporary file of its shard without
+        storing it, returns the path of the file.  The item is stored by
+        ``commit``, e.g. from another process.  ``value`` may also be an
+        iterable of chunks, written as they are produced, in which case
+        metadata values may be callables evaluated once all chunks are
+        written.
+        """
+        shard = os.path.dirname(self._path(key))
+        try:
+            os.makedirs(shard)
+        except OSError:
+            if not os.path.isdir(shard):
+                raise
+
+        fd, tmp_path = mkstemp(prefix=TEMP_PREFIX, dir=shard)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                if isinstance(value, basestring):
+                    f.write(json.dumps(meta) + '\n')
+                    f.write(value)
+                else:
+                    self._stage_chunks(f, value, meta)
+        except Exception:
+            self._discard(tmp_path)
+            raise
+        return tmp_path
+
+    def _stage_chunks(self, f, chunks, meta):
+        """ Writes the item of ``stage`` for an iterable of chunks """
+        late = [k for k, v in meta.iteritems() if callable(v)]
+        header = json.dumps(dict(meta, **dict((k, None) for k in late)))
+        width = len(header) + (META_RESERVE if late else 0)
+        f.write(header.ljust(width) + '\n')
+        for chunk in chunks:
+            f.write(chunk)
+
+        if late:
+            header = json.dumps(dict(meta, **dict((k, meta[k]())
+                                                  for k in late)))
+            if len(header) > width:
+                raise ValueError('Metadata exceeds the reserved room.')
+            f.seek(0)
+            f.write(header.ljust(width))
+
+    def commit(self, key, path):
+        """ Atomically stores the item staged in path under key """
+        try:
+            os.rename(path, self._path(key))
+        except OSError:
+            self._discard(path)
+            raise
+
+        if time.time() - self._last_eviction > EVICTION_PERIOD:
+            self.evict()
+
+    def _discard(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def get(self, key, touch=True):
+        """
+        Returns the ``(meta, value)`` pair stored under key or None if there
+        is no item, or it has expired.  Unless touch is False the read counts
+        towards keeping the item on eviction.
+        """
+        path = self._path(key)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+
+        with f:
+            stat = os.fstat(f.fileno())
+            if not stat.st_size:
+                return None
+            if time.time() - stat.st_mtime > self.max_age:
+                self.remove(key)
+                return None
+
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                end = mapped.find('\n')
+                if end < 0:
+                    return None
+                meta = json.loads(mapped[:end])
+                value = mapped[end + 1:]
+            except ValueError:
+                logging.error(__name__ + ' :: Bad item "{0}".'.format(path))
+                return None
+            finally:
+                mapped.close()
+
+        # Record the read for eviction, keeping the write time
+        if touch:
+            try:
+                os.utime(path, (time.time(), stat.st_mtime))
+            except OSError:
+                pass
+        return meta, value
+
+    def remove(self, key):
+        """ Removes the item stored under key, if any """
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _files(self):
+        """ Generator over the ``(path, stat)`` pairs of the item files """
+        if not os.path.isdir(self.root):
+            return
+        for shard in os.listdir(self.root):
+            shard_path = os.path.join(self.root, shard)
+            if not os.path.isdir(shard_path):
+                continue
+            for name in os.listdir(shard_path):
+                path = os.path.join(shard_path, name)
+                try:
+                    yield path, os.stat(path)
+                except OSError:
+                    # Removed meanwhile
+                    continue
+
+    def keys(self):
+        """ Generator over the keys of the store """
+        for path, _ in self._files():
+            name = os.path.basename(path)
+            if not name.startswith(TEMP_PREFIX):
+                yield name
+
+    def evict(self):
+        """
+        Removes expired items, and abandoned temporary files, then the least
+        recently read items until the store is within its size limit
+        """
+        now = time.time()
+        self._last_eviction = now
+
+        items = list()
+        removed = 0
+        for path, stat in self._files():
+            if now - stat.st_mtime > self.max_age:
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError:
+                    pass
+            elif not os.path.basename(path).startswith(TEMP_PREFIX):
+                items.append((stat.st_atime, stat.st_size, path))
+
+        total = sum(item[1] for item in items)
+        if total > self.max_size:
+            for _, size, path in sorted(items):
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError:
+                    pass
+                total -= size
+                if total <= self.max_size:
+                    break
+
+        if removed:
+            logging.info(__name__ + ' :: Evicted {0} items from "{1}".'.
+                         format(removed, self.root))
+
+
+# Stores of full responses, of individual time series points and of the
+# metric rows of individual users
+response_store = ResponseStore(os.path.join(RESPONSE_STORE_DIR, 'responses'))
+point_store = ResponseStore(os.path.join(RESPONSE_STORE_DIR, 'points'))
+row_store = ResponseStore(os.path.join(RESPONSE_STORE_DIR, 'rows'))
@@ -0,0 +1,315 @@
+"""
+    This module implements the admission of queued requests by the job
+    controller.  Rather than starting requests in order of arrival the
+    scheduler estimates the cost of each request and places it in a priority
+    lane, so that cheap requests are not held up behind expensive ones.
+
+    Cost
+    ~~~~
+
+    The cost of a request (``estimate_cost``) is the product of:
+
+        * the number of users of the cohort, counted in ``usertags`` (the
+        ``all`` cohort counts as ``__scheduler_all_cohort_size__`` users and a
+        sampled request only as its sample),
+        * the cost class of the metric (``METRIC_COST``),
+        * the length of the window each user is measured over, as
+        ``1 + days / 30``,
+        * the number of intervals of a time series request.
+
+    Lanes
+    ~~~~~
+
+    Requests costing less than the bound of a lane in ``LANES`` go in that
+    lane.  Lanes are served in order, but a lane may only hold its share of
+    the running jobs and the lanes beyond the first always leave one slot to
+    the first, so cheap requests never wait for a slot held by an expensive
+    job.  A request waiting
+    longer than ``STARVATION_WAIT`` seconds is admitted ahead of the lanes.
+    Within a lane the request of the requester with the fewest running jobs
+    is admitted first, then the oldest.
+
+    Concurrency
+    ~~~~~~~~~~~
+
+    The number of concurrent jobs adapts between ``MIN_CONCURRENT_JOBS`` and
+    ``MAX_CONCURRENT_JOBS``.  It is decreased when the replication lag of
+    the database of ``__scheduler_replica_project__`` exceeds ``LAG_HIGH``
+    seconds, or when recent jobs take much longer per unit of cost than jobs
+    have on average (i.e. the replicas are slow).  It is increased while
+    requests wait longer than ``TARGET_WAIT`` seconds and all slots are
+    busy::
+
+        >>> scheduler = JobScheduler()
+        >>> scheduler.update(umapi_broker_context.get_all_items(target))
+        >>> for key in scheduler.select(): ...
+"""
+
+__license__ = "GPL (version 2 or later)"
+
+import time
+from collections import OrderedDict, namedtuple
+from re import search, split
+
+from dateutil.parser import parse as date_parse
+
+from user_metrics.config import logging, settings
+from user_metrics.api import query_mod
+from user_metrics.api.engine import COHORT_REGEX, MIN_CONCURRENT_JOBS, \
+    MAX_CONCURRENT_JOBS, DEFAULT_INERVAL_LENGTH
+from user_metrics.api.engine.request_meta import build_request_obj, \
+    get_request_type, request_types
+
+# Relative cost of computing a metric for a user
+METRIC_COST = {
+    'blocks': 1.0,
+    'edit_count': 1.0,
+    'edit_rate': 1.0,
+    'live_account': 2.0,
+    'namespace_edits': 2.0,
+    'pages_created': 2.0,
+    'bytes_added': 2.0,
+    'threshold': 3.0,
+    'survival': 3.0,
+    'time_to_threshold': 4.0,
+    'revert_rate': 10.0,
+}
+DEFAULT_METRIC_COST = 2.0
+
+# Number of users counted for the "all" cohort
+ALL_COHORT_SIZE = int(getattr(settings, '__scheduler_all_cohort_size__',
+                              100000))
+
+# Project whose database replication lag is watched
+REPLICA_PROJECT = getattr(settings, '__scheduler_replica_project__', 'enwiki')
+
+# Default window in hours of a request without one
+DEFAULT_WINDOW = 24.0
+
+# Cost of a request that could not be estimated
+DEFAULT_COST = 1e5
+
+# Lanes as ``(name, cost bound, share of the running jobs)``
+LANES = [
+    ('small', 1e4, 1.0),
+    ('medium', 1e6, 0.5),
+    ('large', float('inf'), 0.25),
+]
+
+# Seconds after which a waiting request is admitted ahead of the lanes
+STARVATION_WAIT = 1800.0
+
+# Seconds a request may wait before the concurrency limit is raised
+TARGET_WAIT = 30.0
+
+# Minimum number of seconds between two adjustments of the limit
+ADJUST_PERIOD = 30.0
+
+# The limit is lowered when the replication lag in seconds, or the recent
+# time per unit of cost relative to the long run average, exceeds these
+LAG_HIGH = 300.0
+SLOWDOWN_HIGH = 3.0
+
+# Weights of the latest job in the recent and in the long run averages of
+# the time per unit of cost
+RECENT_RATE_WEIGHT = 0.3
+BASE_RATE_WEIGHT = 0.02
+
+# Queued and running requests
+queued_job_type = namedtuple('QueuedJob', 'cost lane requester enqueued')
+running_job_type = namedtuple('RunningJob', 'cost lane requester started')
+
+
+def _cohort_size(request_meta):
+    """ Number of users in the cohort of a request """
+    if request_meta.is_user:
+        return 1
+    cohort_expr = request_meta.cohort_expr
+    if cohort_expr == 'all':
+        return ALL_COHORT_SIZE
+    if search(COHORT_REGEX, cohort_expr):
+        return sum(query_mod.get_cohort_size(cid)
+                   for cid in set(split(r'[&~]', cohort_expr)))
+    return query_mod.get_cohort_size(query_mod.get_cohort_id(cohort_expr))
+
+
+def _hours(start, end):
+    delta = date_parse(str(end)) - date_parse(str(start))
+    return max(delta.total_seconds() / 3600.0, 0.0)
+
+
+def estimate_cost(request_meta):
+    """ Estimates the cost of a request, see the module documentation """
+    users = _cohort_size(request_meta)
+    if request_meta.sample:
+        users *= min(float(request_meta.sample), 1.0)
+
+    intervals = 1
+    if get_request_type(request_meta) == request_types.time_series:
+        window = float(request_meta.slice or DEFAULT_INERVAL_LENGTH)
+        intervals = max(int(_hours(request_meta.start, request_meta.end) /
+                            window), 1)
+    elif request_meta.start and request_meta.end:
+        window = _hours(request_meta.start, request_meta.end)
+    elif request_meta.t:
+        window = float(request_meta.t)
+    else:
+        window = DEFAULT_WINDOW
+
+    return users * METRIC_COST.get(request_meta.metric, DEFAULT_METRIC_COST) \
+        * (1.0 + window / 24.0 / 30.0) * intervals
+
+
+def get_lane(cost):
+    """ Name of the lane of a request of the given cost """
+    for name, bound, _ in LANES:
+        if cost < bound:
+            return name
+    return LANES[-1][0]
+
+
+def _replica_lag():
+    """ Replication lag in seconds of the watched replica, 0 if unknown """
+    try:
+        return query_mod.replica_lag_query(REPLICA_PROJECT)
+    except Exception as e:
+        logging.error(__name__ + ' :: Could not read the replication lag: ' +
+                      str(e))
+        return 0.0
+
+
+def _average(average, value, weight):
+    """ Exponentially weighted moving average """
+    if average is None:
+        return value
+    return weight * value + (1.0 - weight) * average
+
+
+class JobScheduler(object):
+    """
+    Chooses which queued requests the job controller starts, see the module
+    documentation.  Requests are identified by their broker key.
+    """
+
+    def __init__(self, min_jobs=MIN_CONCURRENT_JOBS,
+                 max_jobs=MAX_CONCURRENT_JOBS):
+        self.min_jobs = min_jobs
+        self.max_jobs = max(max_jobs, min_jobs)
+        self.limit = self.min_jobs
+
+        self._queued = OrderedDict()
+        self._running = dict()
+        self._rate = None
+        self._base_rate = None
+        self._last_adjustment = 0.0
+
+    def update(self, items, requesters=None):
+        """
+        Synchronises the queue with the items of the request target, a list
+        of ``{key: url}`` dicts in order of arrival.  ``requesters`` maps
+        keys to the requester of the request.
+        """
+        requesters = requesters if requesters else dict()
+        keys = set()
+        for item in items:
+            key, url = item.items()[0]
+            keys.add(key)
+            if key not in self._queued:
+                cost = self._estimate(url)
+                self._queued[key] = queued_job_type(
+                    cost, get_lane(cost), requesters.get(key), time.time())
+
+        # Requests claimed elsewhere
+        for key in self._queued.keys():
+            if key not in keys:
+                del self._queued[key]
+
+    def _estimate(self, url):
+        try:
+            return estimate_cost(build_request_obj(url))
+        except Exception as e:
+            logging.error(__name__ + ' :: Could not estimate the cost of '
+                                     '{0}: {1}'.format(url, str(e)))
+            return DEFAULT_COST
+
+    def select(self):
+        """
+        Returns the keys of the queued requests to start, in order.  The
+        requests are considered running until ``finish`` is called, unless
+        they are returned with ``discard``.
+        """
+        self._adjust()
+        selected = list()
+        while len(self._running) < self.limit and self._queued:
+            key = self._pick()
+            if key is None:
+                break
+            job = self._queued.pop(key)
+            self._running[key] = running_job_type(
+                job.cost, job.lane, job.requester, time.time())
+            selected.append(key)
+        return selected
+
+    def _pick(self):
+        now = time.time()
+        oldest_key, oldest = next(self._queued.iteritems())
+        if now - oldest.enqueued > STARVATION_WAIT:
+            return oldest_key
+
+        requester_jobs = dict()
+        lane_jobs = dict()
+        for job in self._running.itervalues():
+            requester_jobs[job.requester] = \
+                requester_jobs.get(job.requester, 0) + 1
+            lane_jobs[job.lane] = lane_jobs.get(job.lane, 0) + 1
+        expensive_jobs = len(self._running) - lane_jobs.get(LANES[0][0], 0)
+
+        for index, (lane, _, share) in enumerate(LANES):
+            if lane_jobs.get(lane, 0) >= max(int(share * self.limit), 1):
+                continue
+            if index and expensive_jobs >= max(self.limit - 1, 1):
+                continue
+            candidates = [(requester_jobs.get(job.requester, 0), job.enqueued,
+                           key) for key, job in self._queued.iteritems()
+                          if job.lane == lane]
+            if candidates:
+                return min(candidates)[2]
+        return None
+
+    def discard(self, key):
+        """ Forgets a selected request that could not be started """
+        self._running.pop(key, None)
+
+    def finish(self, key):
+        """ Records the completion of a running request """
+        job = self._running.pop(key, None)
+        if not job or not job.cost:
+            return
+        rate = (time.time() - job.started) / job.cost
+        self._rate = _average(self._rate, rate, RECENT_RATE_WEIGHT)
+        self._base_rate = _average(self._base_rate, rate, BASE_RATE_WEIGHT)
+
+    def _adjust(self):
+        """ Adapts the concurrency limit to replica lag and waiting times """
+        now = time.time()
+        if now - self._last_adjustment < ADJUST_PERIOD:
+            return
+        self._last_adjustment = now
+
+        lag = _replica_lag()
+        slowdown = self._rate / self._base_rate if self._base_rate else 1.0
+        wait = max([now - job.enqueued for job in self._queued.itervalues()]
+                   or [0.0])
+
+        limit = self.limit
+        if lag > LAG_HIGH or slowdown > SLOWDOWN_HIGH:
+            limit = max(self.min_jobs, min(int(limit * 0.75), limit - 1))
+        elif wait > TARGET_WAIT and len(self._running) >= limit:
+            limit = min(self.max_jobs, limit + 1)
+
+        if limit != self.limit:
+            logging.info(__name__ + ' :: Concurrent job limit {0} -> {1} '
+                                    '(lag = {2:.0f}s, slowdown = {3:.2f}, '
+                                    'wait = {4:.0f}s)'.
+                         format(self.limit, limit, lag, slowdown, wait))
+            self.limit = limit
@@ -17,24 +17,29 @@ __date__ = "2012-12-21"
 __license__ = "GPL (version 2 or later)"
 
 from flask import Flask, render_template, Markup, redirect, url_for, \
-    request, escape, flash, jsonify, make_response
+    request, escape, flash, Response
 
 from user_metrics.etl.data_loader import Connector
 from user_metrics.config import logging, settings
 from user_metrics.api.engine.data import get_data, get_url_from_keys, \
-    read_pickle_data
+    get_cached_key_signatures, get_encoded_data, decompress_response, \
+    get_request_key, RESPONSE_ENCODING_GZIP
 from user_metrics.api import error_codes, query_mod, \
     REQUEST_BROKER_TARGET, umapi_broker_context, RESPONSE_BROKER_TARGET, \
-    PROCESS_BROKER_TARGET
-from user_metrics.api.engine.request_meta import get_metric_names
+    PROCESS_BROKER_TARGET, REQUESTER_BROKER_TARGET, COALESCE_BROKER_TARGET, \
+    STREAM_END_KEY, get_stream_target
+from user_metrics.api.engine.progress import get_job_status
+from user_metrics.api.engine.request_meta import get_metric_names, \
+    build_request_obj, get_agg_handles, get_request_type, request_types
 from user_metrics.api.session import APIUser
 import user_metrics.config.settings as conf
-from hashlib import sha1
+from copy import deepcopy
 
 # upload files
 import re
 import csv
 import json
+import time
 
 UPLOAD_FOLDER = 'csv_uploads'
 ALLOWED_EXTENSIONS = set(['csv'])
@@ -48,6 +53,11 @@ app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
 # REGEX to identify refresh flags in the URL
 REFRESH_REGEX = r'refresh[^&]*&|\?refresh[^&]*$|&refresh[^&]*$'
 
+# Time in seconds between polls of a stream target and before a stream
+# is closed
+STREAM_POLL_INTERVAL = 0.5
+STREAM_TIMEOUT = 3600
+
 
 def get_errors(request_args):
     """ Returns the error string given the code in request_args """
@@ -385,7 +395,11 @@ def cohort(cohort=''):
 def output(cohort, metric):
     """
     View corresponding to a data request.  Fetches response if it exists or adds
-    request to the request broker target.
+    request to the request broker target.  Requests are keyed on their
+    canonical form (see ``get_request_key``) so an equivalent request that
+    is queued or running is waited on rather than queued again, as is a
+    queued or running request of several aggregators including the one
+    requested.
 
     TODO - change app.route to accept regex to avoid passing unused vars
     """
@@ -394,21 +408,15 @@ def output(cohort, metric):
     refresh = True if 'refresh' in request.args else False
 
     # Generate url hash - replace 'refresh' in url
-    query_args = ''
-
-    if re.search('\?',request.url):
-        query_args = '?' + request.url.split('?')[-1]
-
-    url = re.sub(REFRESH_REGEX, '', request.path + query_args)
-    url = re.sub(r'/cohorts/', '', url)
-    url_hash = sha1(url.encode('utf-8')).hexdigest()
+    url = get_request_url()
+    request_meta = build_request_obj(url)
+    url_hash = get_request_key(url, request_meta)
 
     # Determine whether result is already cached
-    data = get_data(url)
+    item = get_encoded_data(url, request_meta)
 
-    # Is the request already running or queued?
-    is_queued = umapi_broker_context.is_item(REQUEST_BROKER_TARGET, url_hash)
-    is_running = umapi_broker_context.is_item(PROCESS_BROKER_TARGET, url_hash)
+    # Is the request, or one covering it, already running or queued?
+    _, is_queued, is_running = get_coalesced_state(url_hash)
 
     logging.info(__name__ + ' :: REQ {0}:{1}\n\tqueued={2}\n\tprocessing={3}'.
         format(url_hash, url, str(is_queued), str(is_running)))
@@ -422,45 +430,283 @@ def output(cohort, metric):
         return render_template('processing.html', error=error_codes[0])
 
     # Determine if response is already cached
-    elif data and not refresh:
-        return make_response(jsonify(data))
+    elif item and not refresh:
+        return encoded_response(*item)
 
     # Add the request to the queue
     else:
-        umapi_broker_context.add(REQUEST_BROKER_TARGET, url_hash, url)
+        queue_request(url_hash, url, request_meta)
         return render_template('processing.html')
 
 
+def get_request_state(url_hash):
+    """ Returns whether a request is queued and whether it is running """
+    return umapi_broker_context.is_item(REQUEST_BROKER_TARGET, url_hash), \
+        umapi_broker_context.is_item(PROCESS_BROKER_TARGET, url_hash)
+
+
+def get_coalesced_state(url_hash):
+    """
+    Returns the key of the job answering a request, the request itself or
+    a queued or running request covering it (see ``queue_request``), and
+    whether that job is queued and whether it is running.
+    """
+    is_queued, is_running = get_request_state(url_hash)
+    if not is_queued and not is_running:
+        covering_hash = umapi_broker_context.get(COALESCE_BROKER_TARGET,
+                                                 url_hash)
+        if covering_hash:
+            is_queued, is_running = get_request_state(covering_hash)
+            if is_queued or is_running:
+                return covering_hash, is_queued, is_running
+            umapi_broker_context.remove(COALESCE_BROKER_TARGET, url_hash)
+    return url_hash, is_queued, is_running
+
+
+def get_requester():
+    """
+    Identifies the requester of the current request for the fair share of
+    the job scheduler, the logged in user or else the client address.
+    """
+    if settings.__flask_login_exists__ and not current_user.is_anonymous():
+        return 'user:' + str(current_user.id)
+    return 'addr:' + str(request.remote_addr)
+
+
+def queue_request(url_hash, url, request_meta):
+    """
+    Adds a request to the request broker target.  The requests for each
+    of the aggregators of a request of several aggregators are mapped onto
+    it in the coalesce target, its response answers them all (see
+    ``commit_data``).
+    """
+    umapi_broker_context.add(REQUESTER_BROKER_TARGET, url_hash,
+                             get_requester())
+
+    agg_handles = get_agg_handles(request_meta.aggregator) \
+        if request_meta.aggregator else list()
+    if len(agg_handles) > 1:
+        for handle in agg_handles:
+            single_meta = deepcopy(request_meta)
+            single_meta.aggregator = handle
+            single_hash = get_request_key(url, single_meta)
+            umapi_broker_context.remove(COALESCE_BROKER_TARGET, single_hash)
+            umapi_broker_context.add(COALESCE_BROKER_TARGET, single_hash,
+                                     url_hash)
+
+    umapi_broker_context.add(REQUEST_BROKER_TARGET, url_hash, url)
+    umapi_broker_context.notify(REQUEST_BROKER_TARGET)
+
+
+def encoded_response(payload, meta):
+    """
+    Returns a response serving the stored JSON of a request as is.  The JSON
+    is only decompressed for clients that do not accept gzip.  The size of
+    the JSON, and the time taken decompressing it, are reported in the
+    X-Response-Bytes and X-Response-Decode-Time headers.
+    """
+    headers = {'X-Response-Bytes': str(meta.get('size')),
+               'Vary': 'Accept-Encoding'}
+    if meta.get('encoding') == RESPONSE_ENCODING_GZIP and \
+            'gzip' in request.headers.get('Accept-Encoding', ''):
+        headers['Content-Encoding'] = 'gzip'
+    else:
+        time_start = time.time()
+        payload = decompress_response(payload, meta)
+        headers['X-Response-Decode-Time'] = '{0:.4f}'.format(
+            time.time() - time_start)
+    return Response(payload, mimetype='application/json', headers=headers)
+
+
+def get_request_url():
+    """
+    Returns the url of the current request as keyed by the request broker,
+    the refresh flag and any path prefix are removed.
+    """
+    query_args = ''
+
+    if re.search('\?', request.url):
+        query_args = '?' + request.url.split('?')[-1]
+
+    url = re.sub(REFRESH_REGEX, '', request.path + query_args)
+    url = re.sub(r'^/(stream|job_status)', '', url)
+    return re.sub(r'/cohorts/', '', url)
+
+
+def format_stream_event(event, data):
+    """ Formats a server-sent event """
+    return 'event: {0}\ndata: {1}\n\n'.format(event, json.dumps(data))
+
+
+def stream_output(cohort, metric):
+    """
+    View streaming the points of a time series request as server-sent events.
+    Points are sent as they are computed, each "point" event carries the
+    timestamp, the values and an "in_order" flag that is false when earlier
+    points of the series are still outstanding.  The stream is closed with
+    an "end" event.  If the response is already cached it is streamed in
+    full, otherwise the request is queued as in ``output``.  A client
+    reading the end of the stream removes its target, the remaining points
+    of a removed stream are sent from the cached response.
+    """
+
+    refresh = True if 'refresh' in request.args else False
+
+    url = get_request_url()
+    request_meta = build_request_obj(url)
+    url_hash = get_request_key(url, request_meta)
+    stream_target = get_stream_target(url_hash)
+
+    if get_request_type(request_meta) != request_types.time_series:
+        def generate():
+            yield format_stream_event(STREAM_END_KEY, {
+                'status': 'failed',
+                'error': 'Only time series requests can be streamed.'})
+        return Response(generate(), mimetype='text/event-stream')
+
+    data = get_data(url, request_meta)
+
+    is_queued, is_running = get_request_state(url_hash)
+
+    logging.info(__name__ + ' :: STREAM {0}:{1}\n\tqueued={2}\n\t'
+                            'processing={3}'.
+        format(url_hash, url, str(is_queued), str(is_running)))
+
+    def generate_cached(data, sent):
+        for key in sorted(data['data'].keys()):
+            if key not in sent:
+                yield format_stream_event('point',
+                                          {'timestamp': key,
+                                           'data': data['data'][key],
+                                           'in_order': True})
+        yield format_stream_event(STREAM_END_KEY, {'status': 'complete'})
+
+    if data and not refresh and not is_queued and not is_running:
+        return Response(generate_cached(data, set()),
+                        mimetype='text/event-stream')
+
+    if not is_queued and not is_running:
+        umapi_broker_context.clear(stream_target)
+        queue_request(url_hash, url, request_meta)
+
+    def generate():
+        offset = 0
+        sent = set()
+        time_start = time.time()
+        try:
+            while time.time() - time_start < STREAM_TIMEOUT:
+                # The job writes the end of the stream before it finishes
+                finished = not any(get_request_state(url_hash))
+
+                items = umapi_broker_context.get_all_items(stream_target)
+                for item in items[offset:]:
+                    key = item.keys()[0]
+                    if key == STREAM_END_KEY:
+                        yield format_stream_event(STREAM_END_KEY, item[key])
+                        umapi_broker_context.drop(stream_target)
+                        return
+                    point = dict(item[key])
+                    point['timestamp'] = key
+                    sent.add(key)
+                    yield format_stream_event('point', point)
+                offset = len(items)
+
+                if finished:
+                    # The stream was removed, finish from the response
+                    umapi_broker_context.drop(stream_target)
+                    data = get_data(url, request_meta)
+                    if data:
+                        for event in generate_cached(data, sent):
+                            yield event
+                    else:
+                        yield format_stream_event(STREAM_END_KEY,
+                                                  {'status': 'failed'})
+                    return
+                time.sleep(STREAM_POLL_INTERVAL)
+
+            yield format_stream_event(STREAM_END_KEY, {'status': 'timeout'})
+
+        except GeneratorExit:
+            # Drop the client - the job itself carries on to the cache
+            logging.info(__name__ + ' :: Stream client disconnected - {0}'.
+                format(url))
+
+    return Response(generate(), mimetype='text/event-stream')
+
+
+def job_status(cohort, metric):
+    """
+    View reporting the state of a request as JSON, one of "queued",
+    "running", "complete" once the response is cached or "unknown".  The
+    state of a running request includes the progress of its job with the
+    percent complete and an ETA in seconds (see the progress module).
+    """
+    url = get_request_url()
+    request_meta = build_request_obj(url)
+    url_hash, is_queued, is_running = get_coalesced_state(
+        get_request_key(url, request_meta))
+
+    status = {'url': url}
+    if is_running:
+        status['state'] = 'running'
+        status['progress'] = get_job_status(url_hash)
+    elif is_queued:
+        status['state'] = 'queued'
+    elif get_encoded_data(url, request_meta):
+        status['state'] = 'complete'
+    else:
+        status['state'] = 'unknown'
+    return Response(json.dumps(status), mimetype='application/json')
+
+
+def format_job_progress(status):
+    """ Summarises the progress of a running job for the job queue """
+    if not status:
+        return ''
+    summary = '{0}% - {1}/{2} users'.format(status['percent_complete'],
+                                           status['users_done'],
+                                           status['users_total'])
+    if status['intervals_total']:
+        summary += ', {0}/{1} intervals'.format(status['intervals_done'],
+                                               status['intervals_total'])
+    summary += ', {0} queries'.format(status['queries'])
+    if status['eta'] is not None:
+        summary += ', ETA {0}s'.format(int(status['eta']))
+    return summary
+
+
 def job_queue():
     """ View for listing current jobs working """
 
     error = get_errors(request.args)
 
     p_list = list()
-    p_list.append(Markup('<thead><tr><th>state</th><th>url'
-                         '</th></tr></thead>\n<tbody>\n'))
+    p_list.append(Markup('<thead><tr><th>state</th><th>progress</th>'
+                         '<th>url</th></tr></thead>\n<tbody>\n'))
 
     # Get keys from broker targets
     items_req = umapi_broker_context.get_all_items(REQUEST_BROKER_TARGET)
     items_res = umapi_broker_context.get_all_items(RESPONSE_BROKER_TARGET)
     items_proc = umapi_broker_context.get_all_items(PROCESS_BROKER_TARGET)
 
+    row_template = '<tr><td>{0}</td><td>{1}</td>' \
+                   '<td><a href="{2}">{3}</a></td></tr>'
+
     for item in items_req:
         url = item[item.keys()[0]]
-        row_markup = '<tr><td>{0}</td><td><a href="{1}">{2}</a></td></tr>'\
-            .format('request pending', url, url)
+        row_markup = row_template.format('request pending', '', url, url)
         p_list.append(Markup(row_markup))
 
     for item in items_res:
         url = item[item.keys()[0]]
-        row_markup = '<tr><td>{0}</td><td><a href="{1}">{2}</a></td></tr>'\
-            .format('response generating', url, url)
+        row_markup = row_template.format('response generating', '', url, url)
         p_list.append(Markup(row_markup))
 
     for item in items_proc:
-        url = item[item.keys()[0]]
-        row_markup = '<tr><td>{0}</td><td><a href="{1}">{2}</a></td></tr>'\
-            .format('processing', url, url)
+        key = item.keys()[0]
+        url = item[key]
+        row_markup = row_template.format(
+            'processing', format_job_progress(get_job_status(key)), url, url)
         p_list.append(Markup(row_markup))
 
     if error:
@@ -472,28 +718,17 @@ def job_queue():
 def all_urls():
     """ View for listing all requests.  Retrieves from cache """
 
-    # @TODO - this reads the entire cache into memory, filters will be needed
-    # This extracts ALL data from the cache, the data is assumed to be in the
-    # form of <hash key -> (data, key signature)> pairs.  The key signature is
-    # extracted to reconstruct the url.
-
-    all_data = read_pickle_data()
-    key_sigs = list()
+    # The key signature stored with each response is extracted to
+    # reconstruct the url.
 
     # Get a filter on the results
     pattern = request.args.get('filter', '')
 
-    for key, val in all_data.iteritems():
-        if hasattr(val, '__iter__'):
-            try:
-                key_sigs.append(val[1])
-            except (KeyError, IndexError):
-                logging.error(__name__ + ' :: Could not render key signature '
-                                         'from data, key = {0}'.format(key))
-
     # Compose urls from key sigs
     url_list = list()
-    for key_sig in key_sigs:
+    for key_sig in get_cached_key_signatures():
+        if not key_sig:
+            continue
 
         url = get_url_from_keys(key_sig, 'cohorts/')
 
@@ -515,7 +750,9 @@ view_list = {
     api_root.__name__: api_root,
     all_urls.__name__: all_urls,
     job_queue.__name__: job_queue,
+    job_status.__name__: job_status,
     output.__name__: output,
+    stream_output.__name__: stream_output,
     cohort.__name__: cohort,
     all_cohorts.__name__: all_cohorts,
     metric.__name__: metric,
@@ -542,7 +779,11 @@ route_deco = {
     api_root.__name__: app.route('/'),
     all_urls.__name__: app.route('/all_requests'),
     job_queue.__name__: app.route('/job_queue/'),
+    job_status.__name__:
+        app.route('/job_status/cohorts/<string:cohort>/<string:metric>'),
     output.__name__: app.route('/cohorts/<string:cohort>/<string:metric>'),
+    stream_output.__name__:
+        app.route('/stream/cohorts/<string:cohort>/<string:metric>'),
     cohort.__name__: app.route('/cohorts/<string:cohort>'),
     all_cohorts.__name__: app.route('/cohorts/', methods=['POST', 'GET']),
     metric.__name__: app.route('/metrics/<string:metric>'),
@@ -41,6 +41,64 @@
     In this way aggregators and metrics can be combined freely.  New aggregator
     methods can be written to perform different types of aggregation.
 
+    Mergeable aggregator state
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Aggregators that can be computed from a small partial state carry the
+    ``METRIC_AGG_METHOD_STATE`` attribute, a subclass of ``AggregatorState``
+    that is built from the aggregator kwargs.  Rows are folded into the state
+    as they are produced and the states of separate partitions of a cohort
+    are merged, the aggregate is then read off the merged state::
+
+        >>> state = get_agg_state(ba_sum_agg)
+        >>> state.fold_rows(metric_obj)
+        >>> state.merge(other_state)
+        >>> aggregator_from_state(ba_sum_agg, state)
+
+    ``boolean_rate``, ``weighted_rate``, ``quantile_sketch`` and
+    ``numpy_op`` aggregators built from the ops in ``MERGEABLE_OPS`` are
+    mergeable.
+
+    Bounded memory aggregation
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    ``numpy_op`` aggregators that also compute medians (``SPILLED_OPS``)
+    carry a ``SpillingNumpyOpState``, the values of the median fields are
+    kept in sorters that spill sorted runs to disk beyond the aggregation
+    memory budget (see ``user_metrics.etl.spill``).  Likewise
+    ``list_sum_by_group`` and ``list_average_by_group`` take any iterable of
+    rows and, once the rows read exceed the budget, reduce them and the
+    remaining rows through a ``SpillingGroupReducer`` in place of the
+    vectorised reduction.
+
+    Push-down aggregators
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Aggregators that the database can compute directly carry the
+    ``METRIC_AGG_METHOD_PUSHDOWN`` attribute, a method called as
+    ``pushdown(users, metric)`` that returns the aggregate values (the
+    aggregator data without its name) from a single query over all users.
+    Push-down forms count over one window, they are only used when all users
+    share the window defined by ``metric``, i.e. for ``group=activity``.
+
+    Combined aggregators
+    ~~~~~~~~~~~~~~~~~~~~
+
+    ``build_combined_agg`` composes several registered aggregators of a
+    metric into one whose header and values are the concatenation of theirs,
+    so that all of them are computed over a single set of metric results.
+    The combination is mergeable if each of its aggregators is.
+
+    Approximate quantiles
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    ``quantile_sketch`` aggregators, built with ``build_quantile_agg``,
+    report quantiles (by default p50, p90 and p99) of metric fields from
+    KLL sketches (see ``user_metrics.etl.quantile_sketch``) in place of the
+    exact medians of ``numpy_op``.  The rank of each reported value is within
+    ``rank_error_bound(k)`` (0.85% for the default sketch size) of the
+    requested rank with 99% probability.
+
     Aggregator Methods
     ~~~~~~~~~~~~~~~~~~
 """
@@ -50,9 +108,18 @@ __date__ = "12/12/2012"
 __license__ = "GPL (version 2 or later)"
 
 from types import FloatType
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from copy import copy
 from itertools import izip
-from numpy import array, transpose
+from operator import itemgetter
+from math import sqrt
+from sys import getsizeof
+from numpy import array, int64, float64, bool_, argsort, concatenate, \
+    flatnonzero, diff, add
+
+from user_metrics.etl.quantile_sketch import KLLSketch, DEFAULT_SKETCH_SIZE
+from user_metrics.etl.spill import SpillingSorter, SpillingGroupReducer, \
+    MEMORY_BUDGET
 
 # Type used to carry aggregator meta data
 AggregatorMeta = namedtuple('AggregatorMeta', 'field_name index op')
@@ -69,10 +136,23 @@ aggregate_data_class = namedtuple("AggregateData", "header data")
 # 2. header attribute for a type of metric aggregation methods
 # 3. name attribute for a type of metric aggregation methods
 # 4. keyword arg attribute for a type of metric aggregation methods
+# 5. mergeable state class for a type of metric aggregation methods
 METRIC_AGG_METHOD_FLAG = 'metric_agg_flag'
 METRIC_AGG_METHOD_HEAD = 'metric_agg_head'
 METRIC_AGG_METHOD_NAME = 'metric_agg_name'
 METRIC_AGG_METHOD_KWARGS = 'metric_agg_kwargs'
+METRIC_AGG_METHOD_STATE = 'metric_agg_state'
+METRIC_AGG_METHOD_PUSHDOWN = 'metric_agg_pushdown'
+METRIC_AGG_METHOD_TOTALS = 'metric_agg_totals'
+
+# Names of the ``numpy_op`` ops that can be computed from mergeable state
+MERGEABLE_OPS = ['sum', 'mean', 'std', 'var', 'min', 'max', 'amin', 'amax']
+
+# Names of the ``numpy_op`` ops computed from sorted runs spilled to disk
+SPILLED_OPS = ['median']
+
+# Quantiles reported by ``quantile_sketch`` aggregators by default
+DEFAULT_QUANTILES = [0.5, 0.9, 0.99]
 
 
 def aggregator(agg_method, metric, data_header):
@@ -118,10 +198,55 @@ def decorator_builder(header):
             else:
                 raise AggregatorError('This aggregator (%s) does not operate '
                                       'on this data type.' % f.__name__)
+        for attr in [METRIC_AGG_METHOD_STATE, METRIC_AGG_METHOD_TOTALS]:
+            if hasattr(f, attr):
+                setattr(wrapper, attr, getattr(f, attr))
         return wrapper
     return eval_data_model
 
 
+def get_agg_state(agg_method):
+    """
+        Returns an empty ``AggregatorState`` for the aggregator or ``None`` if
+        the aggregator can't be computed from mergeable state.
+    """
+    if not agg_method or not hasattr(agg_method, METRIC_AGG_METHOD_STATE):
+        return None
+    kwargs = getattr(agg_method, METRIC_AGG_METHOD_KWARGS) if hasattr(
+        agg_method, METRIC_AGG_METHOD_KWARGS) else {}
+    return getattr(agg_method, METRIC_AGG_METHOD_STATE)(**kwargs)
+
+
+def get_agg_pushdown(agg_method):
+    """
+        Returns the push-down method of the aggregator or ``None`` if the
+        aggregator has no push-down form.
+    """
+    if not agg_method:
+        return None
+    return getattr(agg_method, METRIC_AGG_METHOD_PUSHDOWN, None)
+
+
+def get_agg_totals(agg_method):
+    """
+        Returns the positions of the aggregate values that are totals over
+        users (e.g. sums and counts), these scale with the number of users.
+    """
+    if not agg_method:
+        return []
+    return getattr(agg_method, METRIC_AGG_METHOD_TOTALS, [])
+
+
+def aggregator_from_state(agg_method, state):
+    """
+        Counterpart of ``aggregator`` for a folded ``AggregatorState``.
+    """
+    agg_header = getattr(agg_method, METRIC_AGG_METHOD_HEAD) if hasattr(
+        agg_method, METRIC_AGG_METHOD_HEAD) else 'No header specified.'
+    data = [getattr(agg_method, METRIC_AGG_METHOD_NAME)] + state.result()
+    return aggregate_data_class(agg_header, data)
+
+
 def list_sum_indices(l, indices):
     """
         Sums the elements of list indicated by numeric list `indices`.  The
@@ -139,6 +264,124 @@ def list_sum_indices(l, indices):
                         for elem in l]))
 
 
+def group_reduce(keys, columns):
+    """
+        Sums each of ``columns`` by the matching group ``keys``.  Keys are
+        factorised with a single stable sort, the sorted rows of each column
+        are then summed per group with ``add.reduceat`` keeping the numpy
+        type of the column.  Returns the index of the first occurrence of
+        each distinct key, the list of summed columns and the count of each
+        group, groups follow the sort order of the keys::
+
+            >>> group_reduce(['b', 'a', 'b'], [[1, 2, 3]])
+            (array([1, 0]), [array([2, 4])], array([1, 2]))
+    """
+    order, starts, counts = factorise(keys)
+    return order[starts], [add.reduceat(array(column)[order], starts)
+                           for column in columns], counts
+
+
+def factorise(keys):
+    """
+        Sorts group keys with a stable sort.  Returns the sort order, the
+        offset into the order at which each group starts and the count of
+        each group.
+    """
+    keys = array(keys)
+    order = argsort(keys, kind='mergesort')
+    sorted_keys = keys[order]
+
+    is_first = concatenate(([True], sorted_keys[1:] != sorted_keys[:-1]))
+    starts = flatnonzero(is_first)
+    counts = diff(concatenate((starts, [len(keys)])))
+    return order, starts, counts
+
+
+def group_aggregate(agg_method, metric, user_groups):
+    """
+        Applies an aggregator to the results of a metric for each group of
+        users.  ``user_groups`` maps user IDs to the list of groups the user
+        belongs to.  The result rows are keyed on their groups in a single
+        pass and sorted by group once, the aggregator is then applied to the
+        rows of every group.  Returns an OrderedDict of ``AggregateData`` by
+        group, in group order.
+    """
+    rows = list(metric.__iter__())
+    row_index = list()
+    keys = list()
+    for i, row in enumerate(rows):
+        for key in user_groups.get(str(row[0]), []):
+            row_index.append(i)
+            keys.append(key)
+
+    groups = OrderedDict()
+    if not keys:
+        return groups
+
+    order, starts, counts = factorise(keys)
+    for start, count in izip(starts, counts):
+        group_metric = copy(metric)
+        group_metric._results = [rows[row_index[j]]
+                                 for j in order[start: start + count]]
+        groups[keys[order[start]]] = aggregator(agg_method, group_metric,
+                                                metric.header())
+    return groups
+
+
+def _group_by(rows, group_index):
+    """
+        Splits the rows of iterable ``rows`` into their group keys and the
+        remaining columns and sums those by group.  Returns the distinct
+        keys, the summed columns and the count of each group.  Rows are read
+        into memory only up to the memory budget.
+    """
+    rows = iter(rows)
+    l = list()
+    for row in rows:
+        if not l:
+            row_size = _row_size(row)
+        l.append(row)
+        if len(l) * row_size >= MEMORY_BUDGET:
+            return _spilling_group_by(l, rows, group_index)
+    if not l:
+        return [], [], []
+
+    keys = map(itemgetter(group_index), l)
+    columns = [map(itemgetter(i), l) for i in xrange(len(l[0]))
+               if i != group_index]
+    first, sums, counts = group_reduce(keys, columns)
+    return [keys[i] for i in first], sums, counts
+
+
+def _row_size(row):
+    """ Estimate of the memory used to reduce a row """
+    return getsizeof(row) + sum(getsizeof(x) + 8 for x in row)
+
+
+def _spilling_group_by(l, rows, group_index):
+    """
+        ``_group_by`` for rows exceeding the memory budget, ``l`` holds the
+        rows read so far and is emptied, ``rows`` the remaining rows.
+    """
+    reducer = SpillingGroupReducer()
+    try:
+        for row in l:
+            reducer.add(row[group_index],
+                        row[:group_index] + row[group_index + 1:])
+        del l[:]
+        for row in rows:
+            reducer.add(row[group_index],
+                        row[:group_index] + row[group_index + 1:])
+        keys, sums, counts = list(), list(), list()
+        for key, group_sums, count in reducer:
+            keys.append(key)
+            sums.append(group_sums)
+            counts.append(count)
+    finally:
+        reducer.discard()
+    return keys, [array(column) for column in izip(*sums)], array(counts)
+
+
 def list_sum_by_group(l, group_index):
     """
         Sums the elements of list keyed on `key_index`. The elements must be
@@ -151,24 +394,24 @@ def list_sum_by_group(l, group_index):
             >>> l = [[2,1],[1,4],[2,2]]
             >>> list_sum_by_group(l,0)
             [[1,4], [2,3]]
+
+        The reduction is vectorised, see ``group_reduce``.  ``l`` may be
+        any iterable of lists, it is read in bounded memory (see
+        ``_group_by``).
     """
-    d = dict()
-    for i in l:
-        summables = i[:group_index] + i[group_index+1:]
-        if i[group_index] in d:
-            d[i[group_index]] = map(sum, izip(summables, d[i[group_index]]))
-        else:
-            d[i[group_index]] = summables
-    return [d[k][:group_index] + [k] + d[k][group_index:] for k in d]
+    keys, sums, counts = _group_by(l, group_index)
+    rows = izip(*[column.tolist() for column in sums]) if sums else \
+        [()] * len(keys)
+    return [list(row[:group_index]) + [k] + list(row[group_index:])
+            for k, row in izip(keys, rows)]
 
 
 def list_average_by_group(l, group_index):
     """
         Computes the average of the elements of list keyed on `key_index`.
         The elements must be summable (i.e. e1 + e2 is allowed for all e1 and
-        e2).  All elements outside of key are summed on matching keys. This
-        duplicates the code of `list_sum_by_group` since it needs to compute
-        counts in the loop also::
+        e2).  All elements outside of key are summed on matching keys and
+        divided by the group count::
 
             Returns: <list of averaged and keyed elements>
 
@@ -176,23 +419,22 @@ def list_average_by_group(l, group_index):
             >>> l = [[2,1],[1,4],[2,2]]
             >>> list_average(l,0)
             [[1, 4.0], [2, 1.5]]
+
+        As in ``list_sum_by_group`` ``l`` may be any iterable of lists.
     """
-    d = dict()
-    counts = dict()
-    for i in l:
-        summables = i[:group_index] + i[group_index+1:]
-        if i[group_index] in d:
-            d[i[group_index]] = map(sum,
-                                    izip(summables, d[i[group_index]]))
-            counts[i[group_index]] += 1
-        else:
-            d[i[group_index]] = summables
-            counts[i[group_index]] = 1
+    keys, sums, counts = _group_by(l, group_index)
+    rows = izip(*[(column / counts.astype(FloatType)).tolist()
+                  for column in sums]) if sums else [()] * len(keys)
+    return [list(row[:group_index]) + [k] + list(row[group_index:])
+            for k, row in izip(keys, rows)]
+
+
+def _cmp_method_default(x):
+    return x > 0
+
 
-    # use numpy array perform list operation
-    for k in counts:
-        d[k] = list(array(d[k]) / float(counts[k]))
-    return [d[k][:group_index] + [k] + d[k][group_index:] for k in d]
+def _weight_method_default(x):
+    return 1
 
 
 def boolean_rate(iter, **kwargs):
@@ -205,12 +447,9 @@ def boolean_rate(iter, **kwargs):
                 live_accounts
     """
 
-    def cmp_method_default(x):
-        return x > 0
-
     val_idx = kwargs['val_idx'] if 'val_idx' in kwargs else 1
     cmp_method = kwargs['cmp_method'] if 'cmp_method' in kwargs \
-        else cmp_method_default
+        else _cmp_method_default
 
     total = 0
     pos = 0
@@ -234,13 +473,10 @@ def weighted_rate(iter, **kwargs):
         Computes a weighted rate over the elements of the iterator.
     """
 
-    def weight_method_default(x):
-        return 1
-
     weight_idx = kwargs['weight_idx'] if 'weight_idx' in kwargs else 1
     val_idx = kwargs['val_idx'] if 'val_idx' in kwargs else 1
     weight_method = kwargs['weight_method'] if 'cmp_method' in kwargs else \
-        weight_method_default
+        _weight_method_default
 
     count = 0
     total_weight = 0.0
@@ -261,38 +497,88 @@ def weighted_rate(iter, **kwargs):
         return [count, total_weight, 0.0]
 
 
+# numpy types of the ``_data_model_meta`` field classes of a metric, other
+# fields are held as objects
+FIELD_DTYPES = {
+    'integer_fields': int64,
+    'float_fields': float64,
+    'boolean_fields': bool_,
+}
+
+
+def get_columns(iter, indices):
+    """
+        Returns typed numpy column arrays for the data ``indices`` of an
+        iterator exposing a dataset, keyed by index.  The column types follow
+        the ``_data_model_meta`` of the metric.  Columns are built once per
+        result set and cached on the metric so that further aggregators over
+        the same results reuse them, columnar results are returned without
+        copying.  The cache is dropped when ``_results`` of the metric is
+        assigned (see ``UserMetric``), results changed in place must be
+        assigned again.
+    """
+    if hasattr(iter, '_results'):
+        rows = iter._results
+    else:
+        rows = list(iter)
+
+    # Columnar results (see ``user_metric.ColumnarResults``) are used as is
+    if hasattr(rows, 'column'):
+        return dict((index, rows.column(index)) for index in indices)
+
+    cache = getattr(iter, '_columns', None)
+    if not cache or cache[0] is not rows or cache[1] != len(rows):
+        cache = (rows, len(rows), dict())
+        try:
+            iter._columns = cache
+        except AttributeError:
+            pass
+    columns = cache[2]
+
+    data_model = getattr(iter, '_data_model_meta', {})
+    for index in indices:
+        if index in columns:
+            continue
+        dtype = None
+        for field_class, field_dtype in FIELD_DTYPES.iteritems():
+            if index in data_model.get(field_class, []):
+                dtype = field_dtype
+        values = [row[index] for row in rows]
+        try:
+            columns[index] = array(values, dtype=dtype)
+        except (TypeError, ValueError, OverflowError):
+            columns[index] = array(values)
+    return dict((index, columns[index]) for index in indices)
+
+
 def numpy_op(iter, **kwargs):
     """
         Computes specified numpy op from an iterator exposing a dataset.
 
             **iter** - assumed to be a UserMetric class with _results defined
             as a list of datapoints
+
+        Ops are run over float views of the typed columns of ``get_columns``
+        so only the referenced fields are converted.
     """
 
     # Retrieve indices on data for which to compute medians
     agg_meta = kwargs['agg_meta']
     values = list()
 
-    # Convert data points to numpy array
-    if hasattr(iter, '_results'):
-        results = array(iter._results)
-    else:
-        results = list()
-        for i in iter:
-            results.append(i)
-        results = array(iter._results)
-
-    # Transpose the array and convert it's elements to Python FloatType
-    results = transpose(results)
-    results = results.astype(FloatType)
-
-    # Compute the median of each specified data index
     for agg_meta_obj in agg_meta:
         if not hasattr(agg_meta_obj, 'op') or \
                 not hasattr(agg_meta_obj, 'index'):
             raise AggregatorError(__name__ + ':: Use AggregatorMeta object to '
                                              'pass aggregator meta data.')
-        values.append(agg_meta_obj.op(results[agg_meta_obj.index, :]))
+
+    columns = get_columns(iter, set(o.index for o in agg_meta))
+    float_columns = dict((index, column.astype(FloatType, copy=False))
+                         for index, column in columns.iteritems())
+
+    # Compute the op over each specified data index
+    for agg_meta_obj in agg_meta:
+        values.append(agg_meta_obj.op(float_columns[agg_meta_obj.index]))
     return values
 
 
@@ -312,9 +598,91 @@ def build_numpy_op_agg(agg_meta_list, metric_header, method_handle):
                 'agg_meta': agg_meta_list
             }
             )
+    ops = [o.op.__name__ for o in agg_meta_list]
+    setattr(agg_method, METRIC_AGG_METHOD_TOTALS,
+            [i for i, op in enumerate(ops) if op == 'sum'])
+    if all(op in MERGEABLE_OPS for op in ops):
+        setattr(agg_method, METRIC_AGG_METHOD_STATE, NumpyOpState)
+    elif all(op in MERGEABLE_OPS + SPILLED_OPS for op in ops):
+        setattr(agg_method, METRIC_AGG_METHOD_STATE, SpillingNumpyOpState)
     return agg_method
 
 
+def quantile_sketch(iter, **kwargs):
+    """
+        Computes approximate quantiles of the data indices in ``agg_meta``
+        from KLL sketches of size ``k``.  ``agg_meta`` is a list of
+        ``AggregatorMeta`` objects whose ``op`` is the quantile in [0, 1].
+    """
+    return QuantileState(**kwargs).fold_rows(iter).result()
+
+
+def build_quantile_agg(field_prefix_names, metric_header, method_handle,
+                       quantiles=DEFAULT_QUANTILES, k=DEFAULT_SKETCH_SIZE):
+    """
+        Builder method for ``quantile_sketch`` aggregators.  The header
+        fields are the field prefixes followed by the quantile, e.g.
+        ``net_p90``.
+    """
+    agg_meta_list = [AggregatorMeta(name + 'p' + ('%g' % (100 * q)), index, q)
+                     for name, index in field_prefix_names.iteritems()
+                     for q in quantiles]
+
+    agg_method = decorator_builder(metric_header)(quantile_sketch)
+    setattr(agg_method, METRIC_AGG_METHOD_FLAG, True)
+    setattr(agg_method, METRIC_AGG_METHOD_NAME, method_handle)
+    setattr(agg_method, METRIC_AGG_METHOD_HEAD,
+            [o.field_name for o in agg_meta_list])
+    setattr(agg_method, METRIC_AGG_METHOD_KWARGS,
+            {
+                'agg_meta': agg_meta_list,
+                'k': k,
+            }
+            )
+    return agg_method
+
+
+def combined_op(iter, **kwargs):
+    """
+        Applies each of the aggregators in ``agg_methods`` to the same
+        dataset and returns the concatenation of their values.
+    """
+    values = list()
+    for agg_method in kwargs['agg_methods']:
+        values.extend(aggregator(agg_method, iter, iter.header()).data[1:])
+    return values
+
+
+def build_combined_agg(agg_methods):
+    """
+        Builder method for aggregators that combine ``agg_methods``.  The
+        combined aggregator is named after the joined names of its parts.
+    """
+    def combined_agg(metric, **kwargs):
+        return combined_op(metric, **kwargs)
+
+    setattr(combined_agg, METRIC_AGG_METHOD_FLAG, True)
+    setattr(combined_agg, METRIC_AGG_METHOD_NAME,
+            ','.join(getattr(a, METRIC_AGG_METHOD_NAME)
+                     for a in agg_methods))
+    setattr(combined_agg, METRIC_AGG_METHOD_HEAD,
+            [field for a in agg_methods
+             for field in getattr(a, METRIC_AGG_METHOD_HEAD)])
+    setattr(combined_agg, METRIC_AGG_METHOD_KWARGS,
+            {
+                'agg_methods': agg_methods
+            }
+            )
+    totals, offset = list(), 0
+    for a in agg_methods:
+        totals.extend(offset + i for i in get_agg_totals(a))
+        offset += len(getattr(a, METRIC_AGG_METHOD_HEAD))
+    setattr(combined_agg, METRIC_AGG_METHOD_TOTALS, totals)
+    if all(hasattr(a, METRIC_AGG_METHOD_STATE) for a in agg_methods):
+        setattr(combined_agg, METRIC_AGG_METHOD_STATE, CombinedState)
+    return combined_agg
+
+
 def build_agg_meta(op_list, field_prefix_names):
     """
         Builder helper method for building module aggregators via
@@ -331,6 +699,260 @@ class AggregatorError(Exception):
         Exception.__init__(self, message)
 
 
+class AggregatorState(object):
+    """
+    Base class for mergeable aggregator state.  Subclasses are built from the
+    kwargs of their aggregator, fold rows one at a time, merge with the state
+    of another partition of the data and produce the aggregate values in the
+    order of the aggregator header.
+    """
+
+    def fold(self, row):
+        raise NotImplementedError()
+
+    def merge(self, other):
+        raise NotImplementedError()
+
+    def result(self):
+        raise NotImplementedError()
+
+    def fold_rows(self, iter):
+        """ Folds every row exposed by an iterator (e.g. a UserMetric) """
+        for row in iter.__iter__():
+            self.fold(row)
+        return self
+
+    def discard(self):
+        """ Releases any resources of a state whose result isn't read """
+        pass
+
+
+class NumpyOpState(AggregatorState):
+    """
+    State for ``numpy_op`` aggregators over ``MERGEABLE_OPS``.  Keeps the
+    count, sum, extrema and the Welford running mean and sum of squared
+    deviations of each data index.  ``std`` and ``var`` are population
+    values as computed by numpy.
+    """
+
+    def __init__(self, agg_meta, **kwargs):
+        self._agg_meta = agg_meta
+        self._stats = dict((o.index, [0, 0.0, 0.0, 0.0, None, None])
+                           for o in agg_meta)
+
+    def fold(self, row):
+        for index, s in self._stats.iteritems():
+            x = float(row[index])
+            s[0] += 1
+            delta = x - s[1]
+            s[1] += delta / s[0]
+            s[2] += delta * (x - s[1])
+            s[3] += x
+            s[4] = x if s[4] is None else min(s[4], x)
+            s[5] = x if s[5] is None else max(s[5], x)
+
+    def merge(self, other):
+        for index, b in other._stats.iteritems():
+            a = self._stats[index]
+            if not b[0]:
+                continue
+            if not a[0]:
+                a[:] = b
+                continue
+            n = a[0] + b[0]
+            delta = b[1] - a[1]
+            a[2] += b[2] + delta * delta * a[0] * b[0] / n
+            a[1] += delta * b[0] / n
+            a[0] = n
+            a[3] += b[3]
+            a[4] = min(a[4], b[4])
+            a[5] = max(a[5], b[5])
+        return self
+
+    def _op_result(self, o):
+        n, mean, m2, total, lo, hi = self._stats[o.index]
+        op = o.op.__name__
+        if op == 'sum':
+            return total
+        elif not n:
+            return float('nan')
+        elif op == 'mean':
+            return mean
+        elif op == 'var':
+            return m2 / n
+        elif op == 'std':
+            return sqrt(m2 / n)
+        elif op in ['min', 'amin']:
+            return lo
+        else:
+            return hi
+
+    def result(self):
+        return [self._op_result(o) for o in self._agg_meta]
+
+
+class SpillingNumpyOpState(NumpyOpState):
+    """
+    State for ``numpy_op`` aggregators over ``MERGEABLE_OPS`` and
+    ``SPILLED_OPS``.  The values of each median field are collected in a
+    ``SpillingSorter`` sharing the memory budget, the median is selected
+    from the merged runs.  Reading the result removes the runs.
+    """
+
+    def __init__(self, agg_meta, **kwargs):
+        super(SpillingNumpyOpState, self).__init__(agg_meta, **kwargs)
+        indices = set(o.index for o in agg_meta
+                      if o.op.__name__ in SPILLED_OPS)
+        self._sorters = dict(
+            (index, SpillingSorter(MEMORY_BUDGET / len(indices)))
+            for index in indices)
+
+    def fold(self, row):
+        super(SpillingNumpyOpState, self).fold(row)
+        for index, sorter in self._sorters.iteritems():
+            sorter.add(float(row[index]))
+
+    def merge(self, other):
+        super(SpillingNumpyOpState, self).merge(other)
+        for index, sorter in self._sorters.iteritems():
+            sorter.merge(other._sorters[index])
+        return self
+
+    def _op_result(self, o):
+        if o.op.__name__ in SPILLED_OPS:
+            return self._sorters[o.index].median()
+        return super(SpillingNumpyOpState, self)._op_result(o)
+
+    def result(self):
+        try:
+            return super(SpillingNumpyOpState, self).result()
+        finally:
+            self.discard()
+
+    def discard(self):
+        for sorter in self._sorters.itervalues():
+            sorter.discard()
+
+
+class BooleanRateState(AggregatorState):
+    """ State for ``boolean_rate`` aggregators """
+
+    def __init__(self, **kwargs):
+        self._val_idx = kwargs['val_idx'] if 'val_idx' in kwargs else 1
+        self._cmp_method = kwargs['cmp_method'] if 'cmp_method' in kwargs \
+            else _cmp_method_default
+        self.total = 0
+        self.pos = 0
+
+    def fold(self, row):
+        try:
+            if self._cmp_method(row[self._val_idx]):
+                self.pos += 1
+            self.total += 1
+        except (IndexError, TypeError):
+            pass
+
+    def merge(self, other):
+        self.total += other.total
+        self.pos += other.pos
+        return self
+
+    def result(self):
+        if self.total:
+            return [self.total, self.pos, float(self.pos) / self.total]
+        else:
+            return [self.total, self.pos, 0.0]
+
+
+class WeightedRateState(AggregatorState):
+    """ State for ``weighted_rate`` aggregators """
+
+    def __init__(self, **kwargs):
+        self._weight_idx = kwargs['weight_idx'] if 'weight_idx' in kwargs \
+            else 1
+        self._val_idx = kwargs['val_idx'] if 'val_idx' in kwargs else 1
+        self._weight_method = kwargs['weight_method'] if 'cmp_method' in \
+            kwargs else _weight_method_default
+        self.count = 0
+        self.total_weight = 0.0
+        self.weighted_sum = 0.0
+
+    def fold(self, row):
+        try:
+            self.count += 1
+            weight = self._weight_method(row[self._weight_idx])
+            self.total_weight += row[self._weight_idx]
+            self.weighted_sum += weight * row[self._val_idx]
+        except (IndexError, TypeError):
+            pass
+
+    def merge(self, other):
+        self.count += other.count
+        self.total_weight += other.total_weight
+        self.weighted_sum += other.weighted_sum
+        return self
+
+    def result(self):
+        if self.count:
+            return [self.count, self.total_weight,
+                    self.weighted_sum / self.count]
+        else:
+            return [self.count, self.total_weight, 0.0]
+
+
+class QuantileState(AggregatorState):
+    """ State for ``quantile_sketch`` aggregators, a sketch per index """
+
+    def __init__(self, agg_meta, k=DEFAULT_SKETCH_SIZE, **kwargs):
+        self._agg_meta = agg_meta
+        self._sketches = dict((o.index, KLLSketch(k)) for o in agg_meta)
+
+    def fold(self, row):
+        for index, sketch in self._sketches.iteritems():
+            sketch.update(float(row[index]))
+
+    def merge(self, other):
+        for index, sketch in other._sketches.iteritems():
+            self._sketches[index].merge(sketch)
+        return self
+
+    def result(self):
+        return [self._sketches[o.index].quantile(o.op)
+                for o in self._agg_meta]
+
+
+class CombinedState(AggregatorState):
+    """ State for combined aggregators, the states of each part """
+
+    def __init__(self, agg_methods, **kwargs):
+        self._states = [get_agg_state(a) for a in agg_methods]
+
+    def fold(self, row):
+        for state in self._states:
+            state.fold(row)
+
+    def merge(self, other):
+        for state, other_state in izip(self._states, other._states):
+            state.merge(other_state)
+        return self
+
+    def result(self):
+        return [value for state in self._states for value in state.result()]
+
+    def discard(self):
+        for state in self._states:
+            state.discard()
+
+
+setattr(boolean_rate, METRIC_AGG_METHOD_STATE, BooleanRateState)
+setattr(weighted_rate, METRIC_AGG_METHOD_STATE, WeightedRateState)
+setattr(quantile_sketch, METRIC_AGG_METHOD_STATE, QuantileState)
+
+# The user counts and total weight of rates are totals
+setattr(boolean_rate, METRIC_AGG_METHOD_TOTALS, [0, 1])
+setattr(weighted_rate, METRIC_AGG_METHOD_TOTALS, [0, 1])
+
+
 class Aggregator(object):
     """
     Base class for aggregators.  Standard method for applying aggregators.
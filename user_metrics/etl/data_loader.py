@@ -52,7 +52,9 @@ __license__ = "GPL (version 2 or later)"
 
 
 from time import sleep
+from multiprocessing import Value
 import MySQLdb
+from MySQLdb.cursors import Cursor
 import operator
 import user_metrics.config.settings as projSet
 
@@ -74,6 +76,31 @@ class DataLoaderError(Exception):
         Exception.__init__(self, message)
 
 
+# Number of queries executed on the cursors of ``Connector`` objects.  The
+# count is shared with the processes forked after ``reset_query_count``.
+_query_count = Value('l', 0)
+
+
+def reset_query_count():
+    """ Starts a new count of the queries of this process and its forks """
+    global _query_count
+    _query_count = Value('l', 0)
+
+
+def get_query_count():
+    """ Number of queries issued since ``reset_query_count`` """
+    return _query_count.value
+
+
+class CountingCursor(Cursor):
+    """ Cursor that counts the queries it executes, see ``get_query_count`` """
+
+    def execute(self, query, args=None):
+        with _query_count.get_lock():
+            _query_count.value += 1
+        return super(CountingCursor, self).execute(query, args)
+
+
 class ConnectorError(Exception):
     """ Basic exception class for UserMetric types """
     def __init__(self, message="Could not establish a connection."):
@@ -118,7 +145,7 @@ class Connector(object):
             if not retries:
                 raise ConnectorError()
 
-            self._cur_ = self._db_.cursor()
+            self._cur_ = self._db_.cursor(CountingCursor)
 
     def close_db(self):
         """ Close the conection if it remains open """
@@ -0,0 +1,128 @@
+"""
+    This module implements a KLL_ quantile sketch, a bounded memory summary
+    of a stream of values from which approximate quantiles are read.  The
+    sketches of separate partitions of a data set can be merged, the result
+    is a sketch of the union with the same accuracy guarantee.
+
+    Error bound
+    ~~~~~~~~~~~
+
+    A sketch of size ``k`` keeps ``O(k)`` values.  The rank of a returned
+    quantile differs from the requested rank by at most ``epsilon * n`` with
+    probability 99%, where ``epsilon`` is approximately ``1.7 / k`` for the
+    sizes used here (e.g. 0.85% of the data for the default ``k = 200``).  The
+    sketch is exact while it has seen fewer than ``k`` values::
+
+        >>> sketch = KLLSketch()
+        >>> for x in xrange(10000): sketch.update(x)
+        >>> sketch.quantile(0.9)    # within 85 ranks of 9000
+
+    .. _KLL: http://arxiv.org/abs/1603.05346
+"""
+
+__license__ = "GPL (version 2 or later)"
+
+from math import ceil
+from random import random
+
+# Default number of values kept on the top level of the sketch
+DEFAULT_SKETCH_SIZE = 200
+
+# Rate at which the capacity of lower levels decays
+CAPACITY_DECAY = 2.0 / 3.0
+
+
+def rank_error_bound(k=DEFAULT_SKETCH_SIZE):
+    """
+        Returns the normalised rank error of a sketch of size ``k`` that
+        holds with probability 99%.
+    """
+    return 1.7 / k
+
+
+class KLLSketch(object):
+    """
+    KLL sketch over comparable values.  Level ``h`` of the sketch holds
+    values of weight ``2 ** h``, a full level is compacted by sorting it and
+    promoting every other value (from a random offset) to the next level.
+    """
+
+    def __init__(self, k=DEFAULT_SKETCH_SIZE):
+        self.k = k
+        self.count = 0
+        self._levels = list()
+        self._size = 0
+        self._max_size = 0
+        self._grow()
+
+    def __len__(self):
+        return self.count
+
+    def _grow(self):
+        self._levels.append(list())
+        self._max_size = sum(self._capacity(h)
+                             for h in xrange(len(self._levels)))
+
+    def _capacity(self, h):
+        depth = len(self._levels) - h - 1
+        return int(ceil(CAPACITY_DECAY ** depth * self.k)) + 1
+
+    def _compress(self):
+        """ Compacts the lowest level that is at capacity """
+        for h in xrange(len(self._levels)):
+            level = self._levels[h]
+            if len(level) >= self._capacity(h):
+                if h + 1 >= len(self._levels):
+                    self._grow()
+
+                # An odd value out stays behind
+                last = level.pop() if len(level) % 2 else None
+                level.sort()
+                offset = 1 if random() < 0.5 else 0
+                self._levels[h + 1].extend(level[offset::2])
+                del level[:]
+                if last is not None:
+                    level.append(last)
+
+                self._size = sum(len(l) for l in self._levels)
+                break
+
+    def update(self, value):
+        """ Adds a value to the sketch """
+        self._levels[0].append(value)
+        self._size += 1
+        self.count += 1
+        if self._size >= self._max_size:
+            self._compress()
+
+    def merge(self, other):
+        """ Merges another sketch into this one """
+        while len(self._levels) < len(other._levels):
+            self._grow()
+        for h, level in enumerate(other._levels):
+            self._levels[h].extend(level)
+        self.count += other.count
+
+        self._size = sum(len(l) for l in self._levels)
+        while self._size >= self._max_size:
+            self._compress()
+        return self
+
+    def quantile(self, q):
+        """
+            Returns the value of approximate rank ``q * n`` or ``nan`` if the
+            sketch is empty.
+        """
+        items = sorted((v, 2 ** h) for h, level in enumerate(self._levels)
+                       for v in level)
+        if not items:
+            return float('nan')
+
+        total = sum(w for v, w in items)
+        target = q * total
+        cumulative = 0
+        for v, w in items:
+            cumulative += w
+            if cumulative >= target:
+                return v
+        return items[-1][0]
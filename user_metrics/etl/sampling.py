@@ -0,0 +1,181 @@
+"""
+    This module implements stratified random sampling of cohorts and the
+    estimation of aggregates, with confidence intervals, from the metric
+    results of a sample.
+
+    Design
+    ~~~~~~
+
+    Users are drawn from every stratum (e.g. registration day) with the same
+    inclusion probability, the sampling ``fraction``.  The users of each
+    stratum are put in a random order, and a random offset in [0, 1) is
+    drawn for the stratum, once for the sample frame (``sample_frame``).  A
+    sample of a stratum of ``N`` users holds the first
+    ``floor(fraction * N + offset)`` users of its order, so ``fraction * N``
+    users on average and every user with probability ``fraction``.  The
+    sample is self weighting: aggregates of the sample estimate those of
+    the cohort, only the values that are totals over users (see
+    ``get_agg_totals``) are scaled by ``1 / fraction``.
+
+    Samples of a frame at a larger fraction hold those at smaller ones, so
+    a sample is extended by drawing it again from its frame, e.g. once a
+    pilot sample has shown the precision of the estimates, and users are
+    still included with probability ``fraction``::
+
+        >>> frame = sample_frame(strata)
+        >>> sample = stratified_sample(frame, 0.01)
+        >>> sample = stratified_sample(frame, 0.1)
+
+    Confidence intervals
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Intervals are percentile intervals over ``BOOTSTRAP_REPLICATES`` (set by
+    ``__sample_bootstrap_replicates__`` in the settings) stratified bootstrap
+    replicates of the sample, rows are resampled with replacement within
+    their stratum.  Strata with a single sampled row are pooled.  Intervals
+    are computed for every numeric aggregate, whatever the aggregator, and
+    for each numeric value of aggregates that are dicts (e.g. totals by
+    namespace).
+"""
+
+__license__ = "GPL (version 2 or later)"
+
+import random
+from copy import copy
+from collections import OrderedDict
+from numpy import percentile, isnan, random as np_random
+
+from user_metrics.config import settings
+from user_metrics.etl.aggregator import aggregator, get_agg_totals
+
+# Number of bootstrap replicates over which intervals are computed
+BOOTSTRAP_REPLICATES = int(getattr(settings,
+                                   '__sample_bootstrap_replicates__', 200))
+
+# Confidence level of the intervals
+CONFIDENCE_LEVEL = 0.95
+
+
+def sample_frame(strata):
+    """
+        Builds the sample frame of ``strata``, a dict of lists of users by
+        stratum: the users of each stratum in a random order along with the
+        offset at which the sample sizes of the stratum are rounded.
+    """
+    frame = dict()
+    for stratum, users in strata.iteritems():
+        users = list(users)
+        random.shuffle(users)
+        frame[stratum] = (users, random.random())
+    return frame
+
+
+def stratified_sample(frame, fraction):
+    """
+        Draws users from each stratum of a ``sample_frame`` with inclusion
+        probability ``fraction``.  Returns a dict of lists of sampled users
+        by stratum, holding the samples of the frame at smaller fractions.
+    """
+    sample = dict()
+    for stratum, (users, offset) in frame.iteritems():
+        n = min(int(fraction * len(users) + offset), len(users))
+        if n:
+            sample[stratum] = users[:n]
+    return sample
+
+
+def _is_number(value):
+    return isinstance(value, (int, long, float)) and \
+        not isinstance(value, bool)
+
+
+def _scale(value, factor):
+    """ Scales a total, or a dict of totals, by ``factor`` """
+    if hasattr(value, 'iteritems'):
+        return OrderedDict((k, _scale(v, factor))
+                           for k, v in value.iteritems())
+    if _is_number(value):
+        return value * factor
+    return value
+
+
+def _estimate(agg_method, metric, rows, fraction):
+    """ Aggregate of ``rows`` with totals scaled up to the cohort """
+    sample_metric = copy(metric)
+    sample_metric._results = rows
+    values = aggregator(agg_method, sample_metric, metric.header()).data[1:]
+    for i in get_agg_totals(agg_method):
+        values[i] = _scale(values[i], 1.0 / fraction)
+    return [v.item() if hasattr(v, 'item') else v for v in values]
+
+
+def sample_estimate(agg_method, metric, sample, fraction,
+                    replicates=BOOTSTRAP_REPLICATES,
+                    confidence=CONFIDENCE_LEVEL):
+    """
+        Estimates the aggregate of a cohort from the results of ``metric``
+        over the users of ``sample`` (as returned by ``stratified_sample``).
+        Returns the estimated aggregate values and a list holding, for each
+        value, the ``[lower, upper]`` bounds of its confidence interval, a
+        dict of the bounds by key for dict values, or ``None`` for values
+        that aren't numeric.
+    """
+    stratum_of = dict((str(user), stratum)
+                      for stratum, users in sample.iteritems()
+                      for user in users)
+    rows = list(metric.__iter__())
+    by_stratum = dict()
+    for row in rows:
+        by_stratum.setdefault(stratum_of.get(str(row[0])), list()).append(row)
+
+    pools = [r for r in by_stratum.itervalues() if len(r) > 1]
+    singles = [r[0] for r in by_stratum.itervalues() if len(r) == 1]
+    if singles:
+        pools.append(singles)
+
+    values = _estimate(agg_method, metric, rows, fraction)
+
+    bootstrap = list()
+    for _ in xrange(replicates):
+        resampled = [pool[i] for pool in pools
+                     for i in np_random.randint(0, len(pool), len(pool))]
+        bootstrap.append(_estimate(agg_method, metric, resampled, fraction))
+
+    alpha = 100.0 * (1.0 - confidence) / 2.0
+    intervals = list()
+    for i, value in enumerate(values):
+        if hasattr(value, 'iteritems'):
+            intervals.append(OrderedDict(
+                (k, _interval(v, [b[i].get(k) for b in bootstrap], alpha))
+                for k, v in value.iteritems()))
+        else:
+            intervals.append(_interval(value, [b[i] for b in bootstrap],
+                                       alpha))
+    return values, intervals
+
+
+def _interval(value, points, alpha):
+    """ Percentile interval of the bootstrap ``points`` of a value """
+    points = [p for p in points if _is_number(p) and not isnan(p)]
+    if not _is_number(value) or not points:
+        return None
+    return [float(percentile(points, alpha)),
+            float(percentile(points, 100.0 - alpha))]
+
+
+def relative_error(values, intervals):
+    """
+        Largest half width of the confidence intervals relative to their
+        estimate, ``None`` if no interval is relative to a non-zero value.
+    """
+    errors = list()
+    for value, interval in zip(values, intervals):
+        if hasattr(interval, 'iteritems'):
+            pairs = [(value[k], interval[k]) for k in interval]
+        else:
+            pairs = [(value, interval)]
+        for value, interval in pairs:
+            if interval and value and not isnan(value):
+                errors.append((interval[1] - interval[0]) / 2.0 /
+                              abs(value))
+    return max(errors) if errors else None
@@ -0,0 +1,338 @@
+"""
+    This module implements bounded memory building blocks for the group-by
+    and aggregation paths.  Partial state is kept in memory until it exceeds
+    a memory budget, it is then written to local disk as a sorted run and
+    memory is released.  Reading the state back merges the runs with what is
+    left in memory, so a large request gets slower rather than exhausting
+    the memory of its process.
+
+    Memory budget
+    ~~~~~~~~~~~~~
+
+    The budget, in megabytes, is set by ``__aggregation_memory_budget__`` in
+    the settings and runs are written to ``__aggregation_spill_dir__`` (the
+    system temporary directory by default).  The budget applies to each
+    state separately, i.e. to each worker process.  Run files are removed
+    once the state has been read (or discarded)::
+
+        >>> sorter = SpillingSorter()
+        >>> for x in values: sorter.add(x)
+        >>> sorter.median()
+
+    Since runs live on local disk, states holding runs may be passed between
+    processes of the same host (e.g. through a ``multiprocessing.Queue``).
+    Sorters spill their buffer when pickled, so that only the paths of their
+    runs are passed.
+
+    ``SpilledRows`` holds the rows of a raw request in the same way, in the
+    order they are added, e.g. for them to be encoded one at a time.
+"""
+
+__license__ = "GPL (version 2 or later)"
+
+import os
+import cPickle
+from heapq import merge
+from itertools import groupby
+from operator import itemgetter
+from sys import getsizeof
+from tempfile import mkstemp, gettempdir
+from numpy import array, fromfile, median, float64
+
+from user_metrics.config import logging, settings
+
+# Memory budget of a single state in bytes
+MEMORY_BUDGET = int(getattr(settings, '__aggregation_memory_budget__',
+                            256)) * 1024 * 1024
+
+# Directory in which runs are written
+SPILL_DIR = getattr(settings, '__aggregation_spill_dir__', gettempdir())
+
+# Number of items read from, or pickled to, a run at a time
+RUN_BLOCK_SIZE = 4096
+
+# Number of runs beyond which a sorter merges its runs into one, this bounds
+# the files open while reading the sorter
+MAX_RUNS = 64
+
+# Memory held by a float in a list
+FLOAT_ITEM_SIZE = getsizeof(0.0) + 8
+
+
+def _new_run():
+    """ Creates an empty run file, returns the open file and its path """
+    fd, path = mkstemp(prefix='umapi_run_', dir=SPILL_DIR)
+    return os.fdopen(fd, 'wb'), path
+
+
+def write_run(items):
+    """ Pickles the items of an iterable to a new run, returns its path """
+    f, path = _new_run()
+    with f:
+        block = list()
+        for item in items:
+            block.append(item)
+            if len(block) == RUN_BLOCK_SIZE:
+                cPickle.dump(block, f, cPickle.HIGHEST_PROTOCOL)
+                block = list()
+        if block:
+            cPickle.dump(block, f, cPickle.HIGHEST_PROTOCOL)
+    return path
+
+
+def read_run(path):
+    """ Generator over the items of a run written by ``write_run`` """
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                block = cPickle.load(f)
+            except EOFError:
+                return
+            for item in block:
+                yield item
+
+
+def _write_float_run(values):
+    """ Writes an iterable of floats to a new run, returns its path """
+    f, path = _new_run()
+    with f:
+        block = list()
+        for value in values:
+            block.append(value)
+            if len(block) == RUN_BLOCK_SIZE:
+                array(block, dtype=float64).tofile(f)
+                block = list()
+        if block:
+            array(block, dtype=float64).tofile(f)
+    return path
+
+
+def _read_float_run(path):
+    """ Generator over the values of a run of floats """
+    with open(path, 'rb') as f:
+        while True:
+            block = fromfile(f, dtype=float64, count=RUN_BLOCK_SIZE)
+            if not len(block):
+                return
+            for value in block.tolist():
+                yield value
+
+
+def remove_runs(paths):
+    """ Deletes run files """
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError as e:
+            logging.error(__name__ + ' :: Could not remove run "{0}": {1}'.
+                          format(path, str(e)))
+
+
+class SpillingSorter(object):
+    """
+    Collects floats in bounded memory.  Values are buffered and, beyond the
+    memory budget, sorted and written to a run of raw doubles.  Iterating
+    the sorter yields all values in sorted order.  A pickled sorter holds
+    its runs only, the buffer is spilled first.
+    """
+
+    def __init__(self, budget=MEMORY_BUDGET):
+        self.budget = budget
+        self.count = 0
+        self.runs = list()
+        self._buffer = list()
+
+    def __len__(self):
+        return self.count
+
+    def __getstate__(self):
+        self.spill()
+        return self.__dict__
+
+    def __iter__(self):
+        return merge(sorted(self._buffer),
+                     *[_read_float_run(path) for path in self.runs])
+
+    def _check_budget(self):
+        if len(self._buffer) * FLOAT_ITEM_SIZE >= self.budget:
+            self.spill()
+
+    def add(self, value):
+        self._buffer.append(value)
+        self.count += 1
+        self._check_budget()
+
+    def spill(self):
+        """ Writes the buffered values to a new sorted run """
+        if not self._buffer:
+            return
+        values = array(self._buffer, dtype=float64)
+        values.sort()
+        f, path = _new_run()
+        with f:
+            values.tofile(f)
+        self.runs.append(path)
+        self._buffer = list()
+        logging.debug(__name__ + ' :: Spilled {0} values to "{1}".'.
+                      format(len(values), path))
+
+    def merge(self, other):
+        """ Takes over the values and runs of another sorter """
+        self.runs.extend(other.runs)
+        self._buffer.extend(other._buffer)
+        self.count += other.count
+        other.runs = list()
+        self._check_budget()
+        if len(self.runs) > MAX_RUNS:
+            self.compact()
+        return self
+
+    def compact(self):
+        """ Merges the runs of the sorter into a single run """
+        runs = self.runs
+        self.runs = [_write_float_run(
+            merge(*[_read_float_run(path) for path in runs]))]
+        remove_runs(runs)
+
+    def select(self, ranks):
+        """ Returns the values at the ascending ``ranks`` of the sort """
+        values = list()
+        ranks = iter(ranks)
+        rank = next(ranks, None)
+        for i, value in enumerate(self.__iter__()):
+            while rank == i:
+                values.append(value)
+                rank = next(ranks, None)
+            if rank is None:
+                break
+        return values
+
+    def median(self):
+        """ Median of the values as computed by ``numpy.median`` """
+        if not self.count:
+            return float('nan')
+        if not self.runs:
+            return float(median(self._buffer))
+        mid = self.count // 2
+        if self.count % 2:
+            return self.select([mid])[0]
+        lo, hi = self.select([mid - 1, mid])
+        return (lo + hi) / 2.0
+
+    def discard(self):
+        """ Removes the runs of the sorter """
+        remove_runs(self.runs)
+        self.runs = list()
+        self._buffer = list()
+        self.count = 0
+
+
+class SpillingGroupReducer(object):
+    """
+    Sums lists of values by key in bounded memory.  Beyond the memory budget
+    the partial sums are written to a run sorted on key.  Iterating the
+    reducer yields ``(key, sums, count)`` for every key in key order.
+    """
+
+    def __init__(self, budget=MEMORY_BUDGET):
+        self.budget = budget
+        self.runs = list()
+        self._groups = dict()
+        self._item_size = None
+
+    def add(self, key, values):
+        group = self._groups.get(key)
+        if group is None:
+            self._groups[key] = [list(values), 1]
+            if self._item_size is None:
+                self._item_size = getsizeof(key) + getsizeof(values) + \
+                    sum(getsizeof(v) for v in values) + 200
+            if len(self._groups) * self._item_size >= self.budget:
+                self.spill()
+        else:
+            sums = group[0]
+            for i, value in enumerate(values):
+                sums[i] += value
+            group[1] += 1
+
+    def spill(self):
+        """ Writes the partial sums to a new run sorted on key """
+        if not self._groups:
+            return
+        items = sorted(self._groups.iteritems(), key=itemgetter(0))
+        self.runs.append(write_run((key, sums, count)
+                                   for key, (sums, count) in items))
+        logging.debug(__name__ + ' :: Spilled {0} groups to "{1}".'.
+                      format(len(items), self.runs[-1]))
+        self._groups = dict()
+
+    def __iter__(self):
+        items = sorted(((key, sums, count) for key, (sums, count)
+                        in self._groups.iteritems()), key=itemgetter(0))
+        merged = merge(items, *[read_run(path) for path in self.runs])
+        for key, group in groupby(merged, key=itemgetter(0)):
+            key, sums, count = next(group)
+            for _, other_sums, other_count in group:
+                sums = [a + b for a, b in zip(sums, other_sums)]
+                count += other_count
+            yield key, sums, count
+
+    def discard(self):
+        """ Removes the runs of the reducer """
+        remove_runs(self.runs)
+        self.runs = list()
+        self._groups = dict()
+
+
+class SpilledRows(object):
+    """
+    Collects rows in bounded memory.  Rows are buffered and, beyond the
+    memory budget, written to a run.  Iterating yields the rows in the order
+    they were added.
+    """
+
+    def __init__(self, budget=MEMORY_BUDGET):
+        self.budget = budget
+        self.count = 0
+        self.runs = list()
+        self._buffer = list()
+        self._item_size = None
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for path in self.runs:
+            for row in read_run(path):
+                yield row
+        for row in self._buffer:
+            yield row
+
+    def add(self, row):
+        if self._item_size is None:
+            self._item_size = getsizeof(row) + \
+                sum(getsizeof(x) for x in row) + 8
+        self._buffer.append(row)
+        self.count += 1
+        if len(self._buffer) * self._item_size >= self.budget:
+            self.spill()
+
+    def extend(self, rows):
+        for row in rows:
+            self.add(row)
+
+    def spill(self):
+        """ Writes the buffered rows to a new run """
+        if not self._buffer:
+            return
+        self.runs.append(write_run(self._buffer))
+        logging.debug(__name__ + ' :: Spilled {0} rows to "{1}".'.
+                      format(len(self._buffer), self.runs[-1]))
+        self._buffer = list()
+
+    def discard(self):
+        """ Removes the runs of the rows """
+        remove_runs(self.runs)
+        self.runs = list()
+        self._buffer = list()
+        self.count = 0
@@ -1,6 +1,19 @@
 
 """
     This module contains custom methods to extract time series data.
+
+    Time series are computed over a grid of tasks, one for every pair of
+    interval and cohort chunk.  The tasks run on a single bounded set of
+    worker processes and the results of the chunks of each interval are
+    reduced by the listener as soon as they are complete.  Long series over
+    small cohorts and short series over large cohorts therefore both keep
+    all of the workers busy.
+
+    When the aggregator is mergeable (see ``user_metrics.etl.aggregator``)
+    each task folds its rows into the aggregator state and only the state is
+    returned to the listener, which merges the states of an interval.
+    ``build_aggregate`` uses the same grid to compute a single aggregate
+    over a cohort.
 """
 
 __author__ = "ryan faulkner"
@@ -8,24 +21,45 @@ __date__ = "12/10/2012"
 __license__ = "GPL (version 2 or later)"
 
 import datetime
-import time
 import os
 from copy import deepcopy
 from dateutil.parser import parse as date_parse
 import operator
-import json
+from math import ceil
+from itertools import izip
+from numpy import zeros, concatenate
 
 from user_metrics.config import settings
-from user_metrics.etl.aggregator import aggregator as agg_engine
+from user_metrics.etl.aggregator import aggregator as agg_engine, \
+    get_agg_state, aggregator_from_state, AggregatorState
 from user_metrics.utils import format_mediawiki_timestamp
+from user_metrics.metrics.users import USER_METRIC_PERIOD_TYPE
 from multiprocessing import Process, Queue
 
 from user_metrics.config import logging
+from Queue import Empty
 
-# Determines the amount of time to wait before picking completed threads off
-# of the queue
+# Maximum number of worker processes and the amount of time in seconds that
+# the listener blocks on the event queue before checking worker liveness
 MAX_THREADS = settings.__time_series_thread_max__
-PROCESS_SLEEP_TIME = 4
+PROCESS_LIVENESS_TIMEOUT = 30
+
+# Bounds on the number of users in a single task of the grid
+MIN_CHUNK_SIZE = 50
+MAX_CHUNK_SIZE = 5000
+
+# Tasks per worker of a grid whose progress is reported, so that progress
+# advances while the workers are busy rather than only as they finish
+PROGRESS_TASKS_PER_WORKER = 4
+
+# Event tags placed on the event queue by workers.  Respectively:
+#
+# 1. the worker has exhausted the task queue
+# 2. a task has completed and carries its results and number of users
+# 3. a task failed
+TS_WORKER_COMPLETE = 'ts_worker_complete'
+TS_TASK_COMPLETE = 'ts_task_complete'
+TS_TASK_FAILED = 'ts_task_failed'
 
 
 def _get_timeseries(date_start, date_end, interval):
@@ -45,6 +79,15 @@ def _get_timeseries(date_start, date_end, interval):
         yield c
 
 
+def get_intervals(start, end, interval):
+    """
+        Returns the list of ``(start, end)`` datetime pairs that make up the
+        points of a time series with the given parameters.
+    """
+    series = list(_get_timeseries(start, end, interval))
+    return zip(series[:-1], series[1:])
+
+
 def build_time_series(start, end, interval, metric, aggregator, cohort,
                       **kwargs):
     """
@@ -67,67 +110,248 @@ def build_time_series(start, end, interval, metric, aggregator, cohort,
 
             aggregator : method.
                 Aggregator method used to aggregate data for time
-                series data points
+                series data points.  If this is ``None`` each point
+                carries the raw metric rows for its interval instead
 
             cohort : list(str).
                 list of user IDs
 
+        The keyword argument ``kt_`` sets the number of worker processes
+        that execute the task grid.  If ``callback_`` is passed it is called
+        with each point as soon as it has been reduced, points may arrive
+        out of timestamp order.  Raises ``TimeSeriesException`` if any point
+        could not be computed.
+
         e.g.
 
         >>> cohort = ['156171','13234584']
         >>> metric = ba.BytesAdded
-        >>> aggregator = agg.list_sum_indices
+        >>> aggregator = ba.ba_sum_agg
 
         >>> build_time_series('20120101000000', '20120112000000', 24, metric,
-                aggregator, cohort,
-            num_threads=4, num_threads_metric=2, log=True)
+                aggregator, cohort, kt_=4, log=True)
 
     """
 
-    log = bool(kwargs['log']) if 'log' in kwargs else False
+    callback = kwargs.pop('callback_', None)
+
+    # Get datetime types
+    start = date_parse(format_mediawiki_timestamp(start))
+    end = date_parse(format_mediawiki_timestamp(end))
+
+    intervals = get_intervals(start, end, interval)
+    return _run_task_grid(intervals, metric, aggregator, cohort, kwargs,
+                          callback)
+
+
+def build_aggregate(start, end, metric, aggregator, cohort, **kwargs):
+    """
+        Computes a single aggregate of a metric over the cohort between
+        ``start`` and ``end`` on the task grid.  The cohort is split into
+        chunks that are processed by separate workers, with a mergeable
+        aggregator only the aggregator state of each chunk is returned.
+
+        Returns the aggregate as ``[start, end, name, value, ...]`` or
+        ``None`` if any chunk failed.  Parameters are as in
+        ``build_time_series``.  If ``progress_`` is passed it is called with
+        the number of users of each chunk as soon as the chunk is done.
+    """
+    progress = kwargs.pop('progress_', None)
 
-    # Get datetime types, and the number of threads
     start = date_parse(format_mediawiki_timestamp(start))
     end = date_parse(format_mediawiki_timestamp(end))
+
+    try:
+        data = _run_task_grid([(start, end)], metric, aggregator, cohort,
+                              kwargs, None, progress=progress)
+    except TimeSeriesException:
+        return None
+    return data[0] if data else None
+
+
+def _run_task_grid(intervals, metric, aggregator, cohort, kwargs, callback,
+                   progress=None):
+    """
+        Runs the tasks for every pair of interval and cohort chunk on
+        ``kt_`` worker processes and returns the reduced points.
+        ``progress`` is called with the number of users of every completed
+        task.
+    """
+    log = bool(kwargs['log']) if 'log' in kwargs else False
     k = kwargs['kt_'] if 'kt_' in kwargs else MAX_THREADS
 
-    # Compute window size and ensure that all the conditions
-    # necessary to generate a proper time series are met
-    num_intervals = int((end - start).total_seconds() / (3600 * interval))
-    intervals_per_thread = num_intervals / k
+    if not intervals or not cohort:
+        return []
+
+    chunks = _partition_cohort(
+        cohort, len(intervals),
+        k * PROGRESS_TASKS_PER_WORKER if progress else k)
 
-    # Compose the sets of time series lists
-    f = lambda t, i:  t + datetime.timedelta(
-        hours=int(intervals_per_thread * interval * i))
-    time_series = [_get_timeseries(f(start, i),
-                   f(start, i+1), interval) for i in xrange(k)]
-    if f(start, k) < end:
-        time_series.append(_get_timeseries(f(start, k), end, interval))
+    # Build the task grid, the workers stop on reaching a ``None`` task
+    task_queue = Queue()
+    for i, (ts_s, ts_e) in enumerate(intervals):
+        for chunk in chunks:
+            task_queue.put((i, ts_s, ts_e, chunk))
+
+    k = min(k, len(intervals) * len(chunks))
+    for i in xrange(k):
+        task_queue.put(None)
 
     event_queue = Queue()
     process_queue = list()
 
     if log:
         logging.info(__name__ + ' :: Spawning procs\n'
-                                '\t%s - %s, interval = %s\n'
-                                '\tthreads = %s ... ' % (str(start), str(end),
-                                                       interval, k))
-    for i in xrange(len(time_series)):
+                                '\t%s - %s\n'
+                                '\tthreads = %s, tasks = %s x %s ... ' %
+                                (str(intervals[0][0]), str(intervals[-1][1]),
+                                 k, len(intervals), len(chunks)))
+    for i in xrange(k):
         p = Process(target=time_series_worker,
-                    args=(time_series[i], metric, aggregator,
-                          cohort, event_queue, kwargs))
+                    args=(task_queue, metric, event_queue, kwargs,
+                          aggregator))
         p.start()
         process_queue.append(p)
 
     # Call the listener
-    return time_series_listener(process_queue, event_queue)
+    return time_series_listener(process_queue, event_queue, intervals,
+                                len(chunks), metric, aggregator, kwargs,
+                                callback=callback, progress=progress)
 
 
-def time_series_listener(process_queue, event_queue):
+def _partition_cohort(cohort, num_intervals, k):
+    """
+        Splits the cohort into chunks such that the task grid holds at least
+        ``k`` tasks while every task handles between ``MIN_CHUNK_SIZE`` and
+        ``MAX_CHUNK_SIZE`` users where the cohort size allows.
     """
-        Listener for ``time_series_worker``.  Blocks and logs until all
-        processes computing time series data are complete.  Returns time
-        dependent data from metrics.
+    num_chunks = int(ceil(float(k) / num_intervals))
+    num_chunks = min(num_chunks,
+                     int(ceil(float(len(cohort)) / MIN_CHUNK_SIZE)))
+    num_chunks = max(num_chunks, 1,
+                     int(ceil(float(len(cohort)) / MAX_CHUNK_SIZE)))
+
+    n = int(ceil(float(len(cohort)) / num_chunks))
+    return [cohort[i: i + n] for i in xrange(0, len(cohort), n)]
+
+
+def build_rolling_time_series(start, end, interval, window, metric,
+                              aggregator, cohort, **kwargs):
+    """
+        Builds a rolling window timeseries dataset for a metric whose
+        results are additive over time (see ``UserMetric._additive_fields``).
+
+        Per-user activity is computed once for each interval, starting
+        ``window - 1`` intervals before ``start``.  The rolling value for
+        every user at each point is then the difference of two cumulative
+        sums, so the cost of the series is that of a single series of
+        ``interval`` sized points regardless of the window length.  The
+        aggregator is applied to the rolling per-user rows of each point.
+        Activity is always measured over the intervals themselves, i.e. the
+        metric is run with ``group`` set to ``USER_METRIC_PERIOD_TYPE.INPUT``
+        whatever the ``group`` passed.
+
+        Parameters:
+
+            start, end, interval, metric, aggregator, cohort :
+                As in ``build_time_series``.
+
+            window : int.
+                Number of intervals spanned by each rolling window
+
+        The ``callback_`` keyword argument is handled as in
+        ``build_time_series`` and receives the rolling points.
+
+        e.g.
+
+        >>> build_rolling_time_series('20120101000000', '20121231000000',
+                24, 30, ec.EditCount, edit_count_active_agg, cohort)
+
+    """
+
+    callback = kwargs.pop('callback_', None)
+
+    # Per registration period buckets would only hold the users registered
+    # in each interval, measured over their own windows
+    kwargs['group'] = USER_METRIC_PERIOD_TYPE.INPUT
+
+    fields = metric._additive_fields
+    if not fields:
+        raise TimeSeriesException('Rolling windows require a metric with '
+                                  'additive fields.')
+    window = int(window)
+    if window < 1:
+        raise TimeSeriesException('Rolling window must span at least one '
+                                  'interval.')
+
+    start = date_parse(format_mediawiki_timestamp(start))
+    bucket_start = start - datetime.timedelta(
+        hours=int(interval) * (window - 1))
+
+    buckets = build_time_series(bucket_start, end, interval, metric, None,
+                                cohort, **kwargs)
+
+    # Windows are taken by position, every interval must have its bucket
+    starts = [str(ts_s) for ts_s, ts_e in
+              get_intervals(bucket_start, end, interval)]
+    if [bucket[0] for bucket in buckets] != starts:
+        raise TimeSeriesException('Rolling windows require every interval '
+                                  'of the series.')
+
+    # Build the (interval x user x field) activity matrix
+    user_index = dict()
+    for bucket in buckets:
+        for row in bucket[2]:
+            user_index.setdefault(str(row[0]), len(user_index))
+
+    activity = zeros((len(buckets), len(user_index), len(fields)))
+    for i, bucket in enumerate(buckets):
+        for row in bucket[2]:
+            activity[i, user_index[str(row[0])]] = [row[f] for f in fields]
+
+    # Prefix sums over the interval axis, led by an all zero slice
+    cumulative = concatenate((zeros((1,) + activity.shape[1:]),
+                              activity.cumsum(axis=0)))
+
+    users = sorted(user_index, key=user_index.get)
+    width = len(metric.header())
+    integer_fields = metric._data_model_meta.get('integer_fields', [])
+
+    data = list()
+    for i in xrange(window - 1, len(buckets)):
+        rolling = cumulative[i + 1] - cumulative[i + 1 - window]
+
+        results = list()
+        for user, values in izip(users, rolling.tolist()):
+            row = [user] + [0] * (width - 1)
+            for f, value in izip(fields, values):
+                row[f] = int(round(value)) if f in integer_fields else value
+            results.append(row)
+
+        metric_obj = metric(datetime_start=buckets[i + 1 - window][0],
+                            datetime_end=buckets[i][1], **kwargs)
+        metric_obj._results = results
+
+        r = agg_engine(aggregator, metric_obj, metric.header())
+        data.append([buckets[i][0], buckets[i][1]] + r.data)
+        if callback:
+            callback(data[-1])
+
+    return data
+
+
+def time_series_listener(process_queue, event_queue, intervals, num_chunks,
+                         metric, aggregator, kwargs, callback=None,
+                         progress=None):
+    """
+        Listener for ``time_series_worker``.  Blocks on the event queue until
+        every process computing time series data has posted its completion
+        sentinel, joining workers as they finish.  The chunk results of each
+        interval are reduced to a point as soon as the last of them arrives.
+        Returns time dependent data from metrics.  Once the workers have
+        ended a ``TimeSeriesException`` naming the intervals whose points
+        could not be computed is raised if there are any, the points passed
+        to ``callback`` so far are then incomplete.
 
         Parameters
         ~~~~~~~~~~
@@ -137,98 +361,186 @@ def time_series_listener(process_queue, event_queue):
 
             event_queue : multiprocessing.Queue
                 Asynchronous data coming in from worker processes.
-    """
-    data = list()
 
-    while 1:
-        # sleep before checking worker threads
-        time.sleep(PROCESS_SLEEP_TIME)
+            intervals : list
+                ``(start, end)`` datetime pairs of the series.
+
+            num_chunks : int
+                Number of cohort chunks computed for each interval.
 
-        logging.info(__name__ + ' :: Time series process queue\n'
-                                '\t{0} threads. (PID = {1})'.
-            format(str(len(process_queue)), os.getpid()))
+            metric, aggregator :
+                As in ``build_time_series``.
 
-        while not event_queue.empty():
-            data.extend(event_queue.get())
-        for p in process_queue:
-            if not p.is_alive():
-                p.terminate()
-                process_queue.remove(p)
+            callback : method
+                Optionally called with each point once it is reduced.
 
-        # exit if all process have finished
-        if not len(process_queue):
-            break
+            progress : method
+                Optionally called with the number of users of each task
+                once it completes.
+    """
+    data = list()
+    pending = dict((p.pid, p) for p in process_queue)
+
+    # Results (rows or merged aggregator state) and number of outstanding
+    # chunks by interval index
+    interval_rows = dict()
+    outstanding = dict((i, num_chunks) for i in xrange(len(intervals)))
+    failed = list()
+
+    while pending:
+        try:
+            event = event_queue.get(True, PROCESS_LIVENESS_TIMEOUT)
+        except Empty:
+            # Reap any worker that died without posting its sentinel
+            for pid, p in pending.items():
+                if not p.is_alive():
+                    logging.error(__name__ + ' :: Time series worker exited '
+                                             'without completing (PID = {0}).'.
+                                  format(pid))
+                    p.join()
+                    del pending[pid]
+            continue
+
+        if event[0] == TS_WORKER_COMPLETE:
+            p = pending.pop(event[1], None)
+            if p:
+                p.join()
+            logging.info(__name__ + ' :: Time series process queue\n'
+                                    '\t{0} threads. (PID = {1})'.
+                         format(str(len(pending)), os.getpid()))
+
+        elif event[0] == TS_TASK_FAILED:
+            # The interval can no longer be completed
+            if outstanding.pop(event[1], None) is not None:
+                failed.append(event[1])
+            rows = interval_rows.pop(event[1], None)
+            if isinstance(rows, AggregatorState):
+                rows.discard()
+
+        elif event[1] in outstanding:
+            i = event[1]
+            if progress:
+                progress(event[3])
+            if isinstance(event[2], AggregatorState):
+                if i in interval_rows:
+                    interval_rows[i].merge(event[2])
+                else:
+                    interval_rows[i] = event[2]
+            else:
+                interval_rows.setdefault(i, list()).extend(event[2])
+            outstanding[i] -= 1
+            if not outstanding[i]:
+                del outstanding[i]
+                point = _reduce_interval(intervals[i],
+                                         interval_rows.pop(i, list()),
+                                         metric, aggregator, kwargs)
+                data.append(point)
+                if callback:
+                    callback(point)
+
+        elif isinstance(event[2], AggregatorState):
+            # State of an interval that has already failed
+            event[2].discard()
+
+    # Intervals left outstanding lost a task to a worker that died
+    failed = sorted(failed + outstanding.keys())
+    if failed:
+        for rows in interval_rows.itervalues():
+            if isinstance(rows, AggregatorState):
+                rows.discard()
+        message = '{0} time series points could not be computed: {1}'.\
+            format(len(failed), ', '.join(str(intervals[i][0])
+                                          for i in failed))
+        logging.error(__name__ + ' :: ' + message)
+        raise TimeSeriesException(message)
 
     # sort
     return sorted(data, key=operator.itemgetter(0), reverse=False)
 
 
-def time_series_worker(time_series,
+def _reduce_interval(interval, rows, metric, aggregator, kwargs):
+    """
+        Combines the rows, or merged aggregator state, of all cohort chunks of
+        an interval into a single point.
+    """
+    ts_s, ts_e = interval
+    if not aggregator:
+        return [str(ts_s), str(ts_e), rows]
+
+    if isinstance(rows, AggregatorState):
+        r = aggregator_from_state(aggregator, rows)
+        return [str(ts_s), str(ts_e)] + r.data
+
+    metric_obj = metric(datetime_start=ts_s, datetime_end=ts_e, **kwargs)
+    metric_obj._results = rows
+    r = agg_engine(aggregator, metric_obj, metric.header())
+    return [str(ts_s), str(ts_e)] + r.data
+
+
+def time_series_worker(task_queue,
                        metric,
-                       aggregator,
-                       cohort,
                        event_queue,
-                       kwargs):
+                       kwargs,
+                       aggregator=None):
     """
-        Worker thread which computes time series data for a set of points
+        Worker process which computes metric rows for tasks of the time
+        series grid.  Metrics are run without inner process pools, the
+        workers of the grid provide the parallelism.
 
         Parameter
         ~~~~~~~~~
 
-            time_series : list(datetime)
-                Datetimes defining series.
+            task_queue : multiprocessing.Queue
+                Tasks of the form ``(index, start, end, users)`` ending with
+                a ``None`` task.
 
             metric : string
                 Metric name.
 
-            aggregator : method
-                aggregator method reference.
-
-            cohort : string
-                Cohort name.
-
             event_queue : multiporcessing.Queue
                 Asynchronous data-structure to communicate with parent proc.
+                The results of each task are put on the queue followed by a
+                ``TS_WORKER_COMPLETE`` sentinel once the worker is done.
+
+            aggregator : method
+                If the aggregator is mergeable the rows of each task are
+                folded into its state and only the state is returned.
     """
     log = bool(kwargs['log']) if 'log' in kwargs else False
 
-    data = list()
-    ts_s = time_series.next()
     new_kwargs = deepcopy(kwargs)
-
-    # re-map some keyword args relating to thread counts
-    if 'metric_threads' in new_kwargs:
-        d = json.loads(new_kwargs['metric_threads'])
-        for key in d:
-            new_kwargs[key] = d[key]
-        del new_kwargs['metric_threads']
-
-    while 1:
-        try:
-            ts_e = time_series.next()
-        except StopIteration:
-            break
-
-        if log:
-            logging.info(__name__ + ' :: Processing thread:\n'
-                                    '\t{0}, {1} - {2} ...'.format(os.getpid(),
-                                                                  str(ts_s),
-                                                                  str(ts_e)))
-
-        metric_obj = metric(datetime_start=ts_s, datetime_end=ts_e, **new_kwargs).\
-            process(cohort, **new_kwargs)
-
-        r = agg_engine(aggregator, metric_obj, metric.header())
-
-        if log:
-            logging.info(__name__ + ' :: Processing complete:\n'
-                                    '\t{0}, {1} - {2} ...'.format(os.getpid(),
-                                                                  str(ts_s),
-                                                                  str(ts_e)))
-        data.append([str(ts_s), str(ts_e)] + r.data)
-        ts_s = ts_e
-
-    event_queue.put(data)
+    new_kwargs['k_'] = 1
+    new_kwargs['kr_'] = 1
+
+    try:
+        for task in iter(task_queue.get, None):
+            i, ts_s, ts_e, users = task
+
+            if log:
+                logging.info(__name__ + ' :: Processing thread:\n'
+                                        '\t{0}, {1} - {2}, {3} users ...'.
+                             format(os.getpid(), str(ts_s), str(ts_e),
+                                    len(users)))
+            try:
+                metric_obj = metric(datetime_start=ts_s, datetime_end=ts_e,
+                                    **new_kwargs).process(users,
+                                                          **new_kwargs)
+            except Exception as e:
+                logging.error(__name__ + ' :: Time series task failed '
+                                         '{0} - {1}: {2}'.
+                              format(str(ts_s), str(ts_e), str(e)))
+                event_queue.put((TS_TASK_FAILED, i))
+                continue
+
+            state = get_agg_state(aggregator)
+            if state:
+                event_queue.put((TS_TASK_COMPLETE, i,
+                                 state.fold_rows(metric_obj), len(users)))
+            else:
+                event_queue.put((TS_TASK_COMPLETE, i,
+                                 list(metric_obj.__iter__()), len(users)))
+    finally:
+        event_queue.put((TS_WORKER_COMPLETE, os.getpid()))
 
 
 class TimeSeriesException(Exception):
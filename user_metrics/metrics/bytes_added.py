@@ -10,7 +10,7 @@ from collections import namedtuple
 import user_metric as um
 import os
 from user_metrics.etl.aggregator import list_sum_by_group, \
-    build_numpy_op_agg, build_agg_meta
+    build_numpy_op_agg, build_agg_meta, build_quantile_agg
 import user_metrics.utils.multiprocessing_wrapper as mpw
 from user_metrics.metrics import query_mod
 from user_metrics.metrics.users import UMP_MAP
@@ -74,6 +74,8 @@ class BytesAdded(um.UserMetric):
             _data_model_meta['float_fields'],
         }
 
+    _additive_fields = [1, 2, 3, 4, 5]
+
     @um.pre_metrics_init
     def __init__(self, **kwargs):
         super(BytesAdded, self).__init__(**kwargs)
@@ -92,13 +94,13 @@ class BytesAdded(um.UserMetric):
         args = self._pack_params()
         revs = mpw.build_thread_pool(users, _get_revisions, self.k_, args)
 
-        # Start worker threads and aggregate results for bytes added
-
+        # Start worker threads and aggregate results for bytes added, the
+        # results of each worker are reduced as they arrive
         self._results = \
-            list_sum_by_group(mpw.build_thread_pool(revs,
-                                                    _process_help,
-                                                    self.k_,
-                                                    args), 0)
+            list_sum_by_group(mpw.iter_thread_pool(revs,
+                                                   _process_help,
+                                                   self.k_,
+                                                   args), 0)
 
         # Add any missing users - O(n)
         tallied_users = set([str(r[0]) for r in self._results])
@@ -272,6 +274,9 @@ ba_min_agg = build_numpy_op_agg(build_agg_meta([min], field_prefixes),
 # Build "max" decorator
 ba_max_agg = build_numpy_op_agg(build_agg_meta([max], field_prefixes),
                                 metric_header, 'ba_max_agg')
+# Build approximate "quantiles" decorator
+ba_quantile_agg = build_quantile_agg(field_prefixes, metric_header,
+                                     'ba_quantile_agg')
 
 
 # Used for testing
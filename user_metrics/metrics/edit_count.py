@@ -10,6 +10,11 @@ from user_metrics.metrics import query_mod
 from user_metrics.metrics.users import UMP_MAP
 from user_metrics.utils import multiprocessing_wrapper as mpw
 from user_metrics.config import logging
+from user_metrics.etl.aggregator import METRIC_AGG_METHOD_FLAG, \
+    METRIC_AGG_METHOD_NAME, METRIC_AGG_METHOD_HEAD, \
+    METRIC_AGG_METHOD_KWARGS, METRIC_AGG_METHOD_PUSHDOWN, \
+    build_numpy_op_agg, build_agg_meta, decorator_builder, boolean_rate
+from user_metrics.utils import format_mediawiki_timestamp
 
 
 class EditCount(um.UserMetric):
@@ -53,6 +58,8 @@ class EditCount(um.UserMetric):
         _data_model_meta['float_fields'],
     }
 
+    _additive_fields = [1]
+
     @um.pre_metrics_init
     def __init__(self, **kwargs):
         super(EditCount, self).__init__(**kwargs)
@@ -125,6 +132,45 @@ def _process_help(args):
     return results
 
 
+# ==========================
+# DEFINE METRIC AGGREGATORS
+# ==========================
+
+metric_header = EditCount.header()
+
+field_prefixes = {
+    'edit_count_': 1,
+}
+
+# Build "sum" decorator
+edit_count_sum_agg = build_numpy_op_agg(build_agg_meta([sum], field_prefixes),
+                                        metric_header, 'edit_count_sum_agg')
+
+
+def edit_count_sum_pushdown(users, metric):
+    """ Counts the edits of all users in the database """
+    query_args_type = namedtuple('QueryArgs', 'date_start date_end')
+    args = query_args_type(format_mediawiki_timestamp(metric.datetime_start),
+                           format_mediawiki_timestamp(metric.datetime_end))
+    rows = query_mod.edit_count_sum_query(users, metric.project, args)
+    return [float(rows[0][0]) if rows else 0.0]
+setattr(edit_count_sum_agg, METRIC_AGG_METHOD_PUSHDOWN,
+        edit_count_sum_pushdown)
+
+# Build "proportion" decorator - the fraction of users that made an edit
+edit_count_active_agg = boolean_rate
+edit_count_active_agg = decorator_builder(EditCount.header())(
+    edit_count_active_agg)
+
+setattr(edit_count_active_agg, METRIC_AGG_METHOD_FLAG, True)
+setattr(edit_count_active_agg, METRIC_AGG_METHOD_NAME,
+        'edit_count_active_agg')
+setattr(edit_count_active_agg, METRIC_AGG_METHOD_HEAD, ['total_users',
+                                                        'active_users',
+                                                        'rate'])
+setattr(edit_count_active_agg, METRIC_AGG_METHOD_KWARGS, {'val_idx': 1})
+
+
 # Rudimentary Testing
 if __name__ == '__main__':
     users = ['13234584', '13234503', '13234565', '13234585', '13234556']
@@ -10,7 +10,7 @@ from user_metrics.etl.aggregator import METRIC_AGG_METHOD_FLAG,\
 import user_metric as um
 import edit_count as ec
 from user_metrics.etl.aggregator import weighted_rate, decorator_builder, \
-    build_numpy_op_agg, build_agg_meta
+    build_numpy_op_agg, build_agg_meta, build_quantile_agg
 from numpy import median, min, max, mean, std
 from user_metrics.metrics.users import USER_METRIC_PERIOD_TYPE as umpt
 from user_metrics.utils import enum, format_mediawiki_timestamp
@@ -176,3 +176,7 @@ er_stats_agg = build_numpy_op_agg(build_agg_meta(op_list, field_prefixes),
 
 agg_kwargs = getattr(er_stats_agg, METRIC_AGG_METHOD_KWARGS)
 setattr(er_stats_agg, METRIC_AGG_METHOD_KWARGS, agg_kwargs)
+
+# Build approximate "quantiles" decorator
+er_quantile_agg = build_quantile_agg(field_prefixes, metric_header,
+                                     'er_quantile_agg')
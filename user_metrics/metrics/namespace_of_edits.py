@@ -7,7 +7,8 @@ __license__ = "GPL (version 2 or later)"
 from user_metrics.config import logging
 
 from user_metrics.etl.aggregator import METRIC_AGG_METHOD_FLAG,\
-    METRIC_AGG_METHOD_NAME, METRIC_AGG_METHOD_HEAD
+    METRIC_AGG_METHOD_NAME, METRIC_AGG_METHOD_HEAD, \
+    METRIC_AGG_METHOD_PUSHDOWN, METRIC_AGG_METHOD_TOTALS
 import user_metric as um
 import user_metrics.utils.multiprocessing_wrapper as mpw
 from collections import namedtuple, OrderedDict
@@ -15,6 +16,7 @@ from user_metrics.etl.aggregator import decorator_builder
 from os import getpid
 from user_metrics.metrics import query_mod
 from user_metrics.metrics.users import UMP_MAP
+from user_metrics.utils import format_mediawiki_timestamp
 
 
 class NamespaceEdits(um.UserMetric):
@@ -167,6 +169,26 @@ setattr(namespace_edits_sum, METRIC_AGG_METHOD_HEAD, ['type',
                                                          'weighted_rate',
                                                          'total_editors',
                                                          'reverted_editors'])
+setattr(namespace_edits_sum, METRIC_AGG_METHOD_TOTALS, [1])
+
+
+def namespace_edits_sum_pushdown(users, metric):
+    """ Counts the edits of all users by namespace in the database """
+    query_args_type = namedtuple('QueryArgs', 'start end')
+    args = query_args_type(format_mediawiki_timestamp(metric.datetime_start),
+                           format_mediawiki_timestamp(metric.datetime_end))
+
+    # Same layout as the values of ``namespace_edits_sum``
+    summed_results = ["namespace_edits_sum", OrderedDict()]
+    for ns in NamespaceEdits.VALID_NAMESPACES:
+        summed_results[1][str(ns)] = 0
+    for row in query_mod.namespace_edits_sum_query(users, metric.project,
+                                                   args):
+        if row[0] in NamespaceEdits.VALID_NAMESPACES:
+            summed_results[1][str(row[0])] = int(row[1])
+    return summed_results
+setattr(namespace_edits_sum, METRIC_AGG_METHOD_PUSHDOWN,
+        namespace_edits_sum_pushdown)
 
 if __name__ == "__main__":
     users = ['17792132', '17797320', '17792130', '17792131',
@@ -50,6 +50,8 @@ class PagesCreated(um.UserMetric):
         'list_sum_indices': _data_model_meta['integer_fields'],
     }
 
+    _additive_fields = [1]
+
     @um.pre_metrics_init
     def __init__(self, **kwargs):
         super(PagesCreated, self).__init__(**kwargs)
@@ -118,7 +120,8 @@ def _process_help(args):
 # DEFINE METRIC AGGREGATORS
 # ==========================
 
-from user_metrics.etl.aggregator import build_numpy_op_agg, build_agg_meta
+from user_metrics.etl.aggregator import build_numpy_op_agg, build_agg_meta, \
+    build_quantile_agg
 from user_metrics.etl.aggregator import METRIC_AGG_METHOD_KWARGS
 
 metric_header = PagesCreated.header()
@@ -136,3 +139,7 @@ pages_created_stats_agg = build_numpy_op_agg(
 
 agg_kwargs = getattr(pages_created_stats_agg, METRIC_AGG_METHOD_KWARGS)
 setattr(pages_created_stats_agg, METRIC_AGG_METHOD_KWARGS, agg_kwargs)
+
+# Build approximate "quantiles" decorator
+pages_created_quantile_agg = build_quantile_agg(
+    field_prefixes, metric_header, 'pages_created_quantile_agg')
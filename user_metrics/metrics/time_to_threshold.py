@@ -12,7 +12,7 @@ from user_metrics.etl.aggregator import METRIC_AGG_METHOD_FLAG,\
     METRIC_AGG_METHOD_NAME, METRIC_AGG_METHOD_HEAD, METRIC_AGG_METHOD_KWARGS
 import user_metric as um
 from user_metrics.etl.aggregator import weighted_rate, decorator_builder, \
-    build_numpy_op_agg, build_agg_meta
+    build_numpy_op_agg, build_agg_meta, build_quantile_agg
 from user_metrics.metrics import query_mod
 from numpy import median, min, max
 import user_metrics.utils.multiprocessing_wrapper as mpw
@@ -202,6 +202,10 @@ ttt_stats_agg = build_numpy_op_agg(build_agg_meta(op_list, field_prefixes),
                                    metric_header,
                                    'ttt_stats_agg')
 
+# Build approximate "quantiles" decorator
+ttt_quantile_agg = build_quantile_agg(field_prefixes, metric_header,
+                                      'ttt_quantile_agg')
+
 
 if __name__ == "__main__":
     for i in TimeToThreshold(threshold_type_class='edit_count_threshold',
@@ -55,6 +55,8 @@ from collections import namedtuple
 from user_metrics.metrics.users import USER_METRIC_PERIOD_TYPE
 from user_metrics.utils import build_namedtuple
 from os import getpid
+from itertools import izip
+from numpy import array, int64, float64, bool_
 import user_metrics.config.settings as conf
 
 
@@ -98,6 +100,70 @@ class UserMetricError(Exception):
         Exception.__init__(self, message)
 
 
+class ColumnarResults(object):
+    """
+        Compact container for the results of a metric.  Each field of the
+        result rows is stored as a typed numpy column following the metric
+        ``_data_model_meta``: user IDs as int64 where they are numeric,
+        integer, float and boolean fields as int64, float64 and bool arrays,
+        anything else as objects.  Iteration yields the rows as lists, with
+        user IDs as strings, so the container can stand in for the list of
+        rows of ``UserMetric._results``::
+
+            >>> results = ColumnarResults(rows, BytesAdded._data_model_meta)
+            >>> results.column(1).sum()
+            >>> for row in results: ...
+    """
+
+    FIELD_DTYPES = [
+        ('id_fields', int64),
+        ('integer_fields', int64),
+        ('float_fields', float64),
+        ('boolean_fields', bool_),
+    ]
+
+    def __init__(self, rows, data_model_meta, width=None):
+        if width is None:
+            width = len(rows[0]) if len(rows) else 0
+
+        self._id_fields = data_model_meta.get('id_fields', [])
+        self._columns = list()
+        for index in xrange(width):
+            values = [row[index] for row in rows]
+            dtype = None
+            for field_class, field_dtype in self.FIELD_DTYPES:
+                if index in data_model_meta.get(field_class, []):
+                    dtype = field_dtype
+            try:
+                column = array(values, dtype=dtype)
+            except (TypeError, ValueError, OverflowError):
+                column = array(values, dtype=object)
+            self._columns.append(column)
+
+    def __len__(self):
+        return len(self._columns[0]) if self._columns else 0
+
+    def __iter__(self):
+        columns = [[str(v) for v in column.tolist()]
+                   if index in self._id_fields else column.tolist()
+                   for index, column in enumerate(self._columns)]
+        return (list(row) for row in izip(*columns))
+
+    def __getitem__(self, i):
+        return [str(column[i].item()) if index in self._id_fields
+                else column[i].item() if hasattr(column[i], 'item')
+                else column[i]
+                for index, column in enumerate(self._columns)]
+
+    def column(self, index):
+        """ Returns the typed array of a field, no copy is made """
+        return self._columns[index]
+
+    @property
+    def nbytes(self):
+        return sum(column.nbytes for column in self._columns)
+
+
 class UserMetric(object):
 
     ALL_NAMESPACES = 'all'
@@ -112,6 +178,10 @@ class UserMetric(object):
     _data_model_meta = dict()
     _agg_indices = dict()
 
+    # Indices of result fields that sum over adjoining time windows, these
+    # allow rolling window series to be built from prefix sums
+    _additive_fields = list()
+
     # Structure that defines parameters for UserMetric class
     _param_types = {
         'init': {
@@ -134,6 +204,7 @@ class UserMetric(object):
                    conf.__user_thread_max__],
             'kr_': [int, 'Number of worker processes over revisions.',
                     conf.__rev_thread_max__],
+            'columnar_': [bool, 'Store results as typed columns.', False],
         }
     }
 
@@ -211,6 +282,16 @@ class UserMetric(object):
     def __iter__(self):
         return (r for r in self._results)
 
+    @property
+    def _results(self):
+        return self._result_rows
+
+    @_results.setter
+    def _results(self, rows):
+        # Drop the columns cached by aggregators for the previous results
+        self._result_rows = rows
+        self._columns = None
+
     @classmethod
     def _construct_data_point(cls):
         return namedtuple(cls.__name__, cls.header())
@@ -249,7 +330,15 @@ class UserMetric(object):
             if hasattr(self, 'log_') and self.log_:
                 logging.info(__name__ + ' :: parameters = ' + str(kwargs))
 
-            return proc_func(self, users, **kwargs)
+            metric = proc_func(self, users, **kwargs)
+
+            # Optionally replace the result rows with a columnar container
+            if hasattr(self, 'columnar_') and self.columnar_ and \
+                    not isinstance(self._results, ColumnarResults):
+                self._results = ColumnarResults(self._results,
+                                                self._data_model_meta,
+                                                len(self.header()))
+            return metric
         return wrapper
 
     def process(self, users, **kwargs):
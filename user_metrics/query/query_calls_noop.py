@@ -78,10 +78,39 @@ def namespace_edits_rev_query(users, project, args):
     return []
 namespace_edits_rev_query.__query_name__ = 'namespace_edits_rev_query'
 
+def edit_count_sum_query(users, project, args):
+    """ Obtain the total rev count of all users """
+    return []
+edit_count_sum_query.__query_name__ = 'edit_count_sum_query'
+
+def namespace_edits_sum_query(users, project, args):
+    """ Obtain the total revisions of all users by namespace """
+    return []
+namespace_edits_sum_query.__query_name__ = 'namespace_edits_sum_query'
+
 def user_registration_date(users, project, args):
     return []
 user_registration_date.__query_name__ = 'user_registration_date'
 
+def get_cohort_id(cohort_name):
+    """ Returns the id of a cohort """
+    return None
+
+def get_cohort_size(tag_id):
+    """ Returns the number of users in a cohort """
+    return 0
+get_cohort_size.__query_name__ = 'get_cohort_size'
+
+def get_cohort_project_by_id(tag_id):
+    """ Returns the project of a cohort given its id """
+    return None
+get_cohort_project_by_id.__query_name__ = 'get_cohort_project_by_id'
+
+def replica_lag_query(project):
+    """ Returns the replication lag in seconds of a project database """
+    return 0.0
+replica_lag_query.__query_name__ = 'replica_lag_query'
+
 query_store = {
     rev_count_query.__query_name__: None,
     live_account_query.__query_name__: None,
@@ -96,7 +125,12 @@ query_store = {
     blocks_user_query.__query_name__: None,
     edit_count_user_query.__query_name__: None,
     namespace_edits_rev_query.__query_name__: None,
+    edit_count_sum_query.__query_name__: None,
+    namespace_edits_sum_query.__query_name__: None,
     user_registration_date.__query_name__: None,
+    get_cohort_size.__query_name__: None,
+    get_cohort_project_by_id.__query_name__: None,
+    replica_lag_query.__query_name__: None,
     }
 
 
@@ -394,6 +394,30 @@ def namespace_edits_rev_query(users, project, args):
 namespace_edits_rev_query.__query_name__ = 'namespace_edits_rev_query'
 
 
+@query_method_deco
+def edit_count_sum_query(users, project, args):
+    """ Obtain the total rev count of all users """
+    query = query_store[edit_count_sum_query.__query_name__]
+    try:
+        params = {'start': str(args.date_start), 'end': str(args.date_end)}
+    except AttributeError as e:
+        raise UMQueryCallError(__name__ + ' :: ' + str(e))
+    return query, params
+edit_count_sum_query.__query_name__ = 'edit_count_sum_query'
+
+
+@query_method_deco
+def namespace_edits_sum_query(users, project, args):
+    """ Obtain the total revisions of all users by namespace """
+    query = query_store[namespace_edits_sum_query.__query_name__]
+    try:
+        params = {'start': str(args.start), 'end': str(args.end)}
+    except AttributeError as e:
+        raise UMQueryCallError(__name__ + ' :: ' + str(e))
+    return query, params
+namespace_edits_sum_query.__query_name__ = 'namespace_edits_sum_query'
+
+
 @query_method_deco
 def user_registration_date_logging(users, project, args):
     """ Returns user registration date from logging table """
@@ -704,6 +728,30 @@ def get_cohort_project_by_meta(cohort_name):
         return None
 
 
+def get_cohort_project_by_id(tag_id):
+    """
+        Returns the project of a cohort given its id.
+
+        Parameters
+        ~~~~~~~~~~
+
+            tag_id : int
+                Cohort id.
+    """
+    conn = Connector(instance=conf.__cohort_data_instance__)
+    utm_query = query_store[get_cohort_project_by_id.__query_name__]
+    utm_query = sub_tokens(utm_query, db=conf.__cohort_meta_instance__,
+                           table=conf.__cohort_meta_db__)
+    try:
+        conn._cur_.execute(utm_query, {'utm_id': int(tag_id)})
+    except (ValueError, ProgrammingError, OperationalError) as e:
+        raise UMQueryCallError(__name__ + ' :: ' + str(e))
+    data = conn._cur_.fetchone()
+    del conn
+    return data[0] if data else None
+get_cohort_project_by_id.__query_name__ = 'get_cohort_project_by_id'
+
+
 def get_cohort_users(tag_id):
     """
         Returns user id list for cohort.
@@ -729,6 +777,30 @@ def get_cohort_users(tag_id):
 get_cohort_users.__query_name__ = 'get_cohort_users'
 
 
+def get_cohort_size(tag_id):
+    """
+        Returns the number of users in a cohort.
+
+        Parameters
+        ~~~~~~~~~~
+
+            tag_id : int
+                Cohort id.
+    """
+    conn = Connector(instance=conf.__cohort_data_instance__)
+    ut_query = query_store[get_cohort_size.__query_name__]
+    ut_query = sub_tokens(ut_query, db=conf.__cohort_meta_instance__,
+                          table=conf.__cohort_db__)
+    try:
+        conn._cur_.execute(ut_query, {'tag_id': int(tag_id)})
+    except (ValueError, ProgrammingError, OperationalError):
+        raise UMQueryCallError(__name__ + ' :: Failed to count users.')
+    size = conn._cur_.fetchone()[0]
+    del conn
+    return int(size)
+get_cohort_size.__query_name__ = 'get_cohort_size'
+
+
 def get_mw_user_id(username, project):
     """
     Returns a UID given.
@@ -757,6 +829,33 @@ def get_mw_user_id(username, project):
     return uid
 get_mw_user_id.__query_name__ = 'get_mw_user_id'
 
+
+def replica_lag_query(project):
+    """
+    Returns the replication lag in seconds of the database of a project,
+    measured as the age of its latest recent change.
+
+    Parameters
+    ~~~~~~~~~~
+
+        project : string
+            MediaWiki project.
+    """
+    conn = Connector(instance=conf.PROJECT_DB_MAP[project])
+    query = query_store[replica_lag_query.__query_name__]
+    query = sub_tokens(query, db=escape_var(project))
+
+    try:
+        conn._cur_.execute(query)
+        lag = conn._cur_.fetchone()[0]
+    except (IndexError, ProgrammingError, OperationalError,
+            TypeError) as e:
+        raise UMQueryCallError(__name__ + ' :: ' + str(e))
+
+    del conn
+    return float(lag) if lag is not None else 0.0
+replica_lag_query.__query_name__ = 'replica_lag_query'
+
 def is_valid_uid_query(uid, project):
     conn = Connector(instance=conf.PROJECT_DB_MAP[project])
     query = query_store[is_valid_uid_query.__name__]
@@ -972,6 +1071,27 @@ query_store = {
             AND rev_timestamp < %(end)s
         GROUP BY 1,2
     """,
+    edit_count_sum_query.__query_name__:
+    """
+        SELECT count(*)
+        FROM <database>.revision
+        WHERE rev_user IN (<users>)
+            AND rev_timestamp >= %(start)s
+            AND rev_timestamp < %(end)s
+    """,
+    namespace_edits_sum_query.__query_name__:
+    """
+        SELECT
+            p.page_namespace,
+            count(*) AS revs
+        FROM <database>.revision AS r
+            JOIN <database>.page AS p
+            ON r.rev_page = p.page_id
+        WHERE rev_user in (<users>)
+            AND rev_timestamp >= %(start)s
+            AND rev_timestamp < %(end)s
+        GROUP BY 1
+    """,
     user_registration_date_logging.__query_name__:
     """
         SELECT
@@ -1040,18 +1160,35 @@ query_store = {
         FROM <database>.<table>
         WHERE utm_name = %(utm_name)s
     """,
+    get_cohort_project_by_id.__query_name__:
+    """
+        SELECT utm_project
+        FROM <database>.<table>
+        WHERE utm_id = %(utm_id)s
+    """,
     get_mw_user_id.__query_name__:
     """
         SELECT user_id
         FROM <database>.user
         WHERE user_name = %(username)s
     """,
+    replica_lag_query.__query_name__:
+    """
+        SELECT UNIX_TIMESTAMP() - UNIX_TIMESTAMP(MAX(rc_timestamp))
+        FROM <database>.recentchanges
+    """,
     get_cohort_users.__query_name__:
     """
         SELECT ut_user
         FROM <database>.<table>
         WHERE ut_tag = %(tag_id)s
     """,
+    get_cohort_size.__query_name__:
+    """
+        SELECT count(*)
+        FROM <database>.<table>
+        WHERE ut_tag = %(tag_id)s
+    """,
     get_latest_user_activity.__query_name__:
     """
         SELECT
@@ -22,7 +22,18 @@ def build_thread_pool(data, callback, k, args):
         Handles initializing, executing, and cleanup for thread pools. Given
         the iterable ``data`` and a thread count ``k`` partition the data and
         execute ``k`` independent jobs on ``callback`` with ``args`` passed.
-        Finally combine the results of each job.
+        Finally combine the results of each job.  When the data fits into a
+        single partition the callback is executed in the calling process
+        and no pool is started.
+    """
+    return list(iter_thread_pool(data, callback, k, args))
+
+
+def iter_thread_pool(data, callback, k, args):
+    """
+        Generator form of ``build_thread_pool``, yields the results of each
+        job as soon as it, and the jobs before it, complete rather than
+        combining them in memory first.
     """
 
     # partition data
@@ -35,19 +46,22 @@ def build_thread_pool(data, callback, k, args):
     # remove any args with empty revision lists
     arg_list = filter(lambda x: len(x[0]), arg_list)
     if not arg_list:
-        return []
+        return
+
+    if len(arg_list) == 1:
+        elem = callback(arg_list[0])
+        for item in (elem if hasattr(elem, '__iter__') else [elem]):
+            yield item
+        return
 
     pool = NonDaemonicPool(processes=len(arg_list))
-    results = list()
-    # Call worker threads and aggregate results
-    if arg_list:
-        for elem in pool.map(callback, arg_list):
-            if hasattr(elem, '__iter__'):
-                results.extend(elem)
-            else:
-                results.extend([elem])
-    pool.terminate()
-    return results
+    # Call worker threads and yield their results
+    try:
+        for elem in pool.imap(callback, arg_list):
+            for item in (elem if hasattr(elem, '__iter__') else [elem]):
+                yield item
+    finally:
+        pool.terminate()
 
 
 class NoDaemonicProcess(mp.Process):